@@ -0,0 +1,66 @@
+"""
+决策树遍历微基准：只测 DiagnosisEngine._walk_tree 的分支求值开销（不取数、不跑 action）。
+
+用法:
+    python scripts/bench_decision_tree.py [--iterations 20000]
+
+- 关闭 [详情排障] 日志（UIX_DETAIL_TRACE=0），否则 stdout 输出会淹没被测开销
+- step.details 的 action 替换为恒等函数，context 由各场景直接给出
+- 输出每个场景的路径长度与单次遍历耗时（µs/walk）
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+os.environ.setdefault("UIX_DETAIL_TRACE", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'backend'))
+logging.disable(logging.WARNING)
+
+from app.engine.diagnosis_engine import DiagnosisEngine  # noqa: E402
+
+# 场景名 → (metric_values, base_context)；值按 reject_errors 管线的分支条件挑选
+SCENARIOS = {
+    # 1 → 11 → 20 → 21 → [22, 23, 24] 三个子分支 → 50 → 99
+    "multi_target": (
+        {
+            "Mwx_0": 1.00005, "n_88um": 3, "output_Mw": 1.0,
+            "output_Tx": 1.0, "output_Ty": 30.0, "output_Rw": 10.0,
+            "mean_Tx": 0.5, "mean_Ty": 5.0, "mean_Rw": 3.0, "normal_count": 2,
+        },
+        {},
+    ),
+    # 1 → 10 → 20 → 99
+    "short_exit": ({"Mwx_0": 1.2, "n_88um": 12}, {}),
+    # output_Mw 越界且 action 不回写：continue_model 回路走满 max_steps=50
+    "loop_to_max_steps": ({"Mwx_0": 0.5, "n_88um": 3, "output_Mw": 99.0}, {}),
+}
+
+
+def bench(engine: DiagnosisEngine, metric_values, base_context, iterations: int):
+    start_node = str(engine.rule_loader.diagnosis_scenes[0].get("start_node", "1"))
+    _, _, trace, _, _ = engine._walk_tree(start_node, metric_values, base_context)
+    began = time.perf_counter()
+    for _ in range(iterations):
+        engine._walk_tree(start_node, metric_values, base_context)
+    elapsed = time.perf_counter() - began
+    return len(trace), elapsed / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    engine = DiagnosisEngine()
+    engine._execute_details = lambda step, context: context
+
+    print(f"{'scenario':<20} {'steps':>6} {'us/walk':>10} {'us/step':>9}")
+    for name, (metric_values, base_context) in SCENARIOS.items():
+        steps, per_walk = bench(engine, metric_values, base_context, args.iterations)
+        print(f"{name:<20} {steps:>6} {per_walk:>10.2f} {per_walk / steps:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,12 @@ from typing import Any, Dict, Optional
 
 from app.engine.actions import has_action
 from app.engine.condition_evaluator import extract_vars_from_definition
+from app.engine.metric_plan import compile_metric_plans
+from app.engine.step_plan import compile_step_plans
+from app.engine.threshold_index import build_threshold_index
 from app.engine.rule_validator import validate_rules_config
+from app.engine.scene_dispatch import compile_scene_dispatch
+from app.engine.subtree_effects import build_subtree_index
 from app.utils import detail_trace
 
 
@@ -52,9 +57,16 @@ class DiagnosisConfigStore:
         self.version = "unknown"
         self.pipeline_defs: Dict[str, Dict[str, Any]] = {}
         self.pipeline_cache: Dict[str, Dict[str, Any]] = {}
-        self.reload()
+        self._load()
 
     def reload(self) -> None:
+        """热加载配置；跨请求指标窗口缓存里的结果可能对应旧指标配置，一并清空。"""
+        self._load()
+        from app.engine.metric_fetcher import clear_metric_window_cache
+
+        clear_metric_window_cache()
+
+    def _load(self) -> None:
         with open(self.root_path, "r", encoding="utf-8") as f:
             data = json.load(f)
         self.version = data.get("version", "unknown")
@@ -195,6 +207,17 @@ class DiagnosisConfigStore:
             "steps": steps,
             "steps_map": {str(step.get("id")): step for step in steps if "id" in step},
             "metrics": metrics,
+            # 每个指标的取数计划（标识符、linking 谓词、filter 解析树、提取器等）在加载时编译一次，
+            # reload() 清空 pipeline_cache 后随新 bundle 重新编译
+            "metric_plans": compile_metric_plans(metrics),
+            # 决策树分支条件同样在加载时预解析成闭包（见 app.engine.step_plan）
+            "step_plans": compile_step_plans(steps),
+            # 详情页指标阈值（含 any_of 各分支展示文本）按指标预先解析
+            "threshold_index": build_threshold_index(steps, metrics),
+            # 场景触发：免费谓词（源记录字段 / 请求参数）与查库触发指标分开，先排除再查库
+            "scene_dispatch": compile_scene_dispatch(scenes, metrics),
+            # 多目标分支：每个 step 可达子图的 context 读写集，决定子分支能否并发
+            "subtree_index": build_subtree_index(steps),
             "default_scene_id": next(
                 (scene.get("id") for scene in scenes if scene.get("default")),
                 None,
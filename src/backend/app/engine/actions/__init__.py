@@ -11,7 +11,8 @@ Action Function Registry
 
 新增函数步骤：
     1. 在 actions/ 目录下创建 .py 文件（或在 builtin.py 里追加）
-    2. 用 @register("函数名") 装饰
+    2. 用 @register("函数名", reads=[...], writes=[...]) 装饰，reads / writes 列出函数
+       经 **context 直接读取的键、返回 dict 可能包含的键
     3. 在本文件末尾 import 该模块
 
 函数签名约定：
@@ -22,25 +23,60 @@ Action Function Registry
     - 所有参数都有默认值（None），函数永远不会因缺参而崩溃
     - 返回 dict，key 即 results 中的字段名
     - **context 接收当前上下文中的所有其他变量（供函数内部访问）
+    - 具名参数没在 params 里声明时同样取 context 同名键，自动计入读集；
+      未声明 reads 的 action 视为可能读取任意键（按需取数时先取齐场景指标），
+      reads / writes 缺一即视为不透明（多目标分支里与任何子分支冲突、一律串行）
 """
 import logging
 import importlib
+import inspect
 import pkgutil
 import time
-from typing import Any, Callable, Dict, Optional
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Optional
 
 from app.utils import detail_trace
 
 logger = logging.getLogger(__name__)
 
 _REGISTRY: Dict[str, Callable] = {}
+# action → 会从 context 读取的键（具名参数 + 声明的 reads）；未声明 reads 的不在表中
+_READS: Dict[str, FrozenSet[str]] = {}
+# action → 返回 dict 可能包含的键；未声明 writes 的不在表中
+_WRITES: Dict[str, FrozenSet[str]] = {}
+# action → 具名参数默认值，解析 reads / writes 里 "{param}"（键名由参数值决定）时使用
+_DEFAULTS: Dict[str, Dict[str, Any]] = {}
 _AUTOLOADED = False
 
 
-def register(name: str):
-    """装饰器：注册 action 函数"""
+def register(
+    name: str,
+    reads: Optional[Iterable[str]] = None,
+    writes: Optional[Iterable[str]] = None,
+):
+    """
+    装饰器：注册 action 函数。
+
+    reads：函数经 **context 直接读取、未必出现在 params 里的 context 键；
+    writes：返回 dict 可能包含的键（输出全部进入 context，不受 results 声明过滤）。
+    写成 "{param}" 表示键名是参数 param 的值（如 increment_counter 的 counter_name）。
+    None 表示未知。
+    """
     def decorator(fn: Callable) -> Callable:
         _REGISTRY[name] = fn
+        named = [
+            param
+            for param in inspect.signature(fn).parameters.values()
+            if param.kind in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY)
+        ]
+        _DEFAULTS[name] = {param.name: param.default for param in named if param.default is not param.empty}
+        if reads is None:
+            _READS.pop(name, None)
+        else:
+            _READS[name] = frozenset(param.name for param in named) | frozenset(reads)
+        if writes is None:
+            _WRITES.pop(name, None)
+        else:
+            _WRITES[name] = frozenset(writes)
         return fn
     return decorator
 
@@ -50,6 +86,40 @@ def has_action(name: str) -> bool:
     return name in _REGISTRY
 
 
+def action_reads(name: str, params: Optional[Dict[str, Any]] = None) -> Optional[FrozenSet[str]]:
+    """
+    按本次 params 解析 action 会从 context 读取的键（不含 params 中 "{var}" 引用的键）。
+
+    未注册、未声明 reads，或 "{param}" 的参数值要到运行时才知道（来自 context）时返回 None。
+    """
+    return _resolve_keys(name, _READS.get(name), params)
+
+
+def action_writes(name: str, params: Optional[Dict[str, Any]] = None) -> Optional[FrozenSet[str]]:
+    """按本次 params 解析 action 输出可能写入 context 的键；无法确定时返回 None（同 action_reads）。"""
+    return _resolve_keys(name, _WRITES.get(name), params)
+
+
+def _resolve_keys(
+    name: str,
+    declared: Optional[FrozenSet[str]],
+    params: Optional[Dict[str, Any]],
+) -> Optional[FrozenSet[str]]:
+    if declared is None:
+        return None
+    keys = set()
+    for key in declared:
+        if not (key.startswith("{") and key.endswith("}")):
+            keys.add(key)
+            continue
+        param = key[1:-1]
+        raw_value = (params or {}).get(param, _DEFAULTS[name].get(param))
+        if not isinstance(raw_value, str) or not raw_value.strip() or raw_value.strip().startswith("{"):
+            return None
+        keys.add(raw_value)
+    return frozenset(keys)
+
+
 def list_actions() -> Dict[str, Callable]:
     """返回 action 注册表副本（只读用途）。"""
     return dict(_REGISTRY)
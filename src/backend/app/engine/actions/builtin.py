@@ -2,13 +2,45 @@
 内置 Action 函数
 """
 import json
+import logging
+import os
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import numpy as np
 
+from app.utils.ttl_cache import TTLCache
+
 from . import register
 
+logger = logging.getLogger(__name__)
+
+# 月均值聚合缓存：键 (equipment, chuck, 列, 窗口起止时刻)，重复打开同一条记录的详情只查一次库；
+# 空窗口（count=0）不缓存，避免一次暂时性缺数在整个 TTL 内被复用。MONTHLY_MEAN_CACHE_TTL_SECONDS=0 关闭。
+try:
+    MONTHLY_MEAN_CACHE_TTL_SECONDS = max(0, int(os.environ.get("MONTHLY_MEAN_CACHE_TTL_SECONDS", 600)))
+except (TypeError, ValueError):
+    logger.warning(
+        "MONTHLY_MEAN_CACHE_TTL_SECONDS=%r 非法，回退到 600",
+        os.environ.get("MONTHLY_MEAN_CACHE_TTL_SECONDS"),
+    )
+    MONTHLY_MEAN_CACHE_TTL_SECONDS = 600
+_monthly_aggregate_cache = TTLCache(256, MONTHLY_MEAN_CACHE_TTL_SECONDS)
+
+# action 经 **ctx 直接读取的 context 键（具名参数由 register 自动计入）与输出键：
+# 按需取数据此先取齐读取的指标，多目标分支据此判断子分支能否并发
+_MONTHLY_MEAN_READS = frozenset({"equipment", "chuck_id", "reference_time"})
+_BUILD_MODEL_READS = frozenset({
+    "ws_pos_x", "ws_pos_y", "mark_pos_x", "mark_pos_y",
+    "Msx", "Msy", "e_ws_x", "e_wsx", "e_ws_y", "e_wsy",
+    "Sx", "S_x", "Sy", "S_y", "D_x", "D_y",
+    # 建模失败时的回退输出
+    "Tx", "Ty", "Rw",
+})
+_BUILD_MODEL_WRITES = frozenset({
+    "output_Tx", "output_Ty", "output_Mw", "output_Rw", "n_88um", "model_history",
+})
+
 
 def _to_float(value: Any, default: float = 0.0) -> float:
     try:
@@ -65,10 +97,33 @@ def _first_numeric(values: Any, fallback: float = 0.0) -> float:
     return _to_float(values, fallback)
 
 
+def _query_monthly_aggregate(
+    column_name: str,
+    equipment: str,
+    chuck_id: Any,
+    time_start: datetime,
+    time_end: datetime,
+) -> Dict[str, Any]:
+    """经 ODS 聚合接口取窗口 AVG/COUNT/STDDEV，按 (equipment, chuck, 列, 窗口起止时刻) 缓存。"""
+    cache_key = (str(equipment), str(chuck_id), column_name, time_start, time_end)
+    hit, cached = _monthly_aggregate_cache.get(cache_key)
+    if hit:
+        return cached
+
+    from app.ods.datacenter_ods import DatacenterODS
+
+    aggregate = DatacenterODS.query_performance_aggregate(
+        column_name, equipment, chuck_id, time_start, time_end
+    )
+    if aggregate and aggregate.get("count") and aggregate.get("avg") is not None:
+        _monthly_aggregate_cache.set(cache_key, aggregate)
+    return aggregate
+
+
 def _query_monthly_mean(column_name: str, current_value: Optional[float], **ctx) -> float:
     """
     查询某指标在当前基准时间前 30 天的均值。
-    过滤口径：equipment + chuck_id + 时间窗口。
+    过滤口径：equipment + chuck_id + 时间窗口；均值在 MySQL 端 AVG 计算，只回传一行。
     """
     equipment = ctx.get("equipment")
     chuck_id = ctx.get("chuck_id")
@@ -88,28 +143,13 @@ def _query_monthly_mean(column_name: str, current_value: Optional[float], **ctx)
     time_start = reference_time - timedelta(days=30)
 
     try:
-        from app.ods.datacenter_ods import LoBatchEquipmentPerformance, SessionLocal
-
-        db = SessionLocal()
-        try:
-            col = getattr(LoBatchEquipmentPerformance, column_name)
-            rows = (
-                db.query(col)
-                .filter(
-                    LoBatchEquipmentPerformance.equipment == equipment,
-                    LoBatchEquipmentPerformance.chuck_id == str(chuck_id),
-                    LoBatchEquipmentPerformance.wafer_product_start_time >= time_start,
-                    LoBatchEquipmentPerformance.wafer_product_start_time <= reference_time,
-                )
-                .all()
-            )
-            values = [_to_float(item[0], None) for item in rows if item and item[0] is not None]
-            values = [v for v in values if v is not None]
-            return _mean(values, _to_float(current_value, 0.0))
-        finally:
-            db.close()
-    except Exception:
+        aggregate = _query_monthly_aggregate(column_name, equipment, chuck_id, time_start, reference_time)
+    except Exception as exc:
+        logger.warning("月均值聚合查询失败，回退当前值: column=%s error=%s", column_name, exc)
+        return _to_float(current_value, 0.0)
+    if aggregate.get("avg") is None:
         return _to_float(current_value, 0.0)
+    return float(aggregate["avg"])
 
 
 def _solve_b_wa_4param_pinv(
@@ -253,7 +293,7 @@ def _build_model(amplitude_um: float, **ctx) -> Dict[str, Any]:
 
 # ── 月均值计算 ───────────────────────────────────────────────────────────────
 
-@register("calculate_monthly_mean_Tx")
+@register("calculate_monthly_mean_Tx", reads=_MONTHLY_MEAN_READS, writes={"mean_Tx"})
 def calculate_monthly_mean_Tx(Tx: Optional[float] = None, **ctx) -> dict:
     values = _to_float_list(Tx)
     if values:
@@ -261,7 +301,7 @@ def calculate_monthly_mean_Tx(Tx: Optional[float] = None, **ctx) -> dict:
     return {"mean_Tx": _query_monthly_mean("wafer_translation_x", Tx, **ctx)}
 
 
-@register("calculate_monthly_mean_Ty")
+@register("calculate_monthly_mean_Ty", reads=_MONTHLY_MEAN_READS, writes={"mean_Ty"})
 def calculate_monthly_mean_Ty(Ty: Optional[float] = None, **ctx) -> dict:
     values = _to_float_list(Ty)
     if values:
@@ -269,7 +309,7 @@ def calculate_monthly_mean_Ty(Ty: Optional[float] = None, **ctx) -> dict:
     return {"mean_Ty": _query_monthly_mean("wafer_translation_y", Ty, **ctx)}
 
 
-@register("calculate_monthly_mean_Rw")
+@register("calculate_monthly_mean_Rw", reads=_MONTHLY_MEAN_READS, writes={"mean_Rw"})
 def calculate_monthly_mean_Rw(Rw: Optional[float] = None, **ctx) -> dict:
     values = _to_float_list(Rw)
     if values:
@@ -279,17 +319,21 @@ def calculate_monthly_mean_Rw(Rw: Optional[float] = None, **ctx) -> dict:
 
 # ── 建模步骤 ────────────────────────────────────────────────────────────────
 
-@register("build_88um_model")
+@register("build_88um_model", reads=_BUILD_MODEL_READS, writes=_BUILD_MODEL_WRITES)
 def build_88um_model(**ctx) -> dict:
     return _build_model(88.0, **ctx)
 
 
-@register("build_8um_model")
+@register("build_8um_model", reads=_BUILD_MODEL_READS, writes=_BUILD_MODEL_WRITES)
 def build_8um_model(**ctx) -> dict:
     return _build_model(8.0, **ctx)
 
 
-@register("build_model")
+@register(
+    "build_model",
+    reads=_BUILD_MODEL_READS | {"model_type", "Mwx_0"},
+    writes=_BUILD_MODEL_WRITES | {"model_type"},
+)
 def build_model(**ctx) -> dict:
     """
     通用建模 action：
@@ -320,7 +364,7 @@ def build_model(**ctx) -> dict:
 
 # ── 模型类型判断 ────────────────────────────────────────────────────────────
 
-@register("determine_model_type")
+@register("determine_model_type", reads={"Mwx_0"}, writes={"model_type"})
 def determine_model_type(**ctx) -> dict:
     mwx0 = ctx.get("Mwx_0")
     if isinstance(mwx0, list):
@@ -337,7 +381,7 @@ def determine_model_type(**ctx) -> dict:
     return {"model_type": "unknown"}
 
 
-@register("select_window_metric")
+@register("select_window_metric", reads=(), writes={"{metric_name}"})
 def select_window_metric(metric_name: str = "", values: Any = None, **ctx) -> dict:
     if not metric_name:
         return {}
@@ -356,7 +400,7 @@ def select_window_metric(metric_name: str = "", values: Any = None, **ctx) -> di
 
 # ── 计数器（用于并行路径的累计计数）────────────────────────────────────────
 
-@register("increment_counter")
+@register("increment_counter", reads={"{counter_name}"}, writes={"{counter_name}"})
 def increment_counter(
     counter_name: str = "normal_count",
     increment: Any = 1,
@@ -372,6 +416,6 @@ def increment_counter(
 # ── 通用透传（未知 action 的兜底）────────────────────────────────────────────
 # 如果规则文件里出现新的 action 名，可在此注册通用 passthrough 避免警告
 
-@register("passthrough")
+@register("passthrough", reads=(), writes=())
 def passthrough(**ctx) -> dict:
     return {}
@@ -417,6 +417,14 @@ def _evaluate_boolean_expr(
     return evaluate_condition_text(text_expr, context, fallback_metric_id)[0]
 
 
+def split_top_level_and(condition: str) -> List[str]:
+    """把条件按顶层 AND 拆成子句（去外层括号）；无顶层 AND 时返回整句，空条件返回 []。"""
+    expr = normalize_condition_text(condition)
+    if not expr:
+        return []
+    return _split_top_level_boolean(_strip_outer_parentheses(expr), "AND")
+
+
 def explain_top_level_and_parts(
     condition: str,
     context: Dict[str, Any],
@@ -425,11 +433,9 @@ def explain_top_level_and_parts(
     将顶层 AND 拆成子句并分别求值，供场景触发排障日志使用。
     若无法拆分（无顶层 AND），则整句求值一次。
     """
-    expr = normalize_condition_text(condition)
-    if not expr:
+    parts = split_top_level_and(condition)
+    if not parts:
         return []
-    text_expr = _strip_outer_parentheses(expr)
-    parts = _split_top_level_boolean(text_expr, "AND")
     if len(parts) <= 1:
         return [(condition, evaluate_boolean_condition_text(condition, context))]
     out: List[Tuple[str, bool]] = []
@@ -14,21 +14,28 @@
 当前按 pipeline 配置中的 diagnosis_scenes.trigger_condition 动态匹配诊断场景。
 """
 import logging
-import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, Any, Optional, List, Tuple
 
 from app.utils import detail_trace
+from app.utils.env_settings import env_int
 from app.engine.rule_loader import RuleLoader
-from app.engine.metric_fetcher import MetricFetcher, DEFAULT_FALLBACK_WINDOW_DAYS
+from app.engine.metric_fetcher import (
+    MetricFetcher,
+    DEFAULT_FALLBACK_WINDOW_DAYS,
+)
+from app.engine.lazy_metrics import LAZY_METRIC_RESOLUTION, LazyMetricResolver
 from app.engine.actions import call_action
+from app.engine.scene_dispatch import ScenePlan, candidate_db_metric_ids, dispatch_candidates
+from app.engine.step_plan import BranchPlan, compile_branch_plans
+from app.engine.subtree_effects import merge_overlays, overlay_writes
+from app.engine.threshold_index import ThresholdEntry, format_branch_display
 from app.engine.condition_evaluator import (
     evaluate_boolean_condition_definition,
     evaluate_boolean_condition_text,
-    evaluate_condition_definition,
     evaluate_condition_text,
     explain_top_level_and_parts,
-    parse_condition_signature,
 )
 
 logger = logging.getLogger(__name__)
@@ -39,6 +46,10 @@ BRANCH_OUTCOME_MATCHED_ELSE = "matched_else"
 BRANCH_OUTCOME_NO_MATCH_NO_ELSE = "no_match_no_else"
 BRANCH_OUTCOME_CONFLICT_NO_ELSE = "conflict_no_else"
 
+# 多目标分支（next.target 为列表）中无数据冒险的子分支并发执行的线程上限；1 = 全部串行（排障用）
+# （分批见 app.engine.subtree_effects）
+SUBTREE_PARALLEL_MAX_WORKERS = env_int("SUBTREE_PARALLEL_MAX_WORKERS", 4, minimum=1)
+
 
 class DiagnosisResult:
     """诊断结果数据类"""
@@ -86,13 +97,20 @@ class DiagnosisEngine:
         self,
         time_window_days: int = DEFAULT_FALLBACK_WINDOW_DAYS,
         pipeline_id: str = "reject_errors",
+        lazy_metrics: Optional[bool] = None,
+        subtree_max_workers: Optional[int] = None,
     ):
         """
         Args:
             time_window_days: 指标未配置 duration 时的回退窗口（天），默认 7
+            lazy_metrics: 按需取数（见 app.engine.lazy_metrics）；None 时取 LAZY_METRIC_RESOLUTION
+            subtree_max_workers: 多目标子分支并发线程上限（见 app.engine.subtree_effects）；
+                None 时取 SUBTREE_PARALLEL_MAX_WORKERS，1 为串行
         """
         self.time_window_days = time_window_days
         self.pipeline_id = pipeline_id
+        self.lazy_metrics = LAZY_METRIC_RESOLUTION if lazy_metrics is None else bool(lazy_metrics)
+        self.subtree_max_workers = max(1, int(subtree_max_workers or SUBTREE_PARALLEL_MAX_WORKERS))
         self.rule_loader = RuleLoader(pipeline_id=pipeline_id)
         # 最近一次诊断用到的 MetricFetcher 实例，service 层读取 source_log 用
         self._last_fetcher: Optional[MetricFetcher] = None
@@ -178,36 +196,57 @@ class DiagnosisEngine:
             detail_trace.preview(metric_ids, 400),
         )
 
-        # 优先从源记录直接取值（Tx, Ty, Rw）
-        with detail_trace.span(
-            "diagnosis_resolve_metrics",
-            scene_id=scene.get("id"),
-            metric_count=len(metric_ids),
-        ):
-            metric_values = fetcher.fetch_from_source_record(source_record, metric_ids)
+        resolver: Optional[LazyMetricResolver] = None
+        if self.lazy_metrics:
+            # 按需取数：走到哪个 step 才取该 step 的指标，后继 step 的指标后台预取
+            resolver = LazyMetricResolver(
+                fetcher, source_record, self.rule_loader, scene_metric_ids=metric_ids
+            )
+            metric_values: Dict[str, Any] = {}
+        else:
+            # 优先从源记录直接取值（Tx, Ty, Rw）
+            with detail_trace.span(
+                "diagnosis_resolve_metrics",
+                scene_id=scene.get("id"),
+                metric_count=len(metric_ids),
+            ):
+                metric_values = fetcher.fetch_from_source_record(source_record, metric_ids)
 
-        non_null = sum(1 for v in metric_values.values() if v is not None)
-        detail_trace.info(
-            "指标解析汇总 | 非空=%s/总计=%s | source_log=%s",
-            non_null,
-            len(metric_values),
-            detail_trace.preview(fetcher.source_log, 500),
-        )
-        logger.info("获取到 %d/%d 个指标值", non_null, len(metric_ids))
+            non_null = sum(1 for v in metric_values.values() if v is not None)
+            detail_trace.info(
+                "指标解析汇总 | 非空=%s/总计=%s | source_log=%s",
+                non_null,
+                len(metric_values),
+                detail_trace.preview(fetcher.source_log, 500),
+            )
+            logger.info("获取到 %d/%d 个指标值", non_null, len(metric_ids))
 
         # 3. 遍历决策树
         start_node = str(scene.get("start_node", "1"))
-        with detail_trace.span("diagnosis_walk_tree", start_node=start_node):
-            root_cause, system, trace, abnormal_metrics, final_context = self._walk_tree(
-                start_node,
-                metric_values,
-                base_context={
-                    "equipment": source_record.get("equipment"),
-                    "chuck_id": source_record.get("chuck_id"),
-                    "lot_id": source_record.get("lot_id"),
-                    "wafer_index": source_record.get("wafer_index"),
-                    "reference_time": ref,
-                },
+        try:
+            with detail_trace.span("diagnosis_walk_tree", start_node=start_node):
+                root_cause, system, trace, abnormal_metrics, final_context = self._walk_tree(
+                    start_node,
+                    metric_values,
+                    base_context={
+                        "equipment": source_record.get("equipment"),
+                        "chuck_id": source_record.get("chuck_id"),
+                        "lot_id": source_record.get("lot_id"),
+                        "wafer_index": source_record.get("wafer_index"),
+                        "reference_time": ref,
+                    },
+                    resolver=resolver,
+                )
+        finally:
+            if resolver is not None:
+                resolver.close()
+        if resolver is not None:
+            resolver.merge_ready(final_context)
+            logger.info(
+                "按需取数: 路径上取数 %d 个，后台预取 %d 个，场景可达共 %d 个",
+                len(resolver.fetched_ids),
+                len(resolver.prefetched_ids),
+                len(metric_ids),
             )
 
         result.root_cause = root_cause
@@ -230,7 +269,7 @@ class DiagnosisEngine:
 
         # 4. 构建 metrics 列表（每个涉及的指标及其状态）
         with detail_trace.span("diagnosis_build_metrics_list"):
-            result.metrics = self._build_metrics_list(metric_ids, final_context)
+            result.metrics = self._build_metrics_list(metric_ids, final_context, fetcher.source_log)
 
         # 5. 构建 errorField（触发异常判断的指标）
         error_fields = [m["name"] for m in result.metrics if m["status"] == "ABNORMAL"]
@@ -248,85 +287,123 @@ class DiagnosisEngine:
         source_record: Dict[str, Any],
         fetcher: MetricFetcher,
     ) -> Optional[Dict[str, Any]]:
-        """按 diagnosis_scenes.trigger_condition 顺序返回首个匹配场景。"""
-        scene_index = 0
-        for scene in self.rule_loader.diagnosis_scenes:
-            scene_index += 1
-            trigger_metric_ids = scene.get("metric_id") or []
-            if isinstance(trigger_metric_ids, str):
-                trigger_metric_ids = [trigger_metric_ids]
-            if scene.get("default") and not trigger_metric_ids and not scene.get("trigger_condition"):
-                return scene
+        """
+        按 diagnosis_scenes.trigger_condition 顺序返回首个匹配场景。
+
+        先用 pipeline 编译的 SceneDispatch 以源表字段 / 请求参数（不查库）排除不可能命中的场景，
+        只为剩余场景一次性取查库触发指标（fetch_all 内并发），再按声明顺序逐个求值。
+        """
+        dispatch = self.rule_loader.get_scene_dispatch()
+        free_values: Dict[str, Any] = {}
+        if dispatch.free_metric_ids:
+            free_values = fetcher.fetch_from_source_record(source_record, list(dispatch.free_metric_ids))
+        candidates, excluded = dispatch_candidates(dispatch, free_values)
+        if excluded:
             detail_trace.info(
-                "select_scene 尝试场景 | idx=%s/%s | scene_id=%s | phenomenon=%s | trigger_metrics=%s",
-                scene_index,
-                len(self.rule_loader.diagnosis_scenes),
-                scene.get("id"),
-                detail_trace.preview(scene.get("phenomenon"), 80),
-                detail_trace.preview(trigger_metric_ids, 400),
+                "select_scene 免费谓词排除 | reject_reason(源表)=%s | excluded=%s | candidates=%s",
+                source_record.get("reject_reason"),
+                detail_trace.preview([plan.scene.get("id") for plan in excluded], 400),
+                detail_trace.preview([plan.scene.get("id") for plan in candidates], 400),
             )
-            trigger_values = fetcher.fetch_from_source_record(source_record, trigger_metric_ids)
+
+        trigger_values_all = dict(free_values)
+        db_metric_ids = candidate_db_metric_ids(candidates)
+        if db_metric_ids:
+            # 候选场景的触发指标合并为一批（含免费指标，供 linking 依赖使用）
+            batch_ids: List[str] = []
+            for plan in candidates:
+                for mid in plan.trigger_metric_ids:
+                    if mid not in batch_ids:
+                        batch_ids.append(mid)
+            trigger_values_all.update(fetcher.fetch_from_source_record(source_record, batch_ids))
+
+        scene_count = len(dispatch.plans)
+        candidate_keys = {id(plan) for plan in candidates}
+        for scene_index, plan in enumerate(dispatch.plans, 1):
+            if id(plan) not in candidate_keys:
+                continue
+            if plan.catch_all:
+                return plan.scene
+            trigger_values = {mid: trigger_values_all.get(mid) for mid in plan.trigger_metric_ids}
+            if self._scene_triggers_match(plan, trigger_values, source_record, fetcher, scene_index, scene_count):
+                return plan.scene
+        detail_trace.info(
+            "select_scene 未命中 | 已检查场景数=%s | 免费谓词排除=%s | reject_reason=%s",
+            scene_count,
+            len(excluded),
+            source_record.get("reject_reason"),
+        )
+        return None
+
+    def _scene_triggers_match(
+        self,
+        plan: ScenePlan,
+        trigger_values: Dict[str, Any],
+        source_record: Dict[str, Any],
+        fetcher: MetricFetcher,
+        scene_index: int,
+        scene_count: int,
+    ) -> bool:
+        """对单个候选场景做完整的 trigger_condition 求值（触发指标已取好）。"""
+        scene = plan.scene
+        detail_trace.info(
+            "select_scene 尝试场景 | idx=%s/%s | scene_id=%s | phenomenon=%s | trigger_metrics=%s",
+            scene_index,
+            scene_count,
+            scene.get("id"),
+            detail_trace.preview(scene.get("phenomenon"), 80),
+            detail_trace.preview(list(plan.trigger_metric_ids), 400),
+        )
+        detail_trace.info(
+            "select_scene 触发指标取值 | scene_id=%s | reject_reason(源表)=%s | values=%s",
+            scene.get("id"),
+            source_record.get("reject_reason"),
+            detail_trace.preview(trigger_values, 800),
+        )
+        for mid in plan.trigger_metric_ids:
+            v = trigger_values.get(mid)
             detail_trace.info(
-                "select_scene 触发指标取值 | scene_id=%s | reject_reason(源表)=%s | values=%s",
+                "select_scene 单指标 | scene_id=%s | metric_id=%s | type=%s | preview=%s | source_log=%s",
                 scene.get("id"),
-                source_record.get("reject_reason"),
-                detail_trace.preview(trigger_values, 800),
+                mid,
+                type(v).__name__,
+                detail_trace.preview(v, 200),
+                fetcher.source_log.get(mid, "?"),
             )
-            for mid in trigger_metric_ids:
-                v = trigger_values.get(mid)
+
+        if not plan.conditions:
+            return bool(plan.trigger_metric_ids) and all(trigger_values.get(mid) for mid in plan.trigger_metric_ids)
+
+        for condition in plan.conditions:
+            parts = explain_top_level_and_parts(condition, trigger_values) if isinstance(condition, str) else []
+            for sub_expr, sub_ok in parts:
                 detail_trace.info(
-                    "select_scene 单指标 | scene_id=%s | metric_id=%s | type=%s | preview=%s | source_log=%s",
+                    "select_scene 子条件 | scene_id=%s | ok=%s | expr=%s",
                     scene.get("id"),
-                    mid,
-                    type(v).__name__,
-                    detail_trace.preview(v, 200),
-                    fetcher.source_log.get(mid, "?"),
+                    sub_ok,
+                    detail_trace.preview(sub_expr, 220),
                 )
-
-            trigger_conditions = scene.get("trigger_condition") or []
-            if isinstance(trigger_conditions, str):
-                trigger_conditions = [trigger_conditions]
-
-            if not trigger_conditions:
-                if trigger_metric_ids and all(trigger_values.get(mid) for mid in trigger_metric_ids):
-                    return scene
-                continue
-
-            for condition in trigger_conditions:
-                parts = explain_top_level_and_parts(condition, trigger_values)
-                for sub_expr, sub_ok in parts:
-                    detail_trace.info(
-                        "select_scene 子条件 | scene_id=%s | ok=%s | expr=%s",
-                        scene.get("id"),
-                        sub_ok,
-                        detail_trace.preview(sub_expr, 220),
-                    )
-                matched = evaluate_boolean_condition_definition(condition, trigger_values)
-                if matched:
-                    logger.info(
-                        "匹配场景 scene=%s trigger_condition=%s values=%s",
-                        scene.get("id"),
-                        condition,
-                        trigger_values,
-                    )
-                    detail_trace.info(
-                        "select_scene 命中 | scene_id=%s | trigger预览=%s | trigger_values=%s",
-                        scene.get("id"),
-                        detail_trace.preview(condition, 160),
-                        detail_trace.preview(trigger_values, 400),
-                    )
-                    return scene
-                detail_trace.warning(
-                    "select_scene 本条件未满足 | scene_id=%s | expr=%s",
+            matched = evaluate_boolean_condition_definition(condition, trigger_values)
+            if matched:
+                logger.info(
+                    "匹配场景 scene=%s trigger_condition=%s values=%s",
                     scene.get("id"),
-                    detail_trace.preview(condition, 300),
+                    condition,
+                    trigger_values,
                 )
-        detail_trace.info(
-            "select_scene 未命中 | 已检查场景数=%s | reject_reason=%s",
-            len(self.rule_loader.diagnosis_scenes),
-            source_record.get("reject_reason"),
-        )
-        return None
+                detail_trace.info(
+                    "select_scene 命中 | scene_id=%s | trigger预览=%s | trigger_values=%s",
+                    scene.get("id"),
+                    detail_trace.preview(condition, 160),
+                    detail_trace.preview(trigger_values, 400),
+                )
+                return True
+            detail_trace.warning(
+                "select_scene 本条件未满足 | scene_id=%s | expr=%s",
+                scene.get("id"),
+                detail_trace.preview(condition, 300),
+            )
+        return False
 
     # ── 决策树遍历 ──────────────────────────────────────────────────────────
 
@@ -335,6 +412,7 @@ class DiagnosisEngine:
         start_node: str,
         metric_values: Dict[str, Optional[float]],
         base_context: Optional[Dict[str, Any]] = None,
+        resolver: Optional[LazyMetricResolver] = None,
     ) -> Tuple[Optional[str], Optional[str], List[str], List[str], Dict[str, Any]]:
         """
         遍历 pipeline 的 steps 决策树
@@ -349,7 +427,7 @@ class DiagnosisEngine:
         # context = 源记录上下文 + metric_values + actions/branch-set 动态追加变量
         context: Dict[str, Any] = dict(base_context or {})
         context.update(metric_values)
-        return self._walk_subtree(start_node, context, [], [], max_steps=50)
+        return self._walk_subtree(start_node, context, [], [], max_steps=50, resolver=resolver)
 
     def _walk_subtree(
         self,
@@ -358,8 +436,13 @@ class DiagnosisEngine:
         trace: List[str],
         abnormal_metrics: List[str],
         max_steps: int = 50,
+        resolver: Optional[LazyMetricResolver] = None,
     ) -> Tuple[Optional[str], Optional[str], List[str], List[str], Dict[str, Any]]:
-        """执行单条子路径；若 target 为列表，则按独立分支顺序依次执行并共享 context。"""
+        """
+        执行单条子路径；若 target 为列表，则交给 _walk_children 执行全部子分支（无数据冒险的并发）。
+
+        resolver 非空（按需取数）时，进入每个 step 先解析该 step 引用的指标并预取后继 step 的指标。
+        """
         current_node = start_node
         completed_iterations = 0
 
@@ -378,6 +461,9 @@ class DiagnosisEngine:
                 desc_snip,
             )
 
+            if resolver is not None:
+                resolver.enter_step(step, context)
+
             # 执行 details 中的 action 函数（顺序串行），更新 context
             context = self._execute_details(step, context)
 
@@ -402,9 +488,10 @@ class DiagnosisEngine:
                     return ("需要人工处理", None, trace, abnormal_metrics, context)
                 break
 
-            # 评估分支条件，返回 (next_node, chosen_branch)
+            # 评估分支条件（pipeline 加载时预编译的 StepPlan），返回 (next_node, chosen_branch)
+            step_plan = self.rule_loader.get_step_plan(step)
             next_node, chosen_branch, branch_outcome = self._evaluate_branches(
-                step, next_branches, context, abnormal_metrics
+                step, next_branches, context, abnormal_metrics, step_plan.branches
             )
 
             if next_node is None:
@@ -430,14 +517,10 @@ class DiagnosisEngine:
             if isinstance(next_node, list):
                 logger.info("多目标节点 %s → 执行全部子分支并汇总结果", next_node)
                 chosen_result = None
-                for child in next_node:
-                    root_cause, system, child_trace, child_abnormal_metrics, context = self._walk_subtree(
-                        str(child),
-                        context,
-                        [],
-                        [],
-                        max_steps=max_steps,
-                    )
+                outcomes = self._walk_children(
+                    [str(child) for child in next_node], context, max_steps=max_steps, resolver=resolver
+                )
+                for root_cause, system, child_trace, child_abnormal_metrics in outcomes:
                     trace.extend(child_trace)
                     for metric_name in child_abnormal_metrics:
                         if metric_name not in abnormal_metrics:
@@ -466,6 +549,65 @@ class DiagnosisEngine:
             )
         return (None, None, trace, abnormal_metrics, context)
 
+    def _walk_children(
+        self,
+        children: List[str],
+        context: Dict[str, Any],
+        max_steps: int = 50,
+        resolver: Optional[LazyMetricResolver] = None,
+    ) -> List[Tuple[Optional[str], Optional[str], List[str], List[str]]]:
+        """
+        执行多目标节点的全部子分支，按声明顺序返回各自的 (root_cause, system, trace, abnormal_metrics)。
+
+        按子树读写集（RuleLoader.get_subtree_index）分批：同批子分支互不读写对方的 context 键，
+        各自在 context 副本上并发执行；批次之间串行，每批结束按声明顺序把写入合并回 context
+        （in-place），全部结束后再按声明顺序整体合并一次，context 终值与串行执行一致。
+        """
+        stages = self.rule_loader.get_subtree_index().schedule(children)
+        pool_size = min(self.subtree_max_workers, max((len(stage) for stage in stages), default=0))
+        if pool_size <= 1:
+            # 全部冲突（或并发关闭）：与原实现一致，串行共享 context
+            outcomes = []
+            for child in children:
+                root_cause, system, child_trace, child_abnormal_metrics, context = self._walk_subtree(
+                    child, context, [], [], max_steps=max_steps, resolver=resolver
+                )
+                outcomes.append((root_cause, system, child_trace, child_abnormal_metrics))
+            return outcomes
+
+        detail_trace.info(
+            "多目标子分支并发 | children=%s | stages=%s",
+            children,
+            [[children[index] for index in stage] for stage in stages],
+        )
+        outcomes_by_index: Dict[int, Tuple[Optional[str], Optional[str], List[str], List[str]]] = {}
+        overlays: List[Tuple[int, Dict[str, Any]]] = []
+        with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="subtree") as executor:
+            for stage in stages:
+                base = dict(context)
+                futures = {
+                    index: executor.submit(
+                        self._walk_subtree,
+                        children[index],
+                        dict(base),
+                        [],
+                        [],
+                        max_steps=max_steps,
+                        resolver=resolver,
+                    )
+                    for index in stage
+                }
+                stage_overlays = []
+                for index in stage:
+                    root_cause, system, child_trace, child_abnormal_metrics, child_context = futures[index].result()
+                    outcomes_by_index[index] = (root_cause, system, child_trace, child_abnormal_metrics)
+                    stage_overlays.append((index, overlay_writes(base, child_context)))
+                merge_overlays(context, stage_overlays)
+                overlays.extend(stage_overlays)
+        if len(stages) > 1:
+            merge_overlays(context, overlays)
+        return [outcomes_by_index[index] for index in range(len(children))]
+
     def _execute_details(
         self,
         step: Dict[str, Any],
@@ -537,27 +679,13 @@ class DiagnosisEngine:
             )
         return outputs
 
-    @staticmethod
-    def _extract_condition_var(condition: Any) -> Optional[str]:
-        """从 condition 字符串提取 {var_name} 中的变量名。
-
-        例: '-2<{mean_Tx}<2' → 'mean_Tx'
-             '{Mwx_0} > 1.0' → 'Mwx_0'
-        """
-        if isinstance(condition, dict):
-            compare = condition.get("compare")
-            if isinstance(compare, dict) and compare.get("left"):
-                return str(compare.get("left"))
-            return None
-        m = re.search(r"\{([^}]+)\}", str(condition))
-        return m.group(1).strip() if m else None
-
     def _evaluate_branches(
         self,
         step: Dict[str, Any],
         branches: List[Dict[str, Any]],
         context: Dict[str, Any],
         abnormal_metrics: List[str],
+        branch_plans: Optional[Tuple[BranchPlan, ...]] = None,
     ) -> Tuple[Optional[Any], Optional[Dict], str]:
         """
         评估步骤的分支条件，返回 (next_node_id, chosen_branch, outcome)。
@@ -572,54 +700,47 @@ class DiagnosisEngine:
             branches:         分支列表
             context:          当前执行上下文
             abnormal_metrics: 异常指标列表（会被修改）
+            branch_plans:     branches 的预编译形式（StepPlan.branches）；缺省时现场编译
 
         Returns:
             (next_node_id, chosen_branch_dict, outcome)；outcome 见模块常量 BRANCH_OUTCOME_*。
         """
-        metric_id = step.get("metric_id")
+        if branch_plans is None:
+            branch_plans = compile_branch_plans(step.get("metric_id"), branches)
         else_branch = None
         else_branch_obj = None
         matched_branches: List[Tuple[Any, Dict[str, Any], Optional[str], str, Any, Any]] = []
 
-        for branch in branches:
-            condition = branch.get("condition")
-            target = branch.get("target")
-
-            # else / 无条件回退：与 rule_validator 约定一致（仅 condition，不用 operator/limit）
-            if condition == "else" or condition is None or (
-                isinstance(condition, str) and not str(condition).strip()
-            ):
-                else_branch = target
-                else_branch_obj = branch
+        for plan in branch_plans:
+            if plan.evaluate is None:
+                else_branch = plan.target
+                else_branch_obj = plan.branch
                 continue
 
-            matched, parsed_var, parsed_operator, parsed_limit, parsed_value = evaluate_condition_definition(
-                condition, context, metric_id
-            )
-            var_name = self._extract_condition_var(condition) or metric_id
+            matched, parsed_var, parsed_operator, parsed_limit, parsed_value = plan.evaluate(context)
+            if not matched:
+                continue
+            var_name = parsed_var or plan.var_name
             operator = ""
             limit: Any = None
-            value = context.get(var_name) if var_name else None
-            if parsed_var:
-                var_name = parsed_var
             if parsed_operator:
                 operator = parsed_operator
                 limit = parsed_limit
-            if parsed_value is not None:
-                value = parsed_value
+            value = parsed_value
+            if value is None and plan.var_name:
+                value = context.get(plan.var_name)
 
-            if matched:
-                detail_trace.info(
-                    "分支命中候选 | step=%s | target=%s | condition=%s | var=%s | operator=%s | limit=%s | value=%s",
-                    step.get("id"),
-                    target,
-                    detail_trace.preview(condition, 180),
-                    var_name,
-                    operator,
-                    limit,
-                    detail_trace.preview(value, 120),
-                )
-                matched_branches.append((target, branch, var_name, operator, limit, value))
+            detail_trace.info(
+                "分支命中候选 | step=%s | target=%s | condition=%s | var=%s | operator=%s | limit=%s | value=%s",
+                step.get("id"),
+                plan.target,
+                detail_trace.preview(plan.condition, 180),
+                var_name,
+                operator,
+                limit,
+                detail_trace.preview(value, 120),
+            )
+            matched_branches.append((plan.target, plan.branch, var_name, operator, limit, value))
 
         # next 分支是独立条件：应只命中 1 条
         if len(matched_branches) == 1:
@@ -699,6 +820,7 @@ class DiagnosisEngine:
         self,
         metric_ids: List[str],
         metric_values: Dict[str, Optional[float]],
+        source_log: Optional[Dict[str, str]] = None,
     ) -> List[Dict[str, Any]]:
         """
         构建接口3返回的 metrics 数组
@@ -713,6 +835,8 @@ class DiagnosisEngine:
         Args:
             metric_ids: 指标 ID 列表
             metric_values: 指标实际值
+            source_log: 本次取数的来源记录（MetricFetcher.source_log）；查库指标的 approximate
+                按实际读取结果标记（抽样回退成精确读取时不再标记）
 
         Returns:
             [{name, value, unit, status, threshold: {operator, limit}}]
@@ -732,8 +856,9 @@ class DiagnosisEngine:
 
             unit = meta.get("unit", "") or ""
 
-            # 查找阈值（从 pipeline steps 中找）
-            threshold_info = self._find_threshold(mid)
+            # 查找阈值（pipeline 加载时按 steps 预解析的阈值索引）
+            threshold_entry = self.rule_loader.get_threshold_entry(mid)
+            threshold_info = threshold_entry.info if threshold_entry is not None else None
 
             # 有阈值 → 诊断指标；无阈值 → 建模输入参数
             metric_type = "diagnostic" if threshold_info else "model_param"
@@ -747,8 +872,8 @@ class DiagnosisEngine:
                     status = "ABNORMAL"
 
             effective_threshold = dict(threshold_info) if threshold_info else {"operator": "-", "limit": 0}
-            if threshold_info:
-                effective_threshold["display"] = self._select_matched_threshold_display(value, threshold_info, mid)
+            if threshold_entry is not None:
+                effective_threshold["display"] = self._entry_threshold_display(threshold_entry, value)
 
             metrics.append({
                 "name": mid,
@@ -756,7 +881,7 @@ class DiagnosisEngine:
                 "unit": unit,
                 "status": status,
                 "type": metric_type,
-                "approximate": bool(meta.get("approximate")),
+                "approximate": self._metric_approximate(mid, meta, source_log),
                 "threshold": effective_threshold,
             })
 
@@ -770,175 +895,64 @@ class DiagnosisEngine:
 
         return metrics
 
-    def _build_alias_map(self) -> Dict[str, str]:
-        """
-        从 metrics 元数据反查 alias 映射:metric.alias_of 字段声明 alias。
-        
-        历史:之前是硬编码 _METRIC_ALIAS_MAP = {output_Tx: Tx, ...},
-        加新别名必须改 Python。post-stage4 Bug #3 fix 改为配置驱动:
-        
-            "output_Tx": {
-              "source_kind": "intermediate",
-              "alias_of": "Tx",     <- 这里声明
-              "approximate": true
-            }
-        
-        Returns:
-            { alias_metric_id: target_metric_id } 字典
-        """
-        alias_map: Dict[str, str] = {}
-        metrics = getattr(self.rule_loader, "metrics", None) or {}
-        for mid, meta in metrics.items():
-            if not isinstance(meta, dict):
-                continue
-            alias = meta.get("alias_of")
-            if alias:
-                alias_map[str(mid)] = str(alias).strip()
-        return alias_map
+    @staticmethod
+    def _metric_approximate(
+        metric_id: str,
+        meta: Dict[str, Any],
+        source_log: Optional[Dict[str, str]],
+    ) -> bool:
+        """查库指标看本次取数是否真的近似；中间量等非查库指标沿用 meta.approximate 展示标记。"""
+        if MetricFetcher._db_source_kind(meta) in {"mysql_nearest_row", "clickhouse_window"}:
+            # 来源带 :memo / :cache 后缀时同样按 approx 标记判断
+            return "approx" in (source_log or {}).get(metric_id, "").split(":")
+        return bool(meta.get("approximate"))
 
     def _find_threshold(self, metric_id: str) -> Optional[Dict[str, Any]]:
         """
-        从 pipeline steps 中查找指标的阈值条件
+        取指标的展示阈值（pipeline 加载时由 app.engine.threshold_index 预解析）。
 
         查找优先级：
-        1. 优先返回 between 条件（正常范围，如 -20 < Tx < 20）
-        2. 其次返回第一个有 operator+limit 的分支（如 n_88um ≤ 8）
+        1. 多个合法区间/边界共同组成正常条件 → any_of
+        2. 单独 between 条件（正常范围，如 -20 < Tx < 20）
+        3. 第一个有 operator+limit 的分支（如 n_88um ≤ 8）
 
-        对于 output_Tx/Ty/Rw/Mw 等别名,通过 metric 配置的 alias_of 字段
-        映射到 pipeline 中的原始名(post-stage4 Bug #3 fix:从硬编码改为配置驱动)。
+        output_Tx/Ty/Rw 等别名通过 metric 配置的 alias_of 字段映射到 pipeline 中的原始名。
 
         Args:
             metric_id: 指标 ID
 
         Returns:
-            {"operator": str, "limit": float/list} 或 None
+            {"operator": str, "limit": float/list, "display": str} 或 None（只读，勿原地修改）
         """
-        # 别名映射:metric.alias_of 字段反查;新增别名只需在 metrics 里加 alias_of
-        alias_map = self._build_alias_map()
-        lookup_id = alias_map.get(metric_id, metric_id)
-
-        for step in self.rule_loader.steps:
-            step_metric_id = step.get("metric_id")
-            # 显式 "next": null 时 step.get("next", []) 仍返回 None，后续 for 崩溃；
-            # 用 `or []` 兜底，与 rule_validator 对 null/空数组等价的处理保持一致。
-            branches = step.get("next") or []
-            parsed_branches = []
-            for branch in branches:
-                condition = str(branch.get("condition", "")).strip()
-                if not condition or condition == "else":
-                    continue
-                signature = parse_condition_signature(condition)
-                if not signature:
-                    continue
-                sig_type = signature.get("type")
-                if sig_type == "range":
-                    parsed_branches.append(
-                        {
-                            "var": signature.get("var"),
-                            "operator": "between",
-                            "limit": signature.get("limit"),
-                            "condition": condition,
-                        }
-                    )
-                    continue
-                if sig_type == "comparison":
-                    rhs_var = signature.get("rhs_var")
-                    rhs_value = signature.get("rhs")
-                    if rhs_var is not None or rhs_value is None:
-                        continue
-                    parsed_branches.append(
-                        {
-                            "var": signature.get("var"),
-                            "operator": signature.get("operator"),
-                            "limit": rhs_value,
-                            "condition": condition,
-                        }
-                    )
-
-            branch_refs_lookup = any(str(item.get("var")) == lookup_id for item in parsed_branches)
-            if step_metric_id != lookup_id and not branch_refs_lookup:
-                continue
-
-            valid_branches = []
-            for branch in parsed_branches:
-                op = str(branch.get("operator", "")).strip()
-                limit = branch.get("limit")
-                condition = str(branch.get("condition", "")).strip()
-                branch_var = str(branch.get("var", "")).strip()
-                if branch_refs_lookup and branch_var != lookup_id:
-                    continue
-                if op and limit is not None:
-                    valid_branches.append(
-                        {
-                            "operator": op,
-                            "limit": limit,
-                            "condition": condition,
-                        }
-                    )
-
-            if not valid_branches:
-                continue
-
-            between_branches = [b for b in valid_branches if b.get("operator", "") == "between"]
-            comparison_branches = [
-                b for b in valid_branches if b.get("operator", "") in {">", "<", ">=", "<=", "==", "!="}
-            ]
-
-            # Mwx_0 这类“多个有效区间/边界共同组成正常条件”的步骤，不能错误折叠成单个 between。
-            if len(between_branches) > 1 or (between_branches and comparison_branches):
-                conditions = [
-                    {"operator": b.get("operator", ""), "limit": b.get("limit")}
-                    for b in valid_branches
-                ]
-                display = " or ".join(
-                    str(b.get("condition", "")).strip() for b in valid_branches if b.get("condition")
-                )
-                return {
-                    "operator": "any_of",
-                    "limit": conditions,
-                    "display": display,
-                    "branchDisplays": [
-                        str(b.get("condition", "")).strip() or None for b in valid_branches
-                    ],
-                }
-
-            # 次优：单独 between 分支（如 output_Mw between [-20, 20]）
-            for branch in valid_branches:
-                op = branch.get("operator", "")
-                limit = branch.get("limit")
-                if op == "between" and isinstance(limit, list):
-                    return {
-                        "operator": "between",
-                        "limit": limit,
-                        "display": str(branch.get("condition", "")).strip() or None,
-                    }
-
-            # 末选：第一个有 operator 的分支（≤、≥ 等，如 n_88um ≤ 8）
-            for branch in valid_branches:
-                op = branch.get("operator", "")
-                limit = branch.get("limit")
-                condition = branch.get("condition", "")
-                if op and limit is not None:
-                    return {
-                        "operator": op,
-                        "limit": limit,
-                        "display": str(condition).strip() or None,
-                    }
-
-        return None
-
-    @staticmethod
-    def _format_threshold_branch_display(
-        metric_name: str,
-        operator: str,
-        limit: Any,
+        entry = self.rule_loader.get_threshold_entry(metric_id)
+        return entry.info if entry is not None else None
+
+    def _entry_threshold_display(self, entry: ThresholdEntry, value: Any) -> Optional[str]:
+        """按预解析的 any_of 分支挑选命中分支的展示文本（口径同 _select_matched_threshold_display）。"""
+        if entry.branches and value is not None:
+            for operator, limit, display in entry.branches:
+                if self._is_within_normal_range(value, operator, limit):
+                    return display
+        return entry.info.get("display")
+
+    def select_cached_threshold_display(
+        self,
+        value: Any,
+        threshold: Dict[str, Any],
+        metric_name: str = "",
     ) -> Optional[str]:
-        metric_expr = f"{{{metric_name}}}" if metric_name else "{value}"
-        if operator == "between" and isinstance(limit, list) and len(limit) == 2:
-            return f"{limit[0]} < {metric_expr} < {limit[1]}"
-        if operator in {">", "<", ">=", "<=", "==", "!="} and limit is not None:
-            return f"{metric_expr} {operator} {limit}"
-        return None
+        """
+        缓存行（rejected_detailed_records.metrics_data）的阈值展示文本。
+
+        非 any_of 直接用缓存里的 display；any_of 阈值与当前配置一致时用阈值索引里
+        预解析的分支展示，配置已变更或旧缓存形态对不上时现场挑选。
+        """
+        if threshold.get("operator") != "any_of" or value is None:
+            return threshold.get("display")
+        entry = self.rule_loader.get_threshold_entry(metric_name) if metric_name else None
+        if entry is not None and entry.matches(threshold):
+            return self._entry_threshold_display(entry, value)
+        return self._select_matched_threshold_display(value, threshold, metric_name)
 
     def _select_matched_threshold_display(
         self,
@@ -975,7 +989,7 @@ class DiagnosisEngine:
                 branch_display = branch_displays[index] if index < len(branch_displays) else None
                 if branch_display:
                     return str(branch_display).strip() or display
-                return self._format_threshold_branch_display(metric_name, branch_operator, branch_limit) or display
+                return format_branch_display(metric_name, branch_operator, branch_limit) or display
 
         return display
 
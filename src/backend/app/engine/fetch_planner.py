@@ -0,0 +1,192 @@
+"""
+取数计划器：把同一层里「同源同表同窗口同 linking」的指标合并成一条多列查询。
+
+reject_errors 里 Msx/Msy/e_ws_x/e_ws_y 都读 src.RPT_WAA_SA_RESULT_OFL 且 exact_keys 完全相同，
+逐指标发 SELECT 会重复扫描同一批行。MetricFetcher 先为每个 DB 指标渲染出 FetchRequest
+（表、时间列、窗口、WHERE 片段与参数都已解析完毕），本模块按签名分组，
+MetricFetcher 再对每组只发一条 SELECT col_a, col_b, ... 并把行按列拆回各指标。
+"""
+import math
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+VALID_SELECTION_MODES = {"all", "nearest", "nearest_n", "aggregate"}
+VALID_SELECTION_AGGREGATES = {"avg", "min", "max", "count"}
+
+
+def freeze_value(value: Any) -> Any:
+    """把参数值转成可哈希形式（list/set/dict → tuple），用于分组签名与缓存键。"""
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), freeze_value(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_value(v) for v in value)
+    if isinstance(value, set):
+        return tuple(sorted((freeze_value(v) for v in value), key=repr))
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+@dataclass(frozen=True)
+class RowSelection:
+    """
+    指标的窗口取行策略（meta.selection）。
+
+    - `all`（默认）：窗口内全部行，按距 T 由近到远
+    - `nearest`：最近一行；`nearest_n:<N>`：最近 N 行
+    - `aggregate:avg|min|max|count`：窗口聚合成单值，结果为 `[value]`
+    """
+
+    mode: str = "all"
+    limit: Optional[int] = None
+    aggregate: Optional[str] = None
+
+    def apply(self, values: List[Any]) -> List[Any]:
+        """SQL 未下推时在 Python 侧对已归一的值列表执行同样的选择。"""
+        if self.limit is not None:
+            return values[: self.limit]
+        if self.aggregate == "count":
+            return [len(values)]
+        if self.aggregate:
+            numbers = []
+            for value in values:
+                try:
+                    number = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if not math.isnan(number):
+                    numbers.append(number)
+            if not numbers:
+                return []
+            if self.aggregate == "avg":
+                return [sum(numbers) / len(numbers)]
+            return [min(numbers) if self.aggregate == "min" else max(numbers)]
+        return values
+
+
+def parse_selection(raw: Any) -> RowSelection:
+    """解析 meta.selection；非法写法抛 ValueError（配置校验与取数共用）。"""
+    text = str(raw or "all").strip().lower()
+    mode, _, arg = text.partition(":")
+    mode, arg = mode.strip(), arg.strip()
+    if mode not in VALID_SELECTION_MODES:
+        raise ValueError(f"selection 仅支持 {sorted(VALID_SELECTION_MODES)}，实际: {raw!r}")
+    if mode == "all" and not arg:
+        return RowSelection()
+    if mode == "nearest" and not arg:
+        return RowSelection(mode="nearest", limit=1)
+    if mode == "nearest_n":
+        try:
+            limit = int(arg)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError(f"selection nearest_n 需写成 nearest_n:<正整数>，实际: {raw!r}")
+        return RowSelection(mode="nearest_n", limit=limit)
+    if mode == "aggregate" and arg in VALID_SELECTION_AGGREGATES:
+        return RowSelection(mode="aggregate", aggregate=arg)
+    raise ValueError(
+        f"selection 写法非法: {raw!r}（示例: nearest / nearest_n:5 / aggregate:avg）"
+    )
+
+
+@dataclass
+class FetchRequest:
+    """单个 DB 指标渲染完成、尚未执行的取数请求。"""
+
+    metric_id: str
+    meta: Dict[str, Any]
+    source: str  # "mysql" | "clickhouse"
+    table_name: str
+    column_name: str
+    time_column: str
+    equipment_column: str
+    time_start: datetime
+    time_end: datetime
+    # MySQL: 以 " AND ..." 开头的 SQL 片段；ClickHouse: WHERE 子句列表（tuple）
+    where: Any
+    params: Dict[str, Any] = field(default_factory=dict)
+    omit_equipment: bool = False
+    context: Dict[str, Any] = field(default_factory=dict)
+    selection: RowSelection = field(default_factory=RowSelection)
+    # 下推到 SQL 的部分：无 Python 侧提取时 LIMIT / 聚合由数据库完成
+    sql_limit: Optional[int] = None
+    sql_aggregate: Optional[str] = None
+    # ClickHouse 时间列类型声明（见 MetricPlan.time_column_type）
+    time_column_type: Optional[str] = None
+    # 存在性探测的正则（见 MetricPlan.probe_pattern）；非 None 时只查「是否有命中行」
+    probe_pattern: Optional[str] = None
+    # 下推到 SQL 的 regex 提取（见 MetricPlan.sql_extract_pattern）；非 None 时列值已是提取后的数值
+    extract_pattern: Optional[str] = None
+    # 窗口策略（见 MetricPlan.window_strategy）；progressive 请求只与同策略请求合并
+    window_strategy: str = "full"
+    # ClickHouse 近似取数（见 MetricPlan.approximate）：SAMPLE 比例（None = 不抽样）与读取行数上限
+    sample_ratio: Optional[float] = None
+    max_rows_to_read: Optional[int] = None
+    # ClickHouse 按块读取的行数 / 近似字节预算（见 MetricPlan.max_rows / max_bytes）；None 表示不限
+    max_rows: Optional[int] = None
+    max_bytes: Optional[int] = None
+    # 编译好的 MetricPlan（提取器、类型转换、cache_ttl 等在 finalize / 缓存阶段使用）
+    plan: Any = None
+
+    @property
+    def selection_pushed(self) -> bool:
+        return self.sql_limit is not None or self.sql_aggregate is not None
+
+    @property
+    def approximate(self) -> bool:
+        return self.sample_ratio is not None or self.max_rows_to_read is not None
+
+    @property
+    def where_key(self) -> Any:
+        return tuple(self.where) if isinstance(self.where, (list, tuple)) else self.where
+
+    @property
+    def _single_column(self) -> bool:
+        return self.sql_limit is not None or self.probe_pattern is not None or self.extract_pattern is not None
+
+    def group_key(self) -> Tuple[Any, ...]:
+        """同组 = 同源、同表、同时间列/设备列、同窗口、同 WHERE 与参数、同 SQL 取行策略。"""
+        return (
+            self.source,
+            self.table_name,
+            self.time_column,
+            self.time_column_type,
+            self.equipment_column,
+            self.omit_equipment,
+            self.time_start,
+            self.time_end,
+            self.where_key,
+            freeze_value(self.params),
+            self.sql_aggregate,
+            self.sql_limit,
+            self.probe_pattern,
+            self.extract_pattern,
+            self.window_strategy,
+            self.sample_ratio,
+            self.max_rows_to_read,
+            self.max_rows,
+            self.max_bytes,
+            # LIMIT 附带「该列非空」谓词、探测 / 提取下推附带「该列匹配」谓词，只能单列查询
+            self.column_name if self._single_column else None,
+        )
+
+
+def plan_fetch_groups(requests: List[FetchRequest]) -> List[List[FetchRequest]]:
+    """按 group_key 分组，组间与组内都保持输入顺序。"""
+    groups: Dict[Tuple[Any, ...], List[FetchRequest]] = {}
+    for request in requests:
+        groups.setdefault(request.group_key(), []).append(request)
+    return list(groups.values())
+
+
+def group_columns(requests: List[FetchRequest]) -> List[str]:
+    """组内需要 SELECT 的去重列（Sx/Sy 共读 data 列时只取一次）。"""
+    columns: List[str] = []
+    for request in requests:
+        if request.column_name not in columns:
+            columns.append(request.column_name)
+    return columns
@@ -0,0 +1,223 @@
+"""
+按需取数（LAZY_METRIC_RESOLUTION=1，opt-in）。
+
+默认模式下 diagnose 先用 RuleLoader.get_all_scene_metric_ids 收集场景可达的全部指标并一次取齐，
+没走到的分支（如 88um 建模收敛后的 8um 路径）同样付出完整的查库成本。
+按需模式下 LazyMetricResolver 在 _walk_subtree 进入每个 step 时只解析该 step 引用的指标
+（RuleLoader.get_step_metric_ids，连同 linking.source 依赖），同时在后台线程预取直接后继
+step 的指标，使取数耗时跟随实际走过的路径而非整棵子图。
+
+action 拿到的是整个 context，会读取 params 里没写的键（如 build_model 回退输出读 Tx/Ty/Rw）。
+因此 step 的需求集还包括各 action 注册时声明的 reads（actions.register）与每个 details 项的 params；
+有 action 未声明 reads 时读集未知，先取齐场景可达的全部指标再执行该 step，结果与默认模式一致。
+
+约定：
+  - 写回 context 用 setdefault：action 输出 / 分支 set 已写入的键不会被后取到的指标值覆盖，
+    与「先取齐再走树、action 覆盖指标值」的默认模式结果一致
+  - 同一指标只取一次：已在后台预取中的指标直接等待该批结果
+  - 未走到的分支若预取已完成，其值在走树结束后补进 context（详情页照常展示），
+    仍未取到的指标在详情里为 UNKNOWN
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.engine.actions import action_reads
+from app.engine.condition_evaluator import extract_vars_from_definition
+from app.engine.metric_fetcher import MetricFetcher
+from app.engine.rule_loader import RuleLoader
+from app.utils import detail_trace
+from app.utils.env_settings import env_int
+
+logger = logging.getLogger(__name__)
+
+# 按需取数（opt-in）：诊断走到哪个 step 才取该 step 引用的指标，并在后台预取直接后继 step 的指标；
+# 0 = 走树前一次取齐场景可达的全部指标
+LAZY_METRIC_RESOLUTION = env_int("LAZY_METRIC_RESOLUTION", 0) > 0
+LAZY_PREFETCH_MAX_WORKERS = env_int("LAZY_PREFETCH_MAX_WORKERS", 4, minimum=1)
+
+
+class LazyMetricResolver:
+    """单次诊断内的按需指标解析器（线程安全；由 DiagnosisEngine.diagnose 创建，诊断结束时 close）。"""
+
+    def __init__(
+        self,
+        fetcher: MetricFetcher,
+        source_record: Dict[str, Any],
+        rule_loader: RuleLoader,
+        max_workers: Optional[int] = None,
+        scene_metric_ids: Optional[Iterable[str]] = None,
+    ):
+        self.fetcher = fetcher
+        self.source_record = source_record
+        self.rule_loader = rule_loader
+        # 读集未知的 action 执行前要取齐的指标；未给出时取 pipeline 定义的全部指标
+        self.scene_metric_ids: List[str] = list(
+            rule_loader.metrics_meta if scene_metric_ids is None else scene_metric_ids
+        )
+        self.values: Dict[str, Any] = {}
+        self._resolved: set = set()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, int(max_workers or LAZY_PREFETCH_MAX_WORKERS)),
+            thread_name_prefix="metric-prefetch",
+        )
+        self.fetched_ids: List[str] = []
+        self.prefetched_ids: List[str] = []
+
+    # ── 依赖闭包与分批 ──────────────────────────────────────────────────────
+
+    def _with_deps(self, metric_ids: Iterable[str]) -> List[str]:
+        """metric_ids 加上 linking.source 传递依赖（被依赖的在前，便于日志阅读）。"""
+        ordered: List[str] = []
+        seen: set = set()
+
+        def visit(metric_id: str) -> None:
+            if metric_id in seen:
+                return
+            seen.add(metric_id)
+            for dep in self.fetcher._metric_linking_source_deps(metric_id):
+                visit(dep)
+            ordered.append(metric_id)
+
+        for metric_id in metric_ids:
+            visit(metric_id)
+        return ordered
+
+    def _claim(self, metric_ids: Iterable[str]) -> Tuple[List[str], List[Future], Future]:
+        """
+        登记一批待取指标：返回 (本批新取的 id, 需先等待的他批 Future, 本批 Future)。
+
+        只等待登记更早的批次，批次间的等待关系无环。
+        """
+        batch: Future = Future()
+        claimed: List[str] = []
+        waits: List[Future] = []
+        with self._lock:
+            for metric_id in self._with_deps(metric_ids):
+                if metric_id in self._resolved:
+                    continue
+                pending = self._pending.get(metric_id)
+                if pending is not None:
+                    if pending not in waits:
+                        waits.append(pending)
+                    continue
+                self._pending[metric_id] = batch
+                claimed.append(metric_id)
+        return claimed, waits, batch
+
+    def _run_batch(self, metric_ids: List[str], waits: List[Future], batch: Future) -> None:
+        try:
+            for future in waits:
+                future.result()
+            with self._lock:
+                known = dict(self.values)
+            values = self.fetcher.fetch_from_source_record(self.source_record, metric_ids, extra_context=known)
+        except BaseException as exc:
+            # fetch_all 对单指标失败已降级为 None；走到这里是批次级异常，按未取到处理
+            logger.warning("按需取数批次失败: metric_ids=%s error=%s", metric_ids, exc)
+            values = {}
+            for metric_id in metric_ids:
+                values.setdefault(metric_id, None)
+        with self._lock:
+            self.values.update(values)
+            for metric_id in metric_ids:
+                self._resolved.add(metric_id)
+                self._pending.pop(metric_id, None)
+        batch.set_result(None)
+
+    # ── 对外接口 ────────────────────────────────────────────────────────────
+
+    def resolve(self, metric_ids: Iterable[str]) -> Dict[str, Any]:
+        """同步解析 metric_ids（含依赖）：未取过的在当前线程取，已在预取中的等待其结果。"""
+        metric_ids = list(metric_ids)
+        claimed, waits, batch = self._claim(metric_ids)
+        if claimed:
+            self.fetched_ids.extend(claimed)
+            self._run_batch(claimed, waits, batch)
+        else:
+            for future in waits:
+                future.result()
+        with self._lock:
+            return dict(self.values)
+
+    def prefetch(self, metric_ids: Iterable[str]) -> None:
+        """后台预取 metric_ids（含依赖）；已取过或已在预取中的跳过。"""
+        claimed, waits, batch = self._claim(metric_ids)
+        if not claimed:
+            return
+        self.prefetched_ids.extend(claimed)
+        try:
+            self._executor.submit(self._run_batch, claimed, waits, batch)
+        except RuntimeError:
+            # 已 close：改为不预取，登记撤销，后续 resolve 会同步取
+            with self._lock:
+                for metric_id in claimed:
+                    self._pending.pop(metric_id, None)
+            batch.set_result(None)
+
+    def step_demand(self, step: Dict[str, Any]) -> List[str]:
+        """
+        执行 step 前须就绪的指标：get_step_metric_ids，加上各 details 项 params 引用的键与
+        action 声明的 reads 中属于 pipeline 指标的部分；有 action 读集未知时为场景全部指标。
+        """
+        metric_ids = list(self.rule_loader.get_step_metric_ids(step))
+        for item in step.get("details") or []:
+            if not isinstance(item, dict) or not item.get("action"):
+                continue
+            params = item.get("params") or {}
+            reads = action_reads(str(item["action"]), params)
+            if reads is None:
+                return list(dict.fromkeys(metric_ids + self.scene_metric_ids))
+            keys = set(reads)
+            for key, raw_value in params.items():
+                if raw_value is None or raw_value == "":
+                    keys.add(str(key))
+                else:
+                    keys.update(extract_vars_from_definition(raw_value))
+            metric_ids.extend(
+                key for key in sorted(keys) if self.rule_loader.get_metric_meta(key) is not None
+            )
+        return list(dict.fromkeys(metric_ids))
+
+    def enter_step(self, step: Dict[str, Any], context: Dict[str, Any]) -> None:
+        """进入 step：同步解析其需求集（step_demand）并 setdefault 进 context，再后台预取直接后继 step 的指标。"""
+        metric_ids = [metric_id for metric_id in self.step_demand(step) if metric_id not in context]
+        successor_ids: List[str] = []
+        for step_id in self.rule_loader.get_step_successors(step):
+            successor = self.rule_loader.get_step(step_id)
+            if successor is not None:
+                successor_ids.extend(self.rule_loader.get_step_metric_ids(successor))
+        if successor_ids:
+            self.prefetch(successor_ids)
+        if metric_ids:
+            values = self.resolve(metric_ids)
+            self._merge(context, values)
+            detail_trace.info(
+                "按需取数 | step=%s | metric_ids=%s | 预取后继=%s",
+                step.get("id"),
+                detail_trace.preview(metric_ids, 240),
+                detail_trace.preview(successor_ids, 240),
+            )
+
+    def merge_ready(self, context: Dict[str, Any]) -> None:
+        """把已取到（含预取完成）的指标补进 context，不等待仍在进行中的预取。"""
+        with self._lock:
+            values = dict(self.values)
+        self._merge(context, values)
+
+    @staticmethod
+    def _merge(context: Dict[str, Any], values: Dict[str, Any]) -> None:
+        for key, value in values.items():
+            context.setdefault(key, value)
+
+    def close(self) -> None:
+        """取消尚未开始的预取；已在执行的批次跑完后返回（其取数线程会写 fetcher.source_log）。"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for future in set(self._pending.values()):
+                if not future.done():
+                    future.set_result(None)
+            self._pending.clear()
@@ -1,18 +1,46 @@
 """统一的指标取数器。"""
-import json
+import heapq
 import logging
+import math
 import os
 import random
+import threading
 import time
 import re
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
 from sqlalchemy import text
 
 from app.diagnosis.config_store import DiagnosisConfigStore
+from app.engine.fetch_planner import (
+    FetchRequest,
+    freeze_value,
+    group_columns,
+    plan_fetch_groups,
+)
+from app.engine.metric_plan import (
+    Coercion,
+    Extractor,
+    FilterNode,
+    LinkPredicate,
+    MetricPlan,
+    compile_coercion,
+    compile_extraction_rule,
+    compile_filter_condition,
+    compile_link_predicates,
+    compile_metric_plan,
+    normalize_linking,
+    parse_duration_days,
+    safe_identifier,
+)
 from app.engine.rule_loader import RuleLoader
 from app.utils import detail_trace
+from app.utils.column_arrays import coerce_float_column, float_column, select_column
+from app.utils.env_settings import env_float, env_int
+from app.utils.fast_json import INVALID_JSON, LazyJsonColumn, decode_json
+from app.utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -25,10 +53,51 @@ if METRIC_SOURCE_MODE not in _VALID_MODES:
     METRIC_SOURCE_MODE = "mock_allowed"
 
 
-def _safe_identifier(name: str) -> str:
-    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_\.]*", str(name)):
-        raise ValueError(f"非法 SQL 标识符: {name}")
-    return str(name)
+# fetch_all 按依赖层并发取数的线程上限；1 表示退化为串行（排障用）。
+DEFAULT_FETCH_MAX_WORKERS = 8
+METRIC_FETCH_MAX_WORKERS = env_int("METRIC_FETCH_MAX_WORKERS", DEFAULT_FETCH_MAX_WORKERS, minimum=1)
+
+# 跨请求窗口查询缓存：条目上限（0 关闭）、默认 TTL 秒数、窗口时间分桶秒数。
+# 指标 meta 的 cache_ttl 可覆盖默认 TTL，cache_ttl=0 表示该指标不进缓存。
+METRIC_CACHE_MAX_ENTRIES = env_int("METRIC_CACHE_MAX_ENTRIES", 2048)
+METRIC_CACHE_TTL_SECONDS = env_int("METRIC_CACHE_TTL_SECONDS", 300)
+METRIC_CACHE_TIME_BUCKET_SECONDS = env_int("METRIC_CACHE_TIME_BUCKET_SECONDS", 60, minimum=1)
+
+# MySQL 按距 T 取最近行：1 = 拆成 T 两侧按时间列有序的范围读取（可走 (equipment, time) 索引，
+# 免整窗 filesort）；0 = 回退 ORDER BY ABS(TIMESTAMPDIFF(...)) 单条查询（排障用）。
+MYSQL_TWO_SIDED_SEEK = env_int("MYSQL_TWO_SIDED_SEEK", 1) > 0
+
+# ClickHouse linking `in` 依赖下推：1 = 同批内 ClickHouse 父指标（如 mark_candidates）作为子查询
+# 嵌进子指标 WHERE，子指标与父指标同层并发；0 = 先取父指标再展开 IN 列表（排障用）。
+CH_JOIN_PUSHDOWN = env_int("CH_JOIN_PUSHDOWN", 1) > 0
+
+# window_strategy=progressive 的放宽节奏：首个窗口小时数、每次放宽倍数（直到指标 duration）。
+PROGRESSIVE_WINDOW_INITIAL_HOURS = env_int("PROGRESSIVE_WINDOW_INITIAL_HOURS", 1, minimum=1)
+PROGRESSIVE_WINDOW_FACTOR = env_int("PROGRESSIVE_WINDOW_FACTOR", 4, minimum=2)
+
+# approximate 取数的默认值（指标 meta.approximate 对象里的 sample / max_rows_to_read 可覆盖）：
+# SAMPLE 比例（>=1 表示不抽样）、单次查询读取行数上限（超出后返回已读部分）。
+CH_APPROX_SAMPLE_RATIO = env_float("CH_APPROX_SAMPLE_RATIO", 0.1)
+CH_APPROX_MAX_ROWS_TO_READ = env_int("CH_APPROX_MAX_ROWS_TO_READ", 10_000_000, minimum=1)
+
+# 需 Python 侧提取的 ClickHouse 指标按块读取时的默认预算（指标 meta 的 max_rows / max_bytes 可覆盖）：
+# 最多读取行数、原始值近似字节数；0 表示不限。
+CH_WINDOW_MAX_ROWS = env_int("CH_WINDOW_MAX_ROWS", 0)
+CH_WINDOW_MAX_BYTES = env_int("CH_WINDOW_MAX_BYTES", 0)
+
+_metric_window_cache = TTLCache(METRIC_CACHE_MAX_ENTRIES, METRIC_CACHE_TTL_SECONDS)
+
+
+def metric_window_cache_stats() -> Dict[str, Any]:
+    """跨请求窗口缓存的命中/未命中/淘汰计数（/health 展示用）。"""
+    return _metric_window_cache.stats()
+
+
+def clear_metric_window_cache() -> None:
+    _metric_window_cache.clear()
+
+# _apply_extractor 的 decoded 缺省值：调用方未预先解析 JSON
+_UNDECODED = object()
 
 
 class MetricFetcher:
@@ -43,6 +112,7 @@ class MetricFetcher:
         pipeline_id: str = "reject_errors",
         params: Optional[Dict[str, Any]] = None,
         source_record: Optional[Dict[str, Any]] = None,
+        max_workers: Optional[int] = None,
     ):
         self.equipment = equipment
         self.reference_time = reference_time
@@ -55,6 +125,11 @@ class MetricFetcher:
         self.store = DiagnosisConfigStore()
         self.pipeline = self.store.get_pipeline(pipeline_id)
         self.source_log: Dict[str, str] = {}
+        self.max_workers = max(1, int(max_workers or METRIC_FETCH_MAX_WORKERS))
+        # 单次诊断内的取数备忘：同一指标 + 同一组已解析 linking 值只查一次库
+        # （scene 触发指标会在 _select_scene 与 diagnose 主流程各取一遍）
+        self._memo: Dict[Tuple[Any, ...], Tuple[Any, str]] = {}
+        self._memo_lock = threading.Lock()
 
     def _duration_days_for_meta(self, meta: Dict[str, Any]) -> int:
         """
@@ -63,12 +138,20 @@ class MetricFetcher:
         而静默退回默认窗口。
         """
         raw = meta.get("duration")
-        if raw is not None:
-            try:
-                return int(float(str(raw).strip()))
-            except (TypeError, ValueError):
-                logger.warning("指标 duration 无效: %r，使用回退 %s 天", raw, self.fallback_duration_days)
-        return self.fallback_duration_days
+        days = parse_duration_days(raw)
+        if days is None and raw is not None:
+            logger.warning("指标 duration 无效: %r，使用回退 %s 天", raw, self.fallback_duration_days)
+        return self.fallback_duration_days if days is None else days
+
+    def _duration_days_for_plan(self, plan: MetricPlan) -> int:
+        if plan.duration_invalid:
+            logger.warning(
+                "指标 %s duration 无效: %r，使用回退 %s 天",
+                plan.metric_id,
+                plan.meta.get("duration"),
+                self.fallback_duration_days,
+            )
+        return self.fallback_duration_days if plan.duration_days is None else plan.duration_days
 
     def window_for_metric(self, meta: Dict[str, Any]) -> Tuple[datetime, datetime]:
         days = self._duration_days_for_meta(meta)
@@ -76,6 +159,20 @@ class MetricFetcher:
         start = end - timedelta(days=days)
         return start, end
 
+    def _window_for_plan(self, plan: MetricPlan) -> Tuple[datetime, datetime]:
+        end = self.reference_time
+        return end - timedelta(days=self._duration_days_for_plan(plan)), end
+
+    def _plan(self, metric_id: str, meta: Dict[str, Any]) -> MetricPlan:
+        """
+        取 pipeline 加载时编译好的 MetricPlan；meta 不是 bundle 里那份（测试替换、动态注入）
+        时现场编译，保证计划与 meta 一致。
+        """
+        plan = (self.pipeline.get("metric_plans") or {}).get(metric_id)
+        if plan is not None and plan.meta is meta:
+            return plan
+        return compile_metric_plan(metric_id, meta)
+
     def _metric_linking_source_deps(self, metric_id: str) -> List[str]:
         """
         返回 metric_id 的 linking.keys / linking.filters 中 `source` 引用到的其它 metric_id。
@@ -143,46 +240,218 @@ class MetricFetcher:
                 break
         return sorted_order
 
+    def _group_metric_ids_by_level(
+        self,
+        metric_ids: List[str],
+        pushdown: Optional[Dict[str, FrozenSet[str]]] = None,
+    ) -> List[List[str]]:
+        """
+        在 _order_metric_ids_with_deps 的拓扑序上分层：层号 = 本批内依赖的最大层号 + 1。
+
+        同层指标之间没有 linking.source 依赖，可以并发取数；层内保持拓扑序，
+        便于日志与结果合并顺序稳定。依赖环退化的尾部按拓扑序里已定层的依赖计算，
+        未定层的依赖忽略（与原串行实现「环内按原顺序取」一致）。
+        pushdown 里的依赖以子查询形式嵌进子指标 SQL，不再占层（见 _plan_join_pushdown）。
+        """
+        ordered = self._order_metric_ids_with_deps(list(metric_ids))
+        wanted = set(ordered)
+        pushdown = pushdown or {}
+        level_of: Dict[str, int] = {}
+        levels: List[List[str]] = []
+        for mid in ordered:
+            pushed = pushdown.get(mid, frozenset())
+            dep_levels = [
+                level_of[dep]
+                for dep in self._metric_linking_source_deps(mid)
+                if dep in wanted and dep in level_of and dep not in pushed
+            ]
+            level = max(dep_levels) + 1 if dep_levels else 0
+            level_of[mid] = level
+            while len(levels) <= level:
+                levels.append([])
+            levels[level].append(mid)
+        return levels
+
+    def _plan_join_pushdown(self, metric_ids: List[str]) -> Dict[str, FrozenSet[str]]:
+        """
+        找出本批内可下推成子查询的 linking 依赖：子指标 → 可下推的父指标集合。
+
+        条件：子指标是 exact_keys 模式的 ClickHouse 指标，linking 里 `in` 谓词的 source 是
+        本批内的 ClickHouse 父指标；父指标取值就是窗口内的列值（无 Python 提取 / 探测 /
+        selection / data_type），且自身不再依赖下推（只下推一层）。
+        父指标取空时 IN 子查询为空集，与「父指标为 None → exact_keys 缺值 → 子指标 None」一致。
+        """
+        if not CH_JOIN_PUSHDOWN:
+            return {}
+        ordered = self._order_metric_ids_with_deps(list(metric_ids))
+        wanted = set(ordered)
+        pushdown: Dict[str, FrozenSet[str]] = {}
+        for mid in ordered:
+            meta = self.rule_loader.get_metric_meta(mid)
+            if not meta or meta.get("enabled") is False:
+                continue
+            plan = self._plan(mid, meta)
+            if plan.source_kind != "clickhouse_window" or plan.error or plan.linking_mode != "exact_keys":
+                continue
+            parents = {
+                pred.source
+                for pred in self._plan_link_predicates(plan)
+                if pred.operator == "in"
+                and pred.source in wanted
+                and pred.source != mid
+                and not pushdown.get(pred.source)
+                and self._pushdown_source_ok(pred.source)
+            }
+            if parents:
+                pushdown[mid] = frozenset(parents)
+        return pushdown
+
+    def _pushdown_source_ok(self, metric_id: str) -> bool:
+        meta = self.rule_loader.get_metric_meta(metric_id)
+        if not meta or meta.get("enabled") is False:
+            return False
+        plan = self._plan(metric_id, meta)
+        return (
+            plan.source_kind == "clickhouse_window"
+            and plan.error is None
+            and not plan.extraction.kind
+            and plan.probe_pattern is None
+            and plan.selection.mode == "all"
+            and plan.coercion.data_type is None
+        )
+
+    def _fetch_one_timed(
+        self,
+        metric_id: str,
+        extra_context: Dict[str, Any],
+    ) -> Tuple[Any, Optional[Exception], float]:
+        """fetch_all 的单指标执行单元：异常不外抛，连同耗时一起交回主线程统一落结果。"""
+        t0 = time.perf_counter()
+        try:
+            value = self._fetch_one(metric_id, extra_context)
+            return value, None, (time.perf_counter() - t0) * 1000
+        except Exception as exc:
+            return None, exc, (time.perf_counter() - t0) * 1000
+
+    @staticmethod
+    def _db_source_kind(meta: Dict[str, Any]) -> str:
+        """规范化 source_kind：mysql/clickhouse 简写映射到 mysql_nearest_row/clickhouse_window。"""
+        source_kind = str(meta.get("source_kind", "")).strip().lower()
+        return {
+            "mysql": "mysql_nearest_row",
+            "clickhouse": "clickhouse_window",
+        }.get(source_kind, source_kind)
+
+    def _fetch_group_timed(self, requests: List[FetchRequest]) -> Dict[str, Tuple[Any, Optional[Exception], float]]:
+        """fetch_all 的合并查询执行单元：组内各指标共享同一次查询耗时。"""
+        t0 = time.perf_counter()
+        try:
+            values = self._fetch_group(requests)
+        except Exception as exc:
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            return {req.metric_id: (None, exc, elapsed_ms) for req in requests}
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        return {req.metric_id: (values.get(req.metric_id), None, elapsed_ms) for req in requests}
+
+    def _plan_level(
+        self,
+        level_ids: List[str],
+        extra_context: Dict[str, Any],
+        pushdown: Optional[Dict[str, FrozenSet[str]]] = None,
+    ) -> Tuple[List[str], List[List[FetchRequest]]]:
+        """
+        把一层指标拆成「走 _fetch_one 单独取数」与「按签名分组的查询」两类。
+
+        已渲染出 FetchRequest 的 DB 指标全部进入分组（单成员组就是普通单列查询），
+        避免同一指标渲染两遍；其余指标（非 DB、禁用、缺上下文、渲染异常）走 _fetch_one。
+        """
+        singles: List[str] = []
+        requests: List[FetchRequest] = []
+        for metric_id in level_ids:
+            request = self._prepare_fetch_request(
+                metric_id, extra_context, (pushdown or {}).get(metric_id, frozenset())
+            )
+            if request is None:
+                singles.append(metric_id)
+            else:
+                requests.append(request)
+        return singles, plan_fetch_groups(requests)
+
     def fetch_all(self, metric_ids: List[str], extra_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        metric_ids = self._order_metric_ids_with_deps(list(metric_ids))
+        """
+        按 linking 依赖分层取数：同层指标在有界线程池里并发执行，层与层之间串行。
+
+        mark_pos_x 这类依赖 mark_candidates 的指标会等到上一层全部落入 context 后再取；
+        其余互不依赖的 ClickHouse / MySQL 查询并发发出，总耗时从「所有查询之和」
+        降到「依赖链上的关键路径」。同层里同表、同窗口、同 linking 的指标由取数计划器
+        合并成一条多列查询（见 fetch_planner）。结果、source_log 与 *_window 条目与串行实现一致。
+        """
+        pushdown = self._plan_join_pushdown(list(metric_ids))
+        levels = self._group_metric_ids_by_level(list(metric_ids), pushdown)
         result: Dict[str, Any] = {}
         resolved_context: Dict[str, Any] = dict(extra_context or {})
         t_batch = time.perf_counter()
-        for metric_id in metric_ids:
-            t0 = time.perf_counter()
-            try:
-                value = self._fetch_one(metric_id, resolved_context)
-                result[metric_id] = value
-                resolved_context[metric_id] = value
-                meta = self.rule_loader.get_metric_meta(metric_id) or {}
-                source_kind = str(meta.get("source_kind", "")).strip().lower()
-                source_kind = {
-                    "mysql": "mysql_nearest_row",
-                    "clickhouse": "clickhouse_window",
-                }.get(source_kind, source_kind)
-                if source_kind in {"mysql_nearest_row", "clickhouse_window"}:
-                    window_values = list(value or [])
-                    result[f"{metric_id}_window"] = window_values
-                    resolved_context[f"{metric_id}_window"] = window_values
-            except Exception as exc:
-                logger.warning("获取指标 %s 失败: %s", metric_id, exc)
-                self.source_log[metric_id] = "none"
-                result[metric_id] = None
-                result[f"{metric_id}_window"] = []
-                resolved_context[metric_id] = None
-                resolved_context[f"{metric_id}_window"] = []
-            finally:
-                elapsed_ms = (time.perf_counter() - t0) * 1000
-                src = self.source_log.get(metric_id, "?")
-                detail_trace.info(
-                    "  [指标] %s | 耗时=%.1fms | source=%s",
-                    metric_id,
-                    elapsed_ms,
-                    src,
-                )
+        widest = max((len(level) for level in levels), default=0)
+        pool_size = min(self.max_workers, widest)
+        executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="metric-fetch") if pool_size > 1 else None
+        task_count = 0
+        merged_count = 0
+        try:
+            for level_index, level_ids in enumerate(levels):
+                singles, groups = self._plan_level(level_ids, resolved_context, pushdown)
+                task_count += len(singles) + len(groups)
+                merged_count += sum(len(group) for group in groups if len(group) > 1)
+                outcomes: Dict[str, Tuple[Any, Optional[Exception], float]] = {}
+                if executor is not None and len(singles) + len(groups) > 1:
+                    # 层内只读 resolved_context；写回统一在主线程按层内顺序进行
+                    single_futures = {
+                        mid: executor.submit(self._fetch_one_timed, mid, resolved_context)
+                        for mid in singles
+                    }
+                    group_futures = [executor.submit(self._fetch_group_timed, group) for group in groups]
+                    for mid, future in single_futures.items():
+                        outcomes[mid] = future.result()
+                    for future in group_futures:
+                        outcomes.update(future.result())
+                else:
+                    for mid in singles:
+                        outcomes[mid] = self._fetch_one_timed(mid, resolved_context)
+                    for group in groups:
+                        outcomes.update(self._fetch_group_timed(group))
+                for metric_id in level_ids:
+                    value, exc, elapsed_ms = outcomes[metric_id]
+                    if exc is None:
+                        result[metric_id] = value
+                        resolved_context[metric_id] = value
+                        meta = self.rule_loader.get_metric_meta(metric_id) or {}
+                        if self._db_source_kind(meta) in {"mysql_nearest_row", "clickhouse_window"}:
+                            window_values = list(value or [])
+                            result[f"{metric_id}_window"] = window_values
+                            resolved_context[f"{metric_id}_window"] = window_values
+                    else:
+                        logger.warning("获取指标 %s 失败: %s", metric_id, exc)
+                        self.source_log[metric_id] = "none"
+                        result[metric_id] = None
+                        result[f"{metric_id}_window"] = []
+                        resolved_context[metric_id] = None
+                        resolved_context[f"{metric_id}_window"] = []
+                    detail_trace.info(
+                        "  [指标] %s | 层=%s | 耗时=%.1fms | source=%s",
+                        metric_id,
+                        level_index,
+                        elapsed_ms,
+                        self.source_log.get(metric_id, "?"),
+                    )
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
         detail_trace.info(
-            "metric_fetch_all 批合计 | 指标数=%s | 批耗时=%.1fms",
-            len(metric_ids),
+            "metric_fetch_all 批合计 | 指标数=%s | 层数=%s | 执行单元=%s | 合并指标=%s | 并发上限=%s | 批耗时=%.1fms",
+            sum(len(level) for level in levels),
+            len(levels),
+            task_count,
+            merged_count,
+            max(pool_size, 1),
             (time.perf_counter() - t_batch) * 1000,
         )
         return result
@@ -200,11 +469,7 @@ class MetricFetcher:
             self.source_log[metric_id] = "disabled"
             return None
 
-        source_kind = str(meta.get("source_kind", "")).strip().lower()
-        source_kind = {
-            "mysql": "mysql_nearest_row",
-            "clickhouse": "clickhouse_window",
-        }.get(source_kind, source_kind)
+        source_kind = self._db_source_kind(meta)
         if source_kind in {"failure_record_field", "request_param"}:
             return None
         if source_kind == "mysql_nearest_row":
@@ -273,34 +538,20 @@ class MetricFetcher:
         return value
 
     def _apply_data_type(self, metric_id: str, value: Any, meta: Dict[str, Any]) -> Any:
-        if value is None:
-            return None
-        raw_data_type = meta.get("data_type")
-        if raw_data_type is None:
+        return self._coerce_value(metric_id, value, compile_coercion(meta.get("data_type")))
+
+    @staticmethod
+    def _coerce_value(metric_id: str, value: Any, coercion: Coercion) -> Any:
+        if value is None or coercion.data_type is None:
             return value
-        data_type = str(raw_data_type).strip().lower()
-        if not data_type:
+        if coercion.func is None:
+            logger.warning("指标 %s 未知 data_type=%s，保留原值", metric_id, coercion.data_type)
             return value
         try:
-            if data_type in {"float", "double", "number"}:
-                return float(value)
-            if data_type in {"int", "integer"}:
-                return int(float(value))
-            if data_type in {"bool", "boolean"}:
-                if isinstance(value, str):
-                    lowered = value.strip().lower()
-                    if lowered in {"true", "1", "yes", "y"}:
-                        return True
-                    if lowered in {"false", "0", "no", "n"}:
-                        return False
-                return bool(value)
-            if data_type in {"str", "string", "text"}:
-                return str(value)
+            return coercion.func(value)
         except (TypeError, ValueError) as exc:
-            logger.warning("指标 %s data_type=%s 转换失败: %s", metric_id, data_type, exc)
+            logger.warning("指标 %s data_type=%s 转换失败: %s", metric_id, coercion.data_type, exc)
             return value
-        logger.warning("指标 %s 未知 data_type=%s，保留原值", metric_id, data_type)
-        return value
 
     def _extract_direct_metric(self, metric_id: str, source_record: Dict[str, Any]) -> Tuple[bool, Any]:
         meta = self.rule_loader.get_metric_meta(metric_id)
@@ -330,7 +581,18 @@ class MetricFetcher:
         self.source_log[metric_id] = "real_input"
         return True, value
 
-    def fetch_from_source_record(self, source_record: Dict[str, Any], metric_ids: List[str]) -> Dict[str, Any]:
+    def fetch_from_source_record(
+        self,
+        source_record: Dict[str, Any],
+        metric_ids: List[str],
+        extra_context: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        源记录 / 请求参数字段直接取值，其余指标走 fetch_all。
+
+        extra_context：本批之外已解析的指标（按需取数时前面 step 取到的值），
+        供 linking.source 依赖解析；不会出现在返回值里。
+        """
         self.source_record = source_record or {}
         result: Dict[str, Any] = {}
         remaining: List[str] = []
@@ -357,19 +619,12 @@ class MetricFetcher:
 
         if remaining:
             with detail_trace.span("metric_fetch_all", remaining=len(remaining)):
-                result.update(self.fetch_all(remaining, extra_context=result))
+                result.update(self.fetch_all(remaining, extra_context={**(extra_context or {}), **result}))
         return result
 
     @staticmethod
     def _normalize_linking(meta: Dict[str, Any]) -> Dict[str, Any]:
-        linking = meta.get("linking") or {}
-        if not isinstance(linking, dict):
-            linking = {}
-        return {
-            "mode": str(linking.get("mode", "time_window_only")).strip().lower(),
-            "keys": list(linking.get("keys") or []),
-            "filters": list(linking.get("filters") or []),
-        }
+        return normalize_linking(meta)
 
     @staticmethod
     def _fallback_policy(meta: Dict[str, Any]) -> str:
@@ -404,77 +659,43 @@ class MetricFetcher:
             return self._resolve_context_value(placeholder.group(1), time_filter, extra_context)
         return self._extract_scalar(token)
 
-    def _build_linking_clauses(
+    def _bind_link_predicates(
         self,
-        linking_items: List[Dict[str, Any]],
+        predicates: Tuple[LinkPredicate, ...],
         time_filter: datetime,
         extra_context: Dict[str, Any],
-        index_seed: int = 0,
         placeholder_style: str = "mysql",
-    ) -> Tuple[List[str], Dict[str, Any], int, bool]:
+        param_prefix: str = "link",
+    ) -> Tuple[List[str], Dict[str, Any], bool]:
+        """按本次上下文为已编译的 linking 谓词绑定参数；值缺失的谓词跳过并标记 missing。"""
         clauses: List[str] = []
         params: Dict[str, Any] = {}
-        idx = index_seed
+        idx = 0
         missing_required = False
 
-        for item in linking_items or []:
-            if not isinstance(item, dict):
-                continue
-            target = str(item.get("target", "")).strip()
-            if not target:
-                continue
-            operator = str(item.get("operator", "=")).strip()
-            if operator not in {"=", "==", "!=", ">", ">=", "<", "<=", "contains", "in"}:
-                raise ValueError(f"linking.operator 不支持: {operator}")
-            if "source" in item:
-                value = self._resolve_context_value(str(item.get("source", "")).strip(), time_filter, extra_context)
-            else:
-                value = item.get("value")
+        def _resolve(name: str) -> Any:
+            return self._resolve_context_value(name, time_filter, extra_context)
+
+        for predicate in predicates:
+            value = predicate.resolve(_resolve)
             if value is None:
                 missing_required = True
                 continue
-            param_name = f"link_{idx}"
-            sql_operator = "=" if operator == "==" else operator
-            target_ident = _safe_identifier(target)
-            if sql_operator == "contains":
-                placeholder = f":{param_name}" if placeholder_style == "mysql" else f"%({param_name})s"
-                if placeholder_style == "clickhouse":
-                    clauses.append(f"positionUTF8(toString({target_ident}), toString({placeholder})) > 0")
-                else:
-                    clauses.append(f"INSTR(CAST({target_ident} AS CHAR), CAST({placeholder} AS CHAR)) > 0")
-                params[param_name] = value
-                idx += 1
-                continue
-            if sql_operator == "in":
-                values = list(value) if isinstance(value, (list, tuple, set)) else [value]
-                if not values:
-                    missing_required = True
-                    continue
-                placeholders: List[str] = []
-                for sub_index, sub_value in enumerate(values):
-                    item_param_name = f"{param_name}_{sub_index}"
-                    placeholders.append(
-                        f":{item_param_name}" if placeholder_style == "mysql" else f"%({item_param_name})s"
-                    )
-                    params[item_param_name] = sub_value
-                if placeholder_style == "clickhouse":
-                    placeholders_sql = ", ".join(f"toString({ph})" for ph in placeholders)
-                    clauses.append(f"toString({target_ident}) IN ({placeholders_sql})")
-                else:
-                    clauses.append(f"{target_ident} IN ({', '.join(placeholders)})")
-                idx += 1
+            clause, clause_params = predicate.render(f"{param_prefix}_{idx}", value, placeholder_style)
+            if clause is None:
+                missing_required = True
                 continue
-            placeholder = f":{param_name}" if placeholder_style == "mysql" else f"%({param_name})s"
-            if placeholder_style == "clickhouse" and sql_operator in {"=", "!="}:
-                # ClickHouse 本地替身与内网参考在部分 linking 列上存在 String/Int 混用，
-                # 这里统一按字符串比较，避免类型不一致导致联调失败。
-                clauses.append(f"toString({target_ident}) {sql_operator} toString({placeholder})")
-            else:
-                clauses.append(f"{target_ident} {sql_operator} {placeholder}")
-            params[param_name] = value
+            clauses.append(clause)
+            params.update(clause_params)
             idx += 1
+        return clauses, params, missing_required
 
-        return clauses, params, idx, missing_required
+    @staticmethod
+    def _plan_link_predicates(plan: MetricPlan) -> Tuple[LinkPredicate, ...]:
+        """exact_keys 模式下 keys 与 filters 一起生效，其余模式只用 filters。"""
+        if plan.linking_mode == "exact_keys":
+            return plan.link_keys + plan.link_filters
+        return plan.link_filters
 
     def _build_metric_filters(
         self,
@@ -485,30 +706,13 @@ class MetricFetcher:
         placeholder_style: str = "mysql",
         extra_context: Optional[Dict[str, Any]] = None,
     ) -> Tuple[List[str], Dict[str, Any], bool]:
-        linking = self._normalize_linking(meta)
-        clauses: List[str] = []
-        params: Dict[str, Any] = {}
-        idx = 0
-        missing_required = False
-        resolved_context = extra_context or {}
-
+        linking = normalize_linking(meta)
+        predicates: Tuple[LinkPredicate, ...] = ()
         if include_exact_keys and linking["mode"] == "exact_keys":
-            key_clauses, key_params, idx, key_missing = self._build_linking_clauses(
-                linking["keys"], time_filter, resolved_context, idx, placeholder_style
-            )
-            clauses.extend(key_clauses)
-            params.update(key_params)
-            missing_required = missing_required or key_missing
-
+            predicates += compile_link_predicates(linking["keys"])
         if include_linking_filters:
-            filter_clauses, filter_params, idx, filter_missing = self._build_linking_clauses(
-                linking["filters"], time_filter, resolved_context, idx, placeholder_style
-            )
-            clauses.extend(filter_clauses)
-            params.update(filter_params)
-            missing_required = missing_required or filter_missing
-
-        return clauses, params, missing_required
+            predicates += compile_link_predicates(linking["filters"])
+        return self._bind_link_predicates(predicates, time_filter, extra_context or {}, placeholder_style)
 
     @staticmethod
     def _join_sql_clauses(clauses: List[str]) -> str:
@@ -527,13 +731,53 @@ class MetricFetcher:
         where_sql: str,
         where_params: Dict[str, Any],
         omit_equipment_filter: bool = False,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
     ) -> List[Any]:
+        rows = self._query_mysql_window_rows(
+            table_name,
+            [column_name],
+            time_column,
+            equipment_column,
+            time_start,
+            time_end,
+            where_sql,
+            where_params,
+            omit_equipment_filter=omit_equipment_filter,
+            limit=limit,
+            aggregate=aggregate,
+        )
+        return [row[0] for row in rows]
+
+    def _query_mysql_window_rows(
+        self,
+        table_name: str,
+        column_names: List[str],
+        time_column: str,
+        equipment_column: str,
+        time_start: datetime,
+        time_end: datetime,
+        where_sql: str,
+        where_params: Dict[str, Any],
+        omit_equipment_filter: bool = False,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
+        regex_probe: Optional[str] = None,
+    ) -> List[Tuple[Any, ...]]:
+        """
+        窗口内按距 T 由近到远读取多列原始行；每行按 column_names 顺序排列。
+
+        limit：只取最近 N 行（同时要求各列非空，与 Python 侧丢弃 None 的口径一致）；
+        aggregate：avg/min/max/count 聚合成单行，不再排序；
+        regex_probe：存在性探测，SELECT 1 ... WHERE 列 REGEXP pattern LIMIT 1。
+        """
         from app.ods.datacenter_ods import SessionLocal
 
+        column_label = ",".join(column_names)
         detail_trace.info(
             "    [MySQL查询] table=%s column=%s time=[%s, %s] omit_equipment=%s where_sql=%s params=%s",
             table_name,
-            column_name,
+            column_label,
             time_start,
             time_end,
             omit_equipment_filter,
@@ -556,153 +800,206 @@ class MetricFetcher:
                 "ref_time": self.reference_time,
             }
 
-        sql = text(
-            f"""
-            SELECT {column_name}
-            FROM {table_name}
-            WHERE {where_equipment}{time_column} >= :time_start
-              AND {time_column} <= :time_end
-              {where_sql}
-            ORDER BY ABS(TIMESTAMPDIFF(SECOND, {time_column}, :ref_time)) ASC
-            """
-        )
+        safe_columns = [safe_identifier(c) for c in column_names]
+        seek_sides: List[str] = []
+        if regex_probe is not None:
+            select_sql = "1"
+            where_sql = where_sql + "".join(f" AND {c} REGEXP :probe_pattern" for c in safe_columns)
+            where_params = {**where_params, "probe_pattern": regex_probe}
+            tail_sql = "LIMIT 1"
+        elif aggregate:
+            select_sql = ", ".join(f"{aggregate.upper()}({c})" for c in safe_columns)
+            tail_sql = ""
+        else:
+            select_sql = ", ".join(safe_columns)
+            limit_sql = ""
+            if limit is not None:
+                where_sql = where_sql + "".join(f" AND {c} IS NOT NULL" for c in safe_columns)
+                limit_sql = f" LIMIT {int(limit)}"
+            tail_sql = f"ORDER BY ABS(TIMESTAMPDIFF(SECOND, {time_column}, :ref_time)) ASC{limit_sql}"
+            if MYSQL_TWO_SIDED_SEEK:
+                seek_sides = self._nearest_seek_sides(time_start, time_end)
+
         db = SessionLocal()
         try:
             t0 = time.perf_counter()
-            rows = db.execute(
-                sql,
-                {
-                    **base_params,
-                    **where_params,
-                },
-            ).fetchall()
+
+            def _run(select_clause: str, range_sql: str, order_sql: str) -> List[Tuple[Any, ...]]:
+                sql = text(
+                    f"""
+                    SELECT {select_clause}
+                    FROM {table_name}
+                    WHERE {where_equipment}{range_sql}
+                      {where_sql}
+                    {order_sql}
+                    """
+                )
+                rows = db.execute(sql, {**base_params, **where_params}).fetchall()
+                return [tuple(row) for row in rows if row is not None]
+
+            if not seek_sides:
+                rows = _run(
+                    select_sql,
+                    f"{time_column} >= :time_start\n                      AND {time_column} <= :time_end",
+                    tail_sql,
+                )
+            elif len(seek_sides) == 1:
+                # 窗口整体在 T 一侧：按时间列单向有序读取，与按距离排序等价
+                side = seek_sides[0]
+                rows = _run(
+                    select_sql,
+                    self._seek_range_sql(time_column, side),
+                    f"ORDER BY {time_column} {'DESC' if side == 'before' else 'ASC'}{limit_sql}",
+                )
+            else:
+                # 窗口跨过 T：两次按索引有序的范围读取，Python 侧按距 T 归并
+                select_with_time = f"{select_sql}, {time_column}"
+                before = _run(
+                    select_with_time,
+                    self._seek_range_sql(time_column, "before"),
+                    f"ORDER BY {time_column} DESC{limit_sql}",
+                )
+                after = _run(
+                    select_with_time,
+                    self._seek_range_sql(time_column, "after"),
+                    f"ORDER BY {time_column} ASC{limit_sql}",
+                )
+                rows = self._merge_by_distance(before, after, limit)
+                if rows is None:
+                    detail_trace.warning(
+                        "    [MySQL查询] table=%s 时间列 %s 无法解析，退回单次按距离排序查询",
+                        table_name,
+                        time_column,
+                    )
+                    rows = _run(
+                        select_sql,
+                        f"{time_column} >= :time_start\n                      AND {time_column} <= :time_end",
+                        tail_sql,
+                    )
             detail_trace.info(
-                "    [MySQL查询完成] table=%s column=%s rows=%s 耗时=%.1fms",
+                "    [MySQL查询完成] table=%s column=%s rows=%s seek=%s 耗时=%.1fms",
                 table_name,
-                column_name,
+                column_label,
                 len(rows),
+                "+".join(seek_sides) or "-",
                 (time.perf_counter() - t0) * 1000,
             )
-            return [row[0] for row in rows if row is not None]
+            return rows
         finally:
             db.close()
 
+    def _nearest_seek_sides(self, time_start: datetime, time_end: datetime) -> List[str]:
+        """
+        按距 T 排序的窗口拆成 T 两侧的有序范围读取：before = [start, min(T, end)] 倒序，
+        after = (T, end] 正序。窗口终点不晚于 T（最常见）时只需 before 一次读取。
+        """
+        sides = []
+        if time_start <= self.reference_time:
+            sides.append("before")
+        if time_end > self.reference_time:
+            sides.append("after")
+        return sides
+
+    @staticmethod
+    def _seek_range_sql(time_column: str, side: str) -> str:
+        if side == "before":
+            return (
+                f"{time_column} >= :time_start\n                      AND {time_column} <= :time_end"
+                f"\n                      AND {time_column} <= :ref_time"
+            )
+        return (
+            f"{time_column} >= :time_start\n                      AND {time_column} <= :time_end"
+            f"\n                      AND {time_column} > :ref_time"
+        )
+
+    @staticmethod
+    def _parse_row_time(value: Any) -> Optional[datetime]:
+        """时间列取值转成 naive datetime（字符串与 reference_time 的解析口径一致：ISO 格式）；无法解析返回 None。"""
+        if isinstance(value, str):
+            text_value = value.strip()
+            if text_value.endswith("Z"):
+                text_value = text_value[:-1]
+            try:
+                value = datetime.fromisoformat(text_value)
+            except ValueError:
+                return None
+        elif isinstance(value, date) and not isinstance(value, datetime):
+            value = datetime.combine(value, datetime.min.time())
+        if not isinstance(value, datetime) or value.tzinfo is not None:
+            return None
+        return value
+
+    def _seconds_from_reference(self, value: datetime) -> int:
+        """与 ABS(TIMESTAMPDIFF(SECOND, col, T)) 同口径：按整秒截断后的绝对距离。"""
+        return abs(int((self.reference_time - value).total_seconds()))
+
+    def _merge_by_distance(
+        self,
+        before: List[Tuple[Any, ...]],
+        after: List[Tuple[Any, ...]],
+        limit: Optional[int],
+    ) -> Optional[List[Tuple[Any, ...]]]:
+        """
+        两侧各自已按距 T 由近到远有序（末列为时间列）；归并后去掉时间列，距离相同时 T 之前的行优先。
+
+        任一行的时间列无法解析时返回 None，由调用方退回单次 ORDER BY ABS(...) 查询，
+        不在 Python 侧猜测其距离。
+        """
+        keyed: List[List[Tuple[int, Tuple[Any, ...]]]] = []
+        for side_rows in (before, after):
+            side: List[Tuple[int, Tuple[Any, ...]]] = []
+            for row in side_rows:
+                row_time = self._parse_row_time(row[-1])
+                if row_time is None:
+                    return None
+                side.append((self._seconds_from_reference(row_time), row[:-1]))
+            keyed.append(side)
+        merged = heapq.merge(*keyed, key=lambda item: item[0])
+        rows = [row for _, row in merged]
+        return rows[:limit] if limit is not None else rows
+
     def _render_mysql_filters(self, filter_condition: Optional[str], time_filter: datetime, extra_context: Dict[str, Any]):
         if not filter_condition:
             return "", {}
-        sql_expr, params, parsed = self._render_mysql_filter_expr(
-            str(filter_condition),
-            time_filter,
-            extra_context,
-            index_seed=0,
-        )
-        if not parsed or not sql_expr:
+        return self._bind_filter_tree(compile_filter_condition(str(filter_condition)), time_filter, extra_context)
+
+    def _bind_filter_tree(
+        self,
+        node: Optional[FilterNode],
+        time_filter: datetime,
+        extra_context: Dict[str, Any],
+    ) -> Tuple[str, Dict[str, Any]]:
+        if node is None:
+            return "", {}
+        sql_expr, params = self._render_filter_node(node, time_filter, extra_context)
+        if not sql_expr:
             return "", {}
         return f" AND ({sql_expr})", params
 
-    def _render_mysql_filter_expr(
+    def _render_filter_node(
         self,
-        expr: str,
+        node: FilterNode,
         time_filter: datetime,
         extra_context: Dict[str, Any],
-        index_seed: int = 0,
-    ) -> Tuple[str, Dict[str, Any], int]:
-        text_expr = str(expr or "").strip()
-        if not text_expr:
-            return "", {}, index_seed
-        text_expr = self._strip_outer_parentheses(text_expr)
-
-        or_parts = self._split_top_level_boolean(text_expr, "OR")
-        if len(or_parts) > 1:
-            sql_parts: List[str] = []
-            params: Dict[str, Any] = {}
-            idx = index_seed
-            for part in or_parts:
-                sub_sql, sub_params, idx = self._render_mysql_filter_expr(part, time_filter, extra_context, idx)
-                if sub_sql:
-                    sql_parts.append(f"({sub_sql})")
-                    params.update(sub_params)
-            return " OR ".join(sql_parts), params, idx
-
-        and_parts = self._split_top_level_boolean(text_expr, "AND")
-        if len(and_parts) > 1:
-            sql_parts = []
-            params = {}
-            idx = index_seed
-            for part in and_parts:
-                sub_sql, sub_params, idx = self._render_mysql_filter_expr(part, time_filter, extra_context, idx)
-                if sub_sql:
-                    sql_parts.append(sub_sql)
-                    params.update(sub_params)
-            return " AND ".join(sql_parts), params, idx
-
-        match = re.fullmatch(r"([A-Za-z_]\w*)\s*(==|=|>=|<=|!=|<>|>|<)\s*(.+)", text_expr)
-        if not match:
-            logger.warning("filter_condition 片段无法解析，已忽略: %s", text_expr)
-            return "", {}, index_seed
-        column_name, operator, raw_value = match.groups()
-        # MySQL 不支持 Python 风格的 `==` / `!=`;这里归一化到 SQL 原生操作符,
-        # 避免配置里写 `col == 5` 时发出无效 SQL(1064 语法错)。
-        sql_operator = {"==": "=", "!=": "<>"}.get(operator, operator)
-        param_name = f"filter_{index_seed}"
-        value = self._resolve_filter_value(raw_value, time_filter, extra_context)
-        if value is None:
-            return "", {}, index_seed + 1
-        clause = f"{_safe_identifier(column_name)} {sql_operator} :{param_name}"
-        return clause, {param_name: value}, index_seed + 1
-
-    @staticmethod
-    def _strip_outer_parentheses(expr: str) -> str:
-        text_expr = expr.strip()
-        while text_expr.startswith("(") and text_expr.endswith(")"):
-            depth = 0
-            closed_at_end = True
-            for idx, ch in enumerate(text_expr):
-                if ch == "(":
-                    depth += 1
-                elif ch == ")":
-                    depth -= 1
-                    if depth == 0 and idx != len(text_expr) - 1:
-                        closed_at_end = False
-                        break
-            if depth != 0 or not closed_at_end:
-                break
-            text_expr = text_expr[1:-1].strip()
-        return text_expr
+    ) -> Tuple[str, Dict[str, Any]]:
+        if node.kind == "cmp":
+            if node.context_var is not None:
+                value = self._resolve_context_value(node.context_var, time_filter, extra_context)
+            else:
+                value = self._extract_scalar(node.raw_value)
+            if value is None:
+                return "", {}
+            param_name = f"filter_{node.param_index}"
+            return f"{node.column} {node.operator} :{param_name}", {param_name: value}
 
-    @staticmethod
-    def _split_top_level_boolean(expr: str, op: str) -> List[str]:
-        parts: List[str] = []
-        buf: List[str] = []
-        depth = 0
-        i = 0
-        op_text = f" {op} "
-        upper_expr = expr.upper()
-        while i < len(expr):
-            ch = expr[i]
-            if ch == "(":
-                depth += 1
-                buf.append(ch)
-                i += 1
-                continue
-            if ch == ")":
-                depth = max(0, depth - 1)
-                buf.append(ch)
-                i += 1
-                continue
-            if depth == 0 and upper_expr[i:i + len(op_text)] == op_text:
-                part = "".join(buf).strip()
-                if part:
-                    parts.append(part)
-                buf = []
-                i += len(op_text)
-                continue
-            buf.append(ch)
-            i += 1
-        last = "".join(buf).strip()
-        if last:
-            parts.append(last)
-        return parts
+        sql_parts: List[str] = []
+        params: Dict[str, Any] = {}
+        for child in node.children:
+            sub_sql, sub_params = self._render_filter_node(child, time_filter, extra_context)
+            if sub_sql:
+                sql_parts.append(f"({sub_sql})" if node.kind == "or" else sub_sql)
+                params.update(sub_params)
+        return f" {node.kind.upper()} ".join(sql_parts), params
 
     def _render_extraction_template(
         self,
@@ -764,8 +1061,13 @@ class MetricFetcher:
         渲染后 'chuck_message[0]' 这种 segment 设计的。
         与 'foo/0' 的写法**双向兼容**。
         """
+        return MetricFetcher._walk_json_path(data, [part for part in str(path or "").split("/") if part])
+
+    @staticmethod
+    def _walk_json_path(data: Any, segments: Any) -> Any:
+        """按已切分的路径段取值（段的三种形式见 _extract_json_path_value）。"""
         current = data
-        for segment in [part for part in str(path or "").split("/") if part]:
+        for segment in segments:
             # 形式 3: 'name[N]' 复合 segment(dict.name → list[N])
             m = MetricFetcher._NAME_INDEX_RE.match(segment)
             if m:
@@ -805,29 +1107,36 @@ class MetricFetcher:
     ) -> Any:
         if raw is None:
             return None
-        rule = str(extraction_rule or "").strip()
-        if not rule:
-            return self._extract_scalar(raw)
-        if rule.startswith("json:"):
-            key = rule[5:].strip()
-            try:
-                data = json.loads(str(raw))
-            except json.JSONDecodeError:
-                return None
-            return self._extract_scalar(data.get(key))
-        if rule.startswith("jsonpath:"):
-            path_template = rule[9:].strip()
-            path = self._render_extraction_template(path_template, extra_context)
-            if not path:
+        extractor = self._bind_extractor(compile_extraction_rule(str(extraction_rule or "")), extra_context)
+        return self._apply_extractor(raw, extractor)
+
+    def _bind_extractor(self, extractor: Extractor, extra_context: Optional[Dict[str, Any]]) -> Optional[Extractor]:
+        """
+        渲染 jsonpath 里的 {var}（每个请求一次，而不是每行一次）；
+        变量缺失时返回 None，表示本请求所有行都提取不到值。
+        """
+        if extractor.kind != "jsonpath" or not extractor.template_vars:
+            return extractor
+        path = self._render_extraction_template(extractor.argument, extra_context)
+        if not path:
+            return None
+        return extractor.bind_path(path)
+
+    def _apply_extractor(self, raw: Any, extractor: Optional[Extractor], decoded: Any = _UNDECODED) -> Any:
+        """decoded 为调用方已解析好的 JSON 树（同列共享）；缺省时现场解析 raw。"""
+        if raw is None or extractor is None:
+            return None
+        if extractor.kind in {"json", "jsonpath"}:
+            if extractor.kind == "jsonpath" and not extractor.argument:
                 return None
-            try:
-                data = json.loads(str(raw))
-            except json.JSONDecodeError:
+            data = decode_json(raw) if decoded is _UNDECODED else decoded
+            if data is INVALID_JSON:
                 return None
-            return self._extract_scalar(self._extract_json_path_value(data, path))
-        if rule.startswith("regex:"):
-            pattern = rule[6:]
-            match = re.search(pattern, str(raw))
+            if extractor.kind == "json":
+                return self._extract_scalar(data.get(extractor.argument))
+            return self._extract_scalar(self._walk_json_path(data, extractor.path_segments))
+        if extractor.kind == "regex":
+            match = extractor.pattern.search(str(raw))
             if not match:
                 return False
             if match.groups():
@@ -835,245 +1144,830 @@ class MetricFetcher:
             return True
         return self._extract_scalar(raw)
 
-    def _fetch_from_mysql(
+    @staticmethod
+    def _memo_key(request: FetchRequest) -> Tuple[Any, ...]:
+        """备忘键 = 指标 id + 列 + 已渲染的表/窗口/WHERE 与 linking 参数值。"""
+        return (request.metric_id, request.column_name) + request.group_key()
+
+    @staticmethod
+    def _copy_fetched_value(value: Any) -> Any:
+        return list(value) if isinstance(value, list) else value
+
+    def _bucket_time(self, value: Any) -> Any:
+        if isinstance(value, datetime):
+            return int(value.timestamp()) // METRIC_CACHE_TIME_BUCKET_SECONDS
+        return value
+
+    def _window_cache_key(self, request: FetchRequest) -> Tuple[Any, ...]:
+        """
+        跨请求缓存键：pipeline 版本 + 编译后的指标计划 + 机台 + 已解析 linking 参数 + 分桶后的窗口与 T。
+
+        指标计划（selection / approximate / 读取预算 / 提取规则等）整体入键，热加载改了指标配置后
+        不会命中旧形状的结果；extraction_rule 里的 {var}（如 Sx/Sy 的 {chuck_index0}）按本次上下文
+        解析后一并入键，避免不同 chuck 的请求互相命中。
+        """
+        plan = request.plan
+        template_vars = tuple(
+            (name, freeze_value(self._resolve_context_value(name, self.reference_time, request.context)))
+            for name in sorted(set(plan.extraction.template_vars))
+        )
+        params = tuple(
+            (name, self._bucket_time(value)) for name, value in sorted(request.params.items())
+        )
+        return (
+            self.pipeline_id,
+            self.pipeline.get("version", self.store.version),
+            request.metric_id,
+            self.equipment,
+            request.source,
+            request.table_name,
+            request.column_name,
+            request.time_column,
+            request.equipment_column,
+            request.omit_equipment,
+            self._bucket_time(request.time_start),
+            self._bucket_time(request.time_end),
+            self._bucket_time(self.reference_time),
+            request.where_key,
+            freeze_value(params),
+            plan.extraction_rule,
+            template_vars,
+            plan,
+            request.sample_ratio,
+            request.max_rows_to_read,
+            request.max_rows,
+            request.max_bytes,
+        )
+
+    def _memo_lookup(self, request: FetchRequest) -> Tuple[bool, Any]:
+        """
+        先查本次诊断备忘，再查跨请求窗口缓存。
+
+        命中时 source_log 记为 `<原来源>:memo` / `<原来源>:cache`，返回值为副本。
+        """
+        with self._memo_lock:
+            entry = self._memo.get(self._memo_key(request))
+        if entry is not None:
+            value, source = entry
+            self.source_log[request.metric_id] = f"{source}:memo"
+            detail_trace.info(
+                "  [取数:%s] metric=%s 命中本次诊断备忘 | source=%s",
+                request.source,
+                request.metric_id,
+                source,
+            )
+            return True, self._copy_fetched_value(value)
+
+        if request.plan.cache_ttl == 0:
+            return False, None
+        hit, cached = _metric_window_cache.get(self._window_cache_key(request))
+        if not hit:
+            return False, None
+        value, source = cached
+        with self._memo_lock:
+            self._memo[self._memo_key(request)] = (self._copy_fetched_value(value), source)
+        self.source_log[request.metric_id] = f"{source}:cache"
+        detail_trace.info(
+            "  [取数:%s] metric=%s 命中跨请求缓存 | source=%s | stats=%s",
+            request.source,
+            request.metric_id,
+            source,
+            _metric_window_cache.stats(),
+        )
+        return True, self._copy_fetched_value(value)
+
+    def _memo_store(self, request: FetchRequest, value: Any) -> Any:
+        """写入本次诊断备忘；真实数据源的结果再写入跨请求缓存（mock/none 不跨请求复用）。"""
+        source = self.source_log.get(request.metric_id, "none")
+        with self._memo_lock:
+            self._memo[self._memo_key(request)] = (self._copy_fetched_value(value), source)
+        if source.startswith("real") and value is not None:
+            _metric_window_cache.set(
+                self._window_cache_key(request),
+                (self._copy_fetched_value(value), source),
+                ttl_seconds=request.plan.cache_ttl,
+            )
+        return value
+
+    @staticmethod
+    def _selection_pushdown(plan: MetricPlan) -> Tuple[Optional[int], Optional[str]]:
+        """
+        决定 selection 能否下推到 SQL，返回 (sql_limit, sql_aggregate)。
+
+        无 extraction_rule 时列值即指标值，LIMIT / 聚合可直接交给数据库；ClickHouse regex 提取
+        已下推到 SQL 时同理。其余提取规则（jsonpath / 不兼容 RE2 的 regex）可能丢行，只能在
+        Python 侧提取后再选。
+        """
+        if plan.python_extraction:
+            return None, None
+        return plan.selection.limit, plan.selection.aggregate
+
+    def _prepare_mysql_request(
         self,
         metric_id: str,
         meta: Dict[str, Any],
         extra_context: Optional[Dict[str, Any]] = None,
-    ) -> Any:
-        table_name = _safe_identifier(meta.get("table_name", ""))
-        column_name = _safe_identifier(meta.get("column_name", ""))
-        time_column = _safe_identifier(meta.get("time_column", "wafer_product_start_time"))
-        equipment_column = _safe_identifier(meta.get("equipment_column", "equipment"))
-        omit_equipment = bool(meta.get("mysql_omit_equipment_filter"))
-        time_start, time_end = self.window_for_metric(meta)
-        linking = self._normalize_linking(meta)
+    ) -> Optional[FetchRequest]:
+        """
+        用已编译的 MetricPlan 为本次请求绑定窗口与 WHERE 参数，得到可执行的 FetchRequest。
+
+        exact_keys 模式缺少必填上下文时返回 None（调用方按「无数据」处理）。
+        """
+        plan = self._plan(metric_id, meta)
+        plan.raise_if_invalid()
+        time_start, time_end = self._window_for_plan(plan)
         resolved_context = extra_context or {}
         detail_trace.info(
             "  [取数:mysql] metric=%s table=%s column=%s mode=%s duration_days=%s extraction=%s filter=%s",
             metric_id,
-            table_name,
-            column_name,
-            linking.get("mode"),
-            self._duration_days_for_meta(meta),
+            plan.table_name,
+            plan.column_name,
+            plan.linking_mode,
+            self._duration_days_for_plan(plan),
             meta.get("extraction_rule"),
             detail_trace.preview(meta.get("filter_condition"), 240),
         )
 
-        filter_sql, filter_params = self._render_mysql_filters(
-            meta.get("filter_condition"),
+        filter_sql, filter_params = self._bind_filter_tree(plan.filter_tree, time_start, resolved_context)
+        linking_clauses, linking_params, missing_required = self._bind_link_predicates(
+            self._plan_link_predicates(plan),
             time_start,
             resolved_context,
-        )
-        linking_clauses, linking_params, missing_required = self._build_metric_filters(
-            meta,
-            time_start,
-            include_exact_keys=True,
-            include_linking_filters=True,
             placeholder_style="mysql",
-            extra_context=resolved_context,
+        )
+        if plan.linking_mode == "exact_keys" and missing_required:
+            return None
+        sql_limit, sql_aggregate = self._selection_pushdown(plan)
+        return FetchRequest(
+            metric_id=metric_id,
+            meta=meta,
+            source="mysql",
+            table_name=plan.table_name,
+            column_name=plan.column_name,
+            time_column=plan.time_column,
+            equipment_column=plan.equipment_column,
+            time_start=time_start,
+            time_end=time_end,
+            where=filter_sql + self._join_sql_clauses(linking_clauses),
+            params={**filter_params, **linking_params},
+            omit_equipment=plan.omit_equipment,
+            context=resolved_context,
+            selection=plan.selection,
+            sql_limit=sql_limit,
+            sql_aggregate=sql_aggregate,
+            probe_pattern=plan.probe_pattern,
+            window_strategy=plan.window_strategy,
+            plan=plan,
         )
 
-        try:
-            if linking["mode"] == "exact_keys":
-                if missing_required:
-                    detail_trace.warning(
-                        "  [取数:mysql] metric=%s 缺少 exact_keys 必填上下文，返回 None",
-                        metric_id,
-                    )
-                    self.source_log[metric_id] = "none"
-                    return None
-                raw_values = self._query_mysql_window(
-                    table_name,
-                    column_name,
-                    time_column,
-                    equipment_column,
-                    time_start,
-                    time_end,
-                    filter_sql + self._join_sql_clauses(linking_clauses),
-                    {**filter_params, **linking_params},
-                    omit_equipment_filter=omit_equipment,
-                )
-            else:
-                fallback_clauses, fallback_params, _ = self._build_metric_filters(
-                    meta,
-                    time_start,
-                    include_exact_keys=False,
-                    include_linking_filters=True,
-                    placeholder_style="mysql",
-                    extra_context=resolved_context,
-                )
-                raw_values = self._query_mysql_window(
-                    table_name,
-                    column_name,
-                    time_column,
-                    equipment_column,
-                    time_start,
-                    time_end,
-                    filter_sql + self._join_sql_clauses(fallback_clauses),
-                    {**filter_params, **fallback_params},
-                    omit_equipment_filter=omit_equipment,
-                )
+    def _finalize_mysql_values(
+        self,
+        request: FetchRequest,
+        raw_values: List[Any],
+        json_column: Optional[LazyJsonColumn] = None,
+    ) -> Any:
+        """
+        对 MySQL 原始列值做 extraction_rule / data_type 归一，并记录 source_log。
 
-            if not raw_values:
-                detail_trace.warning("  [取数:mysql] metric=%s 原始结果为空", metric_id)
-                self.source_log[metric_id] = "none"
-                return None
+        json / jsonpath 提取经 json_column 解析：同列的多个指标（Sx/Sy 共读 data 列）
+        共享同一份解析树。行已按距 T 由近到远排好，selection 只要最近 N 个值时，
+        凑够 N 个即停止，更远的行不再解析。
+        """
+        metric_id = request.metric_id
+        plan = request.plan
+        if not raw_values:
+            detail_trace.warning("  [取数:mysql] metric=%s 原始结果为空", metric_id)
+            self.source_log[metric_id] = "none"
+            return None
 
-            values = []
-            for raw in raw_values:
-                value = self._apply_extraction_rule(raw, meta.get("extraction_rule", ""), resolved_context)
-                value = self._apply_data_type(metric_id, value, meta)
-                if value is None or value is False:
-                    continue
-                values.append(value)
-            if not values:
-                detail_trace.warning(
-                    "  [取数:mysql] metric=%s 原始结果=%s，但提取/类型转换后为空",
-                    metric_id,
-                    len(raw_values),
-                )
-                self.source_log[metric_id] = "none"
-                return None
-            self.source_log[metric_id] = "real_mysql"
-            detail_trace.info(
-                "  [取数:mysql] metric=%s 成功 | raw_count=%s | normalized_count=%s | sample=%s",
+        values = []
+        extractor = self._bind_extractor(plan.extraction, request.context)
+        parses_json = extractor is not None and extractor.kind in {"json", "jsonpath"}
+        if parses_json and json_column is None:
+            json_column = LazyJsonColumn(raw_values)
+        wanted = None if request.selection_pushed else request.selection.limit
+        for index, raw in enumerate(raw_values):
+            if wanted is not None and len(values) >= wanted:
+                break
+            decoded = json_column.get(index) if parses_json and raw is not None else _UNDECODED
+            value = self._apply_extractor(raw, extractor, decoded)
+            value = self._coerce_value(metric_id, value, plan.coercion)
+            if value is None or value is False:
+                continue
+            values.append(value)
+        if not request.selection_pushed:
+            values = request.selection.apply(values)
+        if not values:
+            detail_trace.warning(
+                "  [取数:mysql] metric=%s 原始结果=%s，但提取/类型转换后为空",
                 metric_id,
                 len(raw_values),
-                len(values),
-                detail_trace.preview(values[:3], 160),
-            )
-            return values
-        except Exception as exc:
-            logger.error("MySQL 查询失败: metric=%s table=%s error=%s", metric_id, table_name, exc)
-            detail_trace.error(
-                "  [取数:mysql] metric=%s 异常 | table=%s | error=%s | mode=%s",
-                metric_id,
-                table_name,
-                detail_trace.preview(exc, 260),
-                METRIC_SOURCE_MODE,
             )
-            if METRIC_SOURCE_MODE in ("real", "mock_forbidden"):
-                self.source_log[metric_id] = "none"
-                return None
-            value = self._mock_value(metric_id, meta)
-            self.source_log[metric_id] = "mock"
+            self.source_log[metric_id] = "none"
+            return None
+        self.source_log[metric_id] = "real_mysql"
+        detail_trace.info(
+            "  [取数:mysql] metric=%s 成功 | raw_count=%s | normalized_count=%s | sample=%s",
+            metric_id,
+            len(raw_values),
+            len(values),
+            detail_trace.preview(values[:3], 160),
+        )
+        return values
+
+    def _mysql_fetch_failed(self, metric_id: str, meta: Dict[str, Any], table_name: str, exc: Exception) -> Any:
+        logger.error("MySQL 查询失败: metric=%s table=%s error=%s", metric_id, table_name, exc)
+        detail_trace.error(
+            "  [取数:mysql] metric=%s 异常 | table=%s | error=%s | mode=%s",
+            metric_id,
+            table_name,
+            detail_trace.preview(exc, 260),
+            METRIC_SOURCE_MODE,
+        )
+        if METRIC_SOURCE_MODE in ("real", "mock_forbidden"):
+            self.source_log[metric_id] = "none"
+            return None
+        value = self._mock_value(metric_id, meta)
+        self.source_log[metric_id] = "mock"
+        detail_trace.warning(
+            "  [取数:mysql] metric=%s 使用 mock 回退 | mock_value=%s",
+            metric_id,
+            detail_trace.preview(value, 160),
+        )
+        return [value] if value is not None else []
+
+    def _fetch_from_mysql(
+        self,
+        metric_id: str,
+        meta: Dict[str, Any],
+        extra_context: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        request = self._prepare_mysql_request(metric_id, meta, extra_context)
+        if request is None:
             detail_trace.warning(
-                "  [取数:mysql] metric=%s 使用 mock 回退 | mock_value=%s",
+                "  [取数:mysql] metric=%s 缺少 exact_keys 必填上下文，返回 None",
                 metric_id,
-                detail_trace.preview(value, 160),
             )
-            return [value] if value is not None else []
+            self.source_log[metric_id] = "none"
+            return None
+        # 单指标即单成员组：selection 下推、seek 合并、progressive 窗口与备忘都只在 _fetch_group 一处实现
+        return self._fetch_group([request])[metric_id]
 
-    def _fetch_from_clickhouse(
+    def _prepare_clickhouse_request(
         self,
         metric_id: str,
         meta: Dict[str, Any],
         extra_context: Optional[Dict[str, Any]] = None,
-    ) -> Any:
-        time_start, time_end = self.window_for_metric(meta)
-        linking = self._normalize_linking(meta)
+        pushdown_parents: FrozenSet[str] = frozenset(),
+    ) -> Optional[FetchRequest]:
+        """
+        用已编译的 MetricPlan 为本次请求绑定窗口与 extra_filters 参数，得到可执行的 FetchRequest。
+
+        exact_keys 模式缺少必填上下文时返回 None。pushdown_parents 里的父指标不从上下文取值，
+        其 `in` 谓词渲染成父指标窗口子查询（见 _plan_join_pushdown）。
+        """
+        plan = self._plan(metric_id, meta)
+        plan.raise_if_invalid()
+        time_start, time_end = self._window_for_plan(plan)
         resolved_context = extra_context or {}
         detail_trace.info(
             "  [取数:clickhouse] metric=%s table=%s column=%s mode=%s duration_days=%s extraction=%s",
             metric_id,
-            meta.get("table_name"),
-            meta.get("column_name"),
-            linking.get("mode"),
-            self._duration_days_for_meta(meta),
+            plan.table_name,
+            plan.column_name,
+            plan.linking_mode,
+            self._duration_days_for_plan(plan),
             meta.get("extraction_rule"),
         )
-        try:
-            from app.ods.clickhouse_ods import ClickHouseODS
-
-            exact_filters, exact_filter_params, missing_required = self._build_metric_filters(
-                meta,
-                time_start,
-                include_exact_keys=True,
-                include_linking_filters=True,
-                placeholder_style="clickhouse",
-                extra_context=resolved_context,
+        predicates = self._plan_link_predicates(plan)
+        pushed = tuple(pred for pred in predicates if pred.operator == "in" and pred.source in pushdown_parents)
+        filters, filter_params, missing_required = self._bind_link_predicates(
+            tuple(pred for pred in predicates if pred not in pushed),
+            time_start,
+            resolved_context,
+            placeholder_style="clickhouse",
+        )
+        if plan.linking_mode == "exact_keys" and missing_required:
+            return None
+        for index, predicate in enumerate(pushed):
+            subquery = self._linking_subquery(predicate.source, f"dep{index}", resolved_context)
+            if subquery is None:
+                return None
+            sub_sql, sub_params = subquery
+            filters.append(predicate.render_subquery(sub_sql))
+            filter_params.update(sub_params)
+            detail_trace.info(
+                "  [取数:下推] metric=%s 的 %s IN 改为子查询 | 父指标=%s",
+                metric_id,
+                predicate.target,
+                predicate.source,
             )
+        sql_limit, sql_aggregate = self._selection_pushdown(plan)
+        return FetchRequest(
+            metric_id=metric_id,
+            meta=meta,
+            source="clickhouse",
+            table_name=plan.table_name,
+            column_name=plan.column_name,
+            time_column=plan.time_column,
+            equipment_column=plan.equipment_column,
+            time_start=time_start,
+            time_end=time_end,
+            where=tuple(filters),
+            params=filter_params,
+            context=resolved_context,
+            selection=plan.selection,
+            sql_limit=sql_limit,
+            sql_aggregate=sql_aggregate,
+            probe_pattern=plan.probe_pattern,
+            extract_pattern=plan.sql_extract_pattern,
+            time_column_type=plan.time_column_type,
+            window_strategy=plan.window_strategy,
+            plan=plan,
+            **self._approximate_settings(plan),
+            **self._read_budget(plan),
+        )
 
-            if linking["mode"] == "exact_keys":
-                if missing_required:
-                    detail_trace.warning(
-                        "  [取数:clickhouse] metric=%s 缺少 exact_keys 必填上下文，返回 None",
-                        metric_id,
-                    )
-                    self.source_log[metric_id] = "none"
-                    return None
-                values = ClickHouseODS.query_metric_in_window(
-                    table_name=meta["table_name"],
-                    column_name=meta["column_name"],
-                    equipment=self.equipment,
-                    time_start=time_start,
-                    time_end=time_end,
-                    reference_time=self.reference_time,
-                    extraction_rule=meta.get("extraction_rule"),
-                    time_column=meta.get("time_column", "time"),
-                    equipment_column=meta.get("equipment_column", "equipment"),
-                    extra_filters=exact_filters,
-                    extra_filter_params=exact_filter_params,
-                )
-            else:
-                fallback_filters, fallback_filter_params, _ = self._build_metric_filters(
-                    meta,
-                    time_start,
-                    include_exact_keys=False,
-                    include_linking_filters=True,
-                    placeholder_style="clickhouse",
-                    extra_context=resolved_context,
-                )
-                values = ClickHouseODS.query_metric_in_window(
-                    table_name=meta["table_name"],
-                    column_name=meta["column_name"],
-                    equipment=self.equipment,
-                    time_start=time_start,
-                    time_end=time_end,
-                    reference_time=self.reference_time,
-                    extraction_rule=meta.get("extraction_rule"),
-                    time_column=meta.get("time_column", "time"),
-                    equipment_column=meta.get("equipment_column", "equipment"),
-                    extra_filters=fallback_filters,
-                    extra_filter_params=fallback_filter_params,
-                )
+    @staticmethod
+    def _read_budget(plan: MetricPlan) -> Dict[str, Any]:
+        """按块读取的行数 / 字节预算，只对需要 Python 侧提取（整窗原始行回传）的指标生效。"""
+        if not plan.python_extraction:
+            return {}
+        return {
+            "max_rows": plan.max_rows or CH_WINDOW_MAX_ROWS or None,
+            "max_bytes": plan.max_bytes or CH_WINDOW_MAX_BYTES or None,
+        }
 
-            normalized = []
-            for value in values:
-                value = self._apply_data_type(metric_id, value, meta)
-                if value is None or value is False:
-                    continue
-                normalized.append(value)
-            self.source_log[metric_id] = "real_clickhouse" if normalized else "none"
-            detail_trace.info(
-                "  [取数:clickhouse] metric=%s 完成 | raw_count=%s | normalized_count=%s | source=%s | sample=%s",
+    @staticmethod
+    def _approximate_settings(plan: MetricPlan) -> Dict[str, Any]:
+        """approximate 指标的 SAMPLE 比例与读取行数上限（未声明的取环境变量默认值）。"""
+        approximate = plan.approximate
+        if approximate is None:
+            return {}
+        sample = approximate.sample if approximate.sample is not None else CH_APPROX_SAMPLE_RATIO
+        max_rows = approximate.max_rows_to_read
+        return {
+            "sample_ratio": sample if 0 < sample < 1 else None,
+            "max_rows_to_read": max_rows if max_rows is not None else CH_APPROX_MAX_ROWS_TO_READ,
+        }
+
+    def _linking_subquery(
+        self,
+        parent_id: str,
+        param_prefix: str,
+        extra_context: Dict[str, Any],
+    ) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """父指标窗口查询渲染成子查询；父指标 exact_keys 缺上下文时返回 None（不下推）。"""
+        from app.ods.clickhouse_ods import ClickHouseODS
+
+        parent = self._plan(parent_id, self.rule_loader.get_metric_meta(parent_id) or {})
+        parent.raise_if_invalid()
+        time_start, time_end = self._window_for_plan(parent)
+        filters, params, missing_required = self._bind_link_predicates(
+            self._plan_link_predicates(parent),
+            time_start,
+            extra_context,
+            placeholder_style="clickhouse",
+            param_prefix=f"{param_prefix}_link",
+        )
+        if parent.linking_mode == "exact_keys" and missing_required:
+            return None
+        return ClickHouseODS.window_values_subquery(
+            parent.table_name,
+            parent.column_name,
+            self.equipment,
+            time_start,
+            time_end,
+            time_column=parent.time_column,
+            equipment_column=parent.equipment_column,
+            extra_filters=filters,
+            extra_filter_params=params,
+            time_column_type=parent.time_column_type,
+            param_prefix=param_prefix,
+        )
+
+    def _finalize_clickhouse_values(self, request: FetchRequest, values: List[Any]) -> Any:
+        """对 ClickHouse 提取后的值做 data_type 归一，并记录 source_log。"""
+        normalized = self._normalize_clickhouse_values(request, values)
+        if not request.selection_pushed:
+            normalized = request.selection.apply(normalized)
+        return self._record_clickhouse_values(request, len(values or []), normalized)
+
+    def _normalize_clickhouse_values(self, request: FetchRequest, values: List[Any]) -> List[Any]:
+        normalized = []
+        for value in values:
+            value = self._coerce_value(request.metric_id, value, request.plan.coercion)
+            if value is None or value is False:
+                continue
+            if isinstance(value, float) and math.isnan(value):
+                # ClickHouse 对空集合 avg 返回 nan
+                continue
+            normalized.append(value)
+        return normalized
+
+    def _finalize_clickhouse_array(self, request: FetchRequest, column: Any) -> Any:
+        """
+        列式结果的向量化归一：去 None/NaN、按 data_type 转换、selection 都在 ndarray 上完成，
+        出口处 tolist() 交给 actions（与逐行路径产出同样的 Python 标量列表）。
+        str 或未知 data_type 无法向量化，转成 float 列表后走逐值归一。
+        """
+        numbers = float_column(column)
+        coerced = coerce_float_column(numbers, request.plan.coercion.data_type)
+        if coerced is None:
+            return self._finalize_clickhouse_values(request, numbers.tolist())
+        if not request.selection_pushed:
+            coerced = select_column(coerced, request.selection.limit, request.selection.aggregate)
+        return self._record_clickhouse_values(request, len(column), coerced.tolist())
+
+    def _record_clickhouse_values(self, request: FetchRequest, raw_count: int, normalized: List[Any]) -> Any:
+        metric_id = request.metric_id
+        source = "real_clickhouse:approx" if self._read_was_approximate(request) else "real_clickhouse"
+        self.source_log[metric_id] = source if normalized else "none"
+        detail_trace.info(
+            "  [取数:clickhouse] metric=%s 完成 | raw_count=%s | normalized_count=%s | source=%s | sample=%s",
+            metric_id,
+            raw_count,
+            len(normalized),
+            self.source_log[metric_id],
+            detail_trace.preview(normalized[:3], 160),
+        )
+        return normalized or None
+
+    @staticmethod
+    def _read_was_approximate(request: FetchRequest) -> bool:
+        """
+        本次读取是否真的近似：SAMPLE 实际生效，或未抽样只限读取行数（sample=1）。
+        表不支持 SAMPLE 时 ODS 去掉抽样与行数上限按精确查询重试，不再标记近似。
+        """
+        if request.sample_ratio is not None:
+            from app.ods.clickhouse_ods import sampling_supported
+
+            return sampling_supported(request.table_name)
+        return request.max_rows_to_read is not None
+
+    def _clickhouse_fetch_failed(self, metric_id: str, meta: Dict[str, Any], exc: Exception) -> Any:
+        if METRIC_SOURCE_MODE in ("real", "mock_forbidden"):
+            logger.error("ClickHouse 查询失败: metric=%s error=%s", metric_id, exc)
+            detail_trace.error(
+                "  [取数:clickhouse] metric=%s 异常且禁止 mock | error=%s",
                 metric_id,
-                len(values or []),
-                len(normalized),
-                self.source_log[metric_id],
-                detail_trace.preview(normalized[:3], 160),
+                detail_trace.preview(exc, 260),
             )
-            return normalized or None
-        except Exception as exc:
-            if METRIC_SOURCE_MODE in ("real", "mock_forbidden"):
-                logger.error("ClickHouse 查询失败: metric=%s error=%s", metric_id, exc)
-                detail_trace.error(
-                    "  [取数:clickhouse] metric=%s 异常且禁止 mock | error=%s",
+            self.source_log[metric_id] = "none"
+            return None
+        value = self._mock_value(metric_id, meta)
+        self.source_log[metric_id] = "mock"
+        detail_trace.warning(
+            "  [取数:clickhouse] metric=%s 异常后使用 mock | error=%s | mock_value=%s",
+            metric_id,
+            detail_trace.preview(exc, 220),
+            detail_trace.preview(value, 160),
+        )
+        return [value] if value is not None else []
+
+    def _fetch_from_clickhouse(
+        self,
+        metric_id: str,
+        meta: Dict[str, Any],
+        extra_context: Optional[Dict[str, Any]] = None,
+    ) -> Any:
+        request: Optional[FetchRequest] = None
+        try:
+            request = self._prepare_clickhouse_request(metric_id, meta, extra_context)
+            if request is None:
+                detail_trace.warning(
+                    "  [取数:clickhouse] metric=%s 缺少 exact_keys 必填上下文，返回 None",
                     metric_id,
-                    detail_trace.preview(exc, 260),
                 )
                 self.source_log[metric_id] = "none"
                 return None
-            value = self._mock_value(metric_id, meta)
-            self.source_log[metric_id] = "mock"
+            return self._fetch_group([request])[metric_id]
+        except Exception as exc:
+            value = self._clickhouse_fetch_failed(metric_id, meta, exc)
+            if request is not None:
+                self._memo_store(request, value)
+            return value
+
+    def _prepare_fetch_request(
+        self,
+        metric_id: str,
+        extra_context: Dict[str, Any],
+        pushdown_parents: FrozenSet[str] = frozenset(),
+    ) -> Optional[FetchRequest]:
+        """
+        为取数计划器渲染 DB 指标的请求；非 DB 指标、禁用、缺上下文或渲染异常返回 None，
+        这些指标仍走 _fetch_one 单独处理（保持原有的 none/mock 语义与日志）。
+        """
+        meta = self.rule_loader.get_metric_meta(metric_id)
+        if not meta or meta.get("enabled") is False:
+            return None
+        source_kind = self._db_source_kind(meta)
+        try:
+            if source_kind == "mysql_nearest_row":
+                return self._prepare_mysql_request(metric_id, meta, extra_context)
+            if source_kind == "clickhouse_window":
+                return self._prepare_clickhouse_request(metric_id, meta, extra_context, pushdown_parents)
+        except Exception as exc:
+            logger.debug("指标 %s 取数计划渲染失败，改为单独取数: %s", metric_id, exc)
+        return None
+
+    def _fetch_group(self, requests: List[FetchRequest]) -> Dict[str, Any]:
+        """
+        对同签名的一组请求只发一条多列 SELECT，再按列拆回各指标。
+
+        本次诊断已取过的指标直接从备忘返回，不进入 SELECT。整组查询失败时每个指标
+        按各自的降级策略（mock/none）处理；单指标提取失败不影响同组其它指标。
+        """
+        out: Dict[str, Any] = {}
+        pending: List[FetchRequest] = []
+        for req in requests:
+            hit, value = self._memo_lookup(req)
+            if hit:
+                out[req.metric_id] = value
+            else:
+                pending.append(req)
+        if not pending:
+            return out
+        requests = pending
+        head = requests[0]
+        columns = group_columns(requests)
+        if len(requests) > 1:
+            detail_trace.info(
+                "  [取数:合并] source=%s table=%s metrics=%s columns=%s",
+                head.source,
+                head.table_name,
+                ",".join(req.metric_id for req in requests),
+                ",".join(columns),
+            )
+        # 无需 Python 侧提取的 ClickHouse 指标列值即指标值：按列读成 ndarray，向量化归一
+        columnar = head.source == "clickhouse" and head.probe_pattern is None and not any(
+            req.plan.python_extraction for req in requests
+        )
+        # 需 Python 侧提取的 ClickHouse 组按块读取、逐块提取，selection 满足或预算用完即停
+        streamed = head.source == "clickhouse" and head.probe_pattern is None and not columnar
+        if head.window_strategy == "progressive":
+            window_starts = self._progressive_window_starts(head.time_start, head.time_end)
+        else:
+            window_starts = [head.time_start]
+        for step, time_start in enumerate(window_starts, start=1):
+            try:
+                if streamed:
+                    values, failed = self._stream_group_values(requests, columns, time_start)
+                else:
+                    rows = self._query_group_rows(head, columns, time_start, columnar)
+            except Exception as exc:
+                for req in requests:
+                    out[req.metric_id] = self._memo_store(req, self._fetch_failed(req, exc))
+                return out
+            if not streamed:
+                values, failed = self._finalize_group_rows(requests, columns, rows, columnar)
+            if step == len(window_starts) or all(
+                req.metric_id in failed or self._selection_satisfied(req, values[req.metric_id])
+                for req in requests
+            ):
+                break
+        if len(window_starts) > 1:
+            self._record_progressive_window(requests, head.time_end - time_start, step, len(window_starts))
+        for req in requests:
+            out[req.metric_id] = self._memo_store(req, values[req.metric_id])
+        return out
+
+    def _query_group_rows(
+        self,
+        head: FetchRequest,
+        columns: List[str],
+        time_start: datetime,
+        columnar: bool,
+    ) -> List[Any]:
+        if head.source == "mysql":
+            return self._query_mysql_window_rows(
+                head.table_name,
+                columns,
+                head.time_column,
+                head.equipment_column,
+                time_start,
+                head.time_end,
+                head.where,
+                head.params,
+                omit_equipment_filter=head.omit_equipment,
+                limit=head.sql_limit,
+                aggregate=head.sql_aggregate,
+                regex_probe=head.probe_pattern,
+            )
+        from app.ods.clickhouse_ods import ClickHouseODS
+
+        return ClickHouseODS.query_rows_in_window(
+            head.table_name,
+            columns,
+            self.equipment,
+            time_start,
+            head.time_end,
+            self.reference_time,
+            time_column=head.time_column,
+            equipment_column=head.equipment_column,
+            extra_filters=list(head.where),
+            extra_filter_params=head.params,
+            limit=head.sql_limit,
+            aggregate=head.sql_aggregate,
+            match_pattern=head.probe_pattern,
+            time_column_type=head.time_column_type,
+            columnar=columnar,
+            extract_pattern=head.extract_pattern,
+            sample_ratio=head.sample_ratio,
+            max_rows_to_read=head.max_rows_to_read,
+        )
+
+    def _stream_group_values(
+        self,
+        requests: List[FetchRequest],
+        columns: List[str],
+        time_start: datetime,
+    ) -> Tuple[Dict[str, Any], set]:
+        """
+        按块读取 ClickHouse 组查询并逐块提取 / 归一（返回值同 _finalize_group_rows）。
+
+        行按距 T 由近到远到达，nearest / nearest_n 的指标取够条数后即可停止读取；
+        行数 / 字节预算用完时按已读部分出结果，source_log 追加 `:truncated`。
+        """
+        from app.ods.clickhouse_ods import ClickHouseODS
+
+        head = requests[0]
+        stream = ClickHouseODS.stream_rows_in_window(
+            head.table_name,
+            columns,
+            self.equipment,
+            time_start,
+            head.time_end,
+            self.reference_time,
+            time_column=head.time_column,
+            equipment_column=head.equipment_column,
+            extra_filters=list(head.where),
+            extra_filter_params=head.params,
+            limit=head.sql_limit,
+            aggregate=head.sql_aggregate,
+            time_column_type=head.time_column_type,
+            max_rows=head.max_rows,
+            max_bytes=head.max_bytes,
+        )
+        normalized: Dict[str, List[Any]] = {req.metric_id: [] for req in requests}
+        errors: Dict[str, Exception] = {}
+        indexes = {req.metric_id: columns.index(req.column_name) for req in requests}
+        try:
+            for block in stream:
+                for req in requests:
+                    if req.metric_id in errors:
+                        continue
+                    index = indexes[req.metric_id]
+                    try:
+                        extracted = ClickHouseODS.extract_window_values(
+                            [row[index] for row in block], req.meta.get("extraction_rule")
+                        )
+                        normalized[req.metric_id].extend(self._normalize_clickhouse_values(req, extracted))
+                    except Exception as exc:
+                        errors[req.metric_id] = exc
+                if all(
+                    req.metric_id in errors or self._selection_satisfied(req, normalized[req.metric_id])
+                    for req in requests
+                ):
+                    break
+        finally:
+            stream.close()
+
+        values: Dict[str, Any] = {}
+        for req in requests:
+            if req.metric_id in errors:
+                values[req.metric_id] = self._fetch_failed(req, errors[req.metric_id])
+                continue
+            selected = normalized[req.metric_id]
+            if not req.selection_pushed:
+                selected = req.selection.apply(selected)
+            values[req.metric_id] = self._record_clickhouse_values(req, stream.rows_read, selected)
+            if stream.truncated:
+                self.source_log[req.metric_id] += ":truncated"
+        if stream.truncated:
             detail_trace.warning(
-                "  [取数:clickhouse] metric=%s 异常后使用 mock | error=%s | mock_value=%s",
-                metric_id,
-                detail_trace.preview(exc, 220),
-                detail_trace.preview(value, 160),
+                "  [取数:预算] metrics=%s table=%s 读取预算用完 | 行=%s/%s | 字节≈%s/%s",
+                ",".join(req.metric_id for req in requests),
+                head.table_name,
+                stream.rows_read,
+                head.max_rows,
+                stream.bytes_read,
+                head.max_bytes,
             )
-            return [value] if value is not None else []
+        return values, set(errors)
+
+    def _finalize_group_rows(
+        self,
+        requests: List[FetchRequest],
+        columns: List[str],
+        rows: List[Any],
+        columnar: bool,
+    ) -> Tuple[Dict[str, Any], set]:
+        """按列拆回各指标并归一；返回 (指标值, 提取失败已降级的指标集合)。"""
+        values: Dict[str, Any] = {}
+        failed: set = set()
+        if columnar:
+            for req in requests:
+                try:
+                    values[req.metric_id] = self._finalize_clickhouse_array(req, rows[columns.index(req.column_name)])
+                except Exception as exc:
+                    values[req.metric_id] = self._fetch_failed(req, exc)
+                    failed.add(req.metric_id)
+            return values, failed
+
+        column_values: Dict[str, List[Any]] = {}
+        json_columns: Dict[str, LazyJsonColumn] = {}
+        for req in requests:
+            if req.column_name not in column_values:
+                index = columns.index(req.column_name)
+                column_values[req.column_name] = [row[index] for row in rows]
+                json_columns[req.column_name] = LazyJsonColumn(column_values[req.column_name])
+            raw_values = column_values[req.column_name]
+            try:
+                if req.probe_pattern is not None:
+                    values[req.metric_id] = self._finalize_probe(req, bool(rows))
+                elif req.source == "mysql":
+                    values[req.metric_id] = self._finalize_mysql_values(
+                        req, raw_values, json_columns[req.column_name]
+                    )
+                else:
+                    from app.ods.clickhouse_ods import ClickHouseODS
+
+                    extracted = ClickHouseODS.extract_window_values(raw_values, req.meta.get("extraction_rule"))
+                    values[req.metric_id] = self._finalize_clickhouse_values(req, extracted)
+            except Exception as exc:
+                values[req.metric_id] = self._fetch_failed(req, exc)
+                failed.add(req.metric_id)
+        return values, failed
+
+    def _progressive_window_starts(self, time_start: datetime, time_end: datetime) -> List[datetime]:
+        """
+        progressive 窗口的各级起点：[T-1h, T-4h, T-16h, ...]，末级为指标 duration 的完整窗口。
+
+        每级都查 [起点, T] 全段而不是增量切片，结果与同宽度的 full 查询完全一致。
+        """
+        full = time_end - time_start
+        width = timedelta(hours=PROGRESSIVE_WINDOW_INITIAL_HOURS)
+        starts: List[datetime] = []
+        while width < full:
+            starts.append(time_end - width)
+            width *= PROGRESSIVE_WINDOW_FACTOR
+        starts.append(time_start)
+        return starts
+
+    @staticmethod
+    def _selection_satisfied(request: FetchRequest, value: Any) -> bool:
+        """
+        当前窗口的结果是否已满足 selection：nearest / nearest_n 取够条数、存在性探测已命中。
+
+        all / aggregate 依赖整个窗口，永远不算满足；这类指标的 progressive 在编译取数计划时
+        已退回 full（见 metric_plan._progressive_effective），不会进入逐级放宽。
+        """
+        if request.probe_pattern is not None:
+            return bool(value)
+        limit = request.selection.limit
+        return limit is not None and len(value or []) >= limit
+
+    def _record_progressive_window(
+        self,
+        requests: List[FetchRequest],
+        width: timedelta,
+        step: int,
+        total_steps: int,
+    ) -> None:
+        """source_log 追加 `:progressive@<最终窗口小时>h`，便于统计放宽发生的频率与幅度。"""
+        hours = width.total_seconds() / 3600
+        label = f"{hours:g}h"
+        for req in requests:
+            source = self.source_log.get(req.metric_id, "none")
+            self.source_log[req.metric_id] = f"{source}:progressive@{label}"
+        detail_trace.info(
+            "  [取数:渐进窗口] metrics=%s table=%s 最终窗口=%s 级数=%s/%s",
+            ",".join(req.metric_id for req in requests),
+            requests[0].table_name,
+            label,
+            step,
+            total_steps,
+        )
+
+    def _finalize_probe(self, request: FetchRequest, exists: bool) -> Any:
+        """存在性探测结果：命中记为 [True]，与「逐行 regex 后任一为真」口径一致；未命中为 None。"""
+        source = f"real_{request.source}"
+        self.source_log[request.metric_id] = source if exists else "none"
+        detail_trace.info(
+            "  [取数:探测] metric=%s source=%s table=%s pattern=%s 命中=%s",
+            request.metric_id,
+            request.source,
+            request.table_name,
+            detail_trace.preview(request.probe_pattern, 120),
+            exists,
+        )
+        return [True] if exists else None
+
+    def _fetch_failed(self, request: FetchRequest, exc: Exception) -> Any:
+        if request.source == "mysql":
+            return self._mysql_fetch_failed(request.metric_id, request.meta, request.table_name, exc)
+        return self._clickhouse_fetch_failed(request.metric_id, request.meta, exc)
 
     def _mock_value(self, metric_id: str, meta: Dict[str, Any]) -> Any:
         """
@@ -0,0 +1,685 @@
+"""
+指标取数计划（MetricPlan）：pipeline 加载时把每个 metric meta 编译成不可变对象。
+
+过去 MetricFetcher 每次请求都要重新归一 linking、用 _safe_identifier 校验标识符、
+递归解析 filter_condition、重新解读 extraction_rule / duration / data_type。
+这些都只取决于配置本身，DiagnosisConfigStore._normalize_structured_pipeline 现在
+调用 compile_metric_plans 一次性编译，放进 bundle["metric_plans"]；
+取数时只剩「按上下文绑定参数」这一步。
+
+编译失败（如非法标识符）不会阻断 pipeline 加载：错误记录在 MetricPlan.error，
+取数时再抛出，与编译前「该指标取数失败、其余照常」的行为一致。
+"""
+import logging
+import re
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+from app.engine.fetch_planner import RowSelection, parse_selection
+from app.utils.clickhouse_types import parse_time_column_type
+
+logger = logging.getLogger(__name__)
+
+DB_SOURCE_KINDS = {"mysql_nearest_row", "clickhouse_window"}
+SOURCE_KIND_ALIASES = {"mysql": "mysql_nearest_row", "clickhouse": "clickhouse_window"}
+LINKING_OPERATORS = {"=", "==", "!=", ">", ">=", "<", "<=", "contains", "prefix", "in"}
+# linking 条目可选的 type 声明：声明后 SQL 按列原生类型比较（不再 toString / CAST），可走索引
+LINKING_VALUE_TYPES = {"string", "int", "float"}
+# 窗口策略：full = 一次查满 duration；progressive = 从 T 前 1h 起几何放宽，selection 满足即停
+WINDOW_STRATEGIES = {"full", "progressive"}
+# 近似取数只对窗口聚合有意义（SAMPLE / 读取行数上限会改变 LIMIT、nearest 的取行结果）；
+# 且只有抽样无偏的聚合：avg 直接可用，count 按 _sample_factor 放大。min / max 在样本上偏向中间值，无法校正
+APPROXIMATE_AGGREGATES = {"avg", "count"}
+
+_SAFE_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_\.]*")
+_FILTER_COMPARISON_RE = re.compile(r"([A-Za-z_]\w*)\s*(==|=|>=|<=|!=|<>|>|<)\s*(.+)")
+_TEMPLATE_VAR_RE = re.compile(r"\{(\w+)\}")
+# ClickHouse match()（RE2）与 MySQL 8 REGEXP（ICU）不支持或语义不同的 Python 正则写法：
+# 环视、反向引用、\Z、原子组、条件分组、占有量词
+_SQL_REGEX_UNSUPPORTED_RE = re.compile(r"\(\?<?[=!]|\(\?P=|\(\?>|\(\?\(|\\[1-9]|\\Z|[*+?}]\+")
+
+
+def safe_identifier(name: str) -> str:
+    if not _SAFE_IDENTIFIER_RE.fullmatch(str(name)):
+        raise ValueError(f"非法 SQL 标识符: {name}")
+    return str(name)
+
+
+def normalize_source_kind(raw: Any) -> str:
+    source_kind = str(raw or "").strip().lower()
+    return SOURCE_KIND_ALIASES.get(source_kind, source_kind)
+
+
+# ── linking 谓词 ────────────────────────────────────────────────────────────
+
+
+def _link_value_to_string(value: Any) -> str:
+    # 上游指标取回的整数 id 常是 float（11.0），按字符串比较时去掉多余的 .0
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+_LINK_VALUE_CASTERS: Dict[str, Callable[[Any], Any]] = {
+    "string": _link_value_to_string,
+    "int": lambda value: int(float(value)),
+    "float": float,
+}
+
+
+def escape_like_prefix(value: Any) -> str:
+    """prefix 操作符的 LIKE 模式：转义 \\ % _ 后追加 %（MySQL 与 ClickHouse 默认转义符都是反斜杠）。"""
+    text_value = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return text_value + "%"
+
+
+@dataclass(frozen=True)
+class LinkPredicate:
+    """
+    一条 linking.keys / linking.filters 谓词；SQL 片段按方言预渲染，只留参数占位 {ph}/{phs}。
+
+    value_type 为空时 ClickHouse 侧统一 toString 比较（兼容 String/Int 混用的表）；
+    声明 type 后参数先在 Python 侧转成该类型，SQL 直接比较原生列，可命中主键 / 索引。
+    """
+
+    target: str
+    operator: str  # 归一后的 SQL 操作符（== → =）
+    source: Optional[str]
+    value: Any
+    mysql_template: str
+    clickhouse_template: str
+    value_type: Optional[str] = None
+
+    def resolve(self, resolver: Callable[[str], Any]) -> Any:
+        if self.source is not None:
+            return resolver(self.source)
+        return self.value
+
+    def _cast(self, value: Any) -> Any:
+        if self.operator == "prefix":
+            return escape_like_prefix(_link_value_to_string(value))
+        if self.value_type is None:
+            return value
+        return _LINK_VALUE_CASTERS[self.value_type](value)
+
+    def render(self, param_name: str, value: Any, placeholder_style: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        """返回 (SQL 片段, 参数)；in 的值为空或值无法转成声明的 type 时片段为 None（调用方按缺失处理）。"""
+        template = self.clickhouse_template if placeholder_style == "clickhouse" else self.mysql_template
+
+        def _placeholder(name: str) -> str:
+            return f":{name}" if placeholder_style == "mysql" else f"%({name})s"
+
+        try:
+            if self.operator == "in":
+                values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+                values = [self._cast(sub_value) for sub_value in values]
+            else:
+                value = self._cast(value)
+        except (TypeError, ValueError):
+            logger.warning("linking %s 的值 %r 无法转成 type=%s，按缺失处理", self.target, value, self.value_type)
+            return None, {}
+
+        if self.operator == "in":
+            if not values:
+                return None, {}
+            params: Dict[str, Any] = {}
+            placeholders: List[str] = []
+            for sub_index, sub_value in enumerate(values):
+                item_param_name = f"{param_name}_{sub_index}"
+                placeholders.append(_placeholder(item_param_name))
+                params[item_param_name] = sub_value
+            if placeholder_style == "clickhouse" and self.value_type is None:
+                phs = ", ".join(f"toString({ph})" for ph in placeholders)
+            else:
+                phs = ", ".join(placeholders)
+            return template.format(phs=phs), params
+        return template.format(ph=_placeholder(param_name)), {param_name: value}
+
+    def render_subquery(self, subquery: str) -> str:
+        """in 谓词的值来自另一条 ClickHouse 查询时，直接嵌入子查询：列 IN (SELECT ...)。"""
+        if self.value_type in (None, "string"):
+            return self.clickhouse_template.format(phs=subquery)
+        # 子查询按 toString 输出，数值类型的列同样转字符串比较
+        return f"toString({self.target}) IN ({subquery})"
+
+
+def compile_link_predicate(item: Any) -> Optional[LinkPredicate]:
+    """把 linking 条目编译成 LinkPredicate；target 为空或条目非 dict 时返回 None（忽略）。"""
+    if not isinstance(item, dict):
+        return None
+    target = str(item.get("target", "")).strip()
+    if not target:
+        return None
+    operator = str(item.get("operator", "=")).strip()
+    if operator not in LINKING_OPERATORS:
+        raise ValueError(f"linking.operator 不支持: {operator}")
+    value_type = str(item.get("type") or "").strip().lower() or None
+    if value_type is not None and value_type not in LINKING_VALUE_TYPES:
+        raise ValueError(f"linking.type 仅支持 {sorted(LINKING_VALUE_TYPES)}，实际: {item.get('type')!r}")
+    if value_type not in (None, "string") and operator in {"contains", "prefix"}:
+        raise ValueError(f"linking.operator={operator} 只能用于字符串列，实际 type={value_type}")
+    sql_operator = "=" if operator == "==" else operator
+    ident = safe_identifier(target)
+    typed = value_type is not None
+    if sql_operator == "contains":
+        if typed:
+            mysql_template = f"INSTR({ident}, {{ph}}) > 0"
+            clickhouse_template = f"positionUTF8({ident}, {{ph}}) > 0"
+        else:
+            mysql_template = f"INSTR(CAST({ident} AS CHAR), CAST({{ph}} AS CHAR)) > 0"
+            clickhouse_template = f"positionUTF8(toString({ident}), toString({{ph}})) > 0"
+    elif sql_operator == "prefix":
+        # LIKE 'xxx%' 可走 MySQL 索引范围扫描与 ClickHouse 主键分析
+        mysql_template = f"{ident} LIKE {{ph}}"
+        clickhouse_template = f"{ident} LIKE {{ph}}" if typed else f"toString({ident}) LIKE {{ph}}"
+    elif sql_operator == "in":
+        mysql_template = f"{ident} IN ({{phs}})"
+        clickhouse_template = f"{ident} IN ({{phs}})" if typed else f"toString({ident}) IN ({{phs}})"
+    else:
+        mysql_template = f"{ident} {sql_operator} {{ph}}"
+        if sql_operator in {"=", "!="} and not typed:
+            # ClickHouse 本地替身与内网参考在部分 linking 列上存在 String/Int 混用，
+            # 未声明 type 时统一按字符串比较，避免类型不一致导致联调失败。
+            clickhouse_template = f"toString({ident}) {sql_operator} toString({{ph}})"
+        else:
+            clickhouse_template = mysql_template
+    return LinkPredicate(
+        target=ident,
+        operator=sql_operator,
+        source=str(item.get("source", "")).strip() if "source" in item else None,
+        value=item.get("value"),
+        mysql_template=mysql_template,
+        clickhouse_template=clickhouse_template,
+        value_type=value_type,
+    )
+
+
+def compile_link_predicates(items: Any) -> Tuple[LinkPredicate, ...]:
+    compiled = (compile_link_predicate(item) for item in (items or []))
+    return tuple(pred for pred in compiled if pred is not None)
+
+
+# ── filter_condition ────────────────────────────────────────────────────────
+
+
+@dataclass(frozen=True)
+class FilterNode:
+    """filter_condition 的解析树：or / and 组合节点，或 cmp 叶子（列 操作符 :filter_N）。"""
+
+    kind: str
+    children: Tuple["FilterNode", ...] = ()
+    column: str = ""
+    operator: str = ""
+    raw_value: str = ""
+    context_var: Optional[str] = None  # raw_value 为 {var} 占位符时的变量名
+    param_index: int = 0
+
+
+def strip_outer_parentheses(expr: str) -> str:
+    text_expr = expr.strip()
+    while text_expr.startswith("(") and text_expr.endswith(")"):
+        depth = 0
+        closed_at_end = True
+        for idx, ch in enumerate(text_expr):
+            if ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth -= 1
+                if depth == 0 and idx != len(text_expr) - 1:
+                    closed_at_end = False
+                    break
+        if depth != 0 or not closed_at_end:
+            break
+        text_expr = text_expr[1:-1].strip()
+    return text_expr
+
+
+def split_top_level_boolean(expr: str, op: str) -> List[str]:
+    parts: List[str] = []
+    buf: List[str] = []
+    depth = 0
+    i = 0
+    op_text = f" {op} "
+    upper_expr = expr.upper()
+    while i < len(expr):
+        ch = expr[i]
+        if ch == "(":
+            depth += 1
+            buf.append(ch)
+            i += 1
+            continue
+        if ch == ")":
+            depth = max(0, depth - 1)
+            buf.append(ch)
+            i += 1
+            continue
+        if depth == 0 and upper_expr[i:i + len(op_text)] == op_text:
+            part = "".join(buf).strip()
+            if part:
+                parts.append(part)
+            buf = []
+            i += len(op_text)
+            continue
+        buf.append(ch)
+        i += 1
+    last = "".join(buf).strip()
+    if last:
+        parts.append(last)
+    return parts
+
+
+def _compile_filter_expr(expr: str, index_seed: int) -> Tuple[Optional[FilterNode], int]:
+    text_expr = str(expr or "").strip()
+    if not text_expr:
+        return None, index_seed
+    text_expr = strip_outer_parentheses(text_expr)
+
+    for kind, op in (("or", "OR"), ("and", "AND")):
+        parts = split_top_level_boolean(text_expr, op)
+        if len(parts) > 1:
+            children: List[FilterNode] = []
+            idx = index_seed
+            for part in parts:
+                child, idx = _compile_filter_expr(part, idx)
+                if child is not None:
+                    children.append(child)
+            return FilterNode(kind=kind, children=tuple(children)), idx
+
+    match = _FILTER_COMPARISON_RE.fullmatch(text_expr)
+    if not match:
+        logger.warning("filter_condition 片段无法解析，已忽略: %s", text_expr)
+        return None, index_seed
+    column_name, operator, raw_value = match.groups()
+    # MySQL 不支持 Python 风格的 `==` / `!=`;这里归一化到 SQL 原生操作符,
+    # 避免配置里写 `col == 5` 时发出无效 SQL(1064 语法错)。
+    sql_operator = {"==": "=", "!=": "<>"}.get(operator, operator)
+    raw_value = raw_value.strip()
+    placeholder = _TEMPLATE_VAR_RE.fullmatch(raw_value)
+    node = FilterNode(
+        kind="cmp",
+        column=safe_identifier(column_name),
+        operator=sql_operator,
+        raw_value=raw_value,
+        context_var=placeholder.group(1) if placeholder else None,
+        param_index=index_seed,
+    )
+    return node, index_seed + 1
+
+
+@lru_cache(maxsize=512)
+def compile_filter_condition(filter_condition: str) -> Optional[FilterNode]:
+    """解析 MySQL filter_condition（AND / OR / 括号 / 比较），参数序号 filter_N 在编译期确定。"""
+    node, _ = _compile_filter_expr(filter_condition, 0)
+    return node
+
+
+# ── extraction_rule ─────────────────────────────────────────────────────────
+
+
+@dataclass(frozen=True)
+class Extractor:
+    """
+    预解析的 extraction_rule：kind ∈ {"", json, jsonpath, regex}。
+
+    regex 预编译；jsonpath 不含 {var} 占位符时预切分路径段，含占位符时保留模板按请求渲染。
+    """
+
+    kind: str
+    argument: str = ""
+    pattern: Optional[Pattern[str]] = None
+    path_segments: Optional[Tuple[str, ...]] = None
+    template_vars: Tuple[str, ...] = ()
+
+    def bind_path(self, rendered_path: str) -> "Extractor":
+        """返回 {var} 已按请求上下文渲染、路径段已切分的 jsonpath 提取器。"""
+        segments = tuple(part for part in rendered_path.split("/") if part)
+        return replace(self, argument=rendered_path, path_segments=segments, template_vars=())
+
+
+@lru_cache(maxsize=512)
+def compile_extraction_rule(extraction_rule: str) -> Extractor:
+    rule = str(extraction_rule or "").strip()
+    if rule.startswith("json:"):
+        return Extractor(kind="json", argument=rule[5:].strip())
+    if rule.startswith("jsonpath:"):
+        path = rule[9:].strip()
+        template_vars = tuple(_TEMPLATE_VAR_RE.findall(path))
+        segments = None if template_vars else tuple(part for part in path.split("/") if part)
+        return Extractor(kind="jsonpath", argument=path, path_segments=segments, template_vars=template_vars)
+    if rule.startswith("regex:"):
+        return Extractor(kind="regex", argument=rule[6:], pattern=re.compile(rule[6:]))
+    return Extractor(kind="")
+
+
+def sql_regex_compatible(pattern: str) -> bool:
+    """pattern 能否原样交给 ClickHouse match() / MySQL REGEXP，且与 Python re.search 同义。"""
+    return not _SQL_REGEX_UNSUPPORTED_RE.search(pattern)
+
+
+# ── data_type ───────────────────────────────────────────────────────────────
+
+
+def _coerce_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in {"true", "1", "yes", "y"}:
+            return True
+        if lowered in {"false", "0", "no", "n"}:
+            return False
+    return bool(value)
+
+
+_COERCERS: Dict[str, Callable[[Any], Any]] = {
+    "float": float,
+    "double": float,
+    "number": float,
+    "int": lambda value: int(float(value)),
+    "integer": lambda value: int(float(value)),
+    "bool": _coerce_bool,
+    "boolean": _coerce_bool,
+    "str": str,
+    "string": str,
+    "text": str,
+}
+
+
+@dataclass(frozen=True)
+class Coercion:
+    """data_type 对应的转换函数；data_type 为空时 func 为 None，未知类型 known=False。"""
+
+    data_type: Optional[str] = None
+    func: Optional[Callable[[Any], Any]] = None
+
+    @property
+    def known(self) -> bool:
+        return self.data_type is None or self.func is not None
+
+
+@lru_cache(maxsize=64)
+def _compile_coercion_text(data_type: str) -> Coercion:
+    if not data_type:
+        return Coercion()
+    return Coercion(data_type=data_type, func=_COERCERS.get(data_type))
+
+
+def compile_coercion(raw_data_type: Any) -> Coercion:
+    if raw_data_type is None:
+        return Coercion()
+    return _compile_coercion_text(str(raw_data_type).strip().lower())
+
+
+# ── MetricPlan ──────────────────────────────────────────────────────────────
+
+
+def parse_duration_days(raw: Any) -> Optional[int]:
+    """
+    duration 兼容: 整数("7")、浮点字符串("7.0"/"7.5")与纯数字。
+    先 float 再 int 可向下取整(7.9 → 7 天)；缺省或非法返回 None（由调用方用回退窗口）。
+    """
+    if raw is None:
+        return None
+    try:
+        return int(float(str(raw).strip()))
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class ApproximateQuery:
+    """
+    ClickHouse 近似取数（meta.approximate 写成 true 或对象时启用）。
+
+    sample：SAMPLE 比例 (0, 1]，1 表示不抽样只限读取行数；max_rows_to_read：单次查询读取行数上限，
+    超出后按 read_overflow_mode=break 返回已读部分。None 表示使用环境变量默认值。
+    """
+
+    sample: Optional[float] = None
+    max_rows_to_read: Optional[int] = None
+
+
+def parse_approximate(raw: Any) -> Optional[ApproximateQuery]:
+    """解析 meta.approximate；false/缺省返回 None，非法写法抛 ValueError（配置校验与取数共用）。"""
+    if raw is None or raw is False:
+        return None
+    if raw is True:
+        return ApproximateQuery()
+    if not isinstance(raw, dict):
+        raise ValueError(f"approximate 只能是布尔值或 {{sample, max_rows_to_read}} 对象，实际: {raw!r}")
+    unknown = set(raw) - {"sample", "max_rows_to_read"}
+    if unknown:
+        raise ValueError(f"approximate 不支持的字段: {sorted(unknown)}")
+    sample = raw.get("sample")
+    if sample is not None:
+        if isinstance(sample, bool) or not isinstance(sample, (int, float)) or not 0 < sample <= 1:
+            raise ValueError(f"approximate.sample 须为 (0, 1] 内的数，实际: {sample!r}")
+        sample = float(sample)
+    max_rows = raw.get("max_rows_to_read")
+    if max_rows is not None:
+        if isinstance(max_rows, bool) or not isinstance(max_rows, int) or max_rows <= 0:
+            raise ValueError(f"approximate.max_rows_to_read 须为正整数，实际: {max_rows!r}")
+    return ApproximateQuery(sample=sample, max_rows_to_read=max_rows)
+
+
+@dataclass(frozen=True)
+class MetricPlan:
+    metric_id: str
+    meta: Dict[str, Any] = field(compare=False, hash=False, repr=False)
+    source_kind: str = ""
+    enabled: bool = True
+    table_name: str = ""
+    column_name: str = ""
+    time_column: str = ""
+    equipment_column: str = ""
+    # ClickHouse 时间列类型声明（DateTime / DateTime64 / String）；None 表示按表级声明或探测结果
+    time_column_type: Optional[str] = None
+    omit_equipment: bool = False
+    duration_days: Optional[int] = None
+    duration_invalid: bool = False
+    linking_mode: str = "time_window_only"
+    link_keys: Tuple[LinkPredicate, ...] = ()
+    link_filters: Tuple[LinkPredicate, ...] = ()
+    filter_tree: Optional[FilterNode] = None
+    extraction: Extractor = field(default_factory=lambda: Extractor(kind=""))
+    coercion: Coercion = field(default_factory=Coercion)
+    selection: RowSelection = field(default_factory=RowSelection)
+    cache_ttl: Optional[float] = None
+    window_strategy: str = "full"
+    # 存在性探测：无捕获组的 regex 只关心「窗口内有没有一行命中」，取数改为
+    # SELECT 1 ... WHERE <列匹配 pattern> LIMIT 1；None 表示走普通窗口查询
+    probe_pattern: Optional[str] = None
+    # ClickHouse 的带捕获组 regex 下推：SELECT toFloat64OrNull(extract(列, pattern)) ... WHERE match(列, pattern)，
+    # 只回传已提取的数值；None 表示 RE2 不兼容（或非 ClickHouse / 非 regex），走 Python 逐行提取
+    sql_extract_pattern: Optional[str] = None
+    # ClickHouse 近似取数（SAMPLE + max_rows_to_read）；None 表示精确查询。
+    # 仅 clickhouse_window + 可下推的 aggregate selection 生效，其它 source_kind 的 approximate 只是展示标记
+    approximate: Optional[ApproximateQuery] = None
+    # ClickHouse 按块读取的预算（需 Python 侧提取时生效）：最多读取的行数 / 近似字节数；None 表示用环境变量默认值
+    max_rows: Optional[int] = None
+    max_bytes: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def is_db(self) -> bool:
+        return self.source_kind in DB_SOURCE_KINDS
+
+    @property
+    def python_extraction(self) -> bool:
+        """取回的列值是否还需在 Python 侧做提取（提取规则未下推到 SQL）。"""
+        return bool(self.extraction.kind) and self.sql_extract_pattern is None
+
+    @property
+    def extraction_rule(self) -> str:
+        return str(self.meta.get("extraction_rule") or "")
+
+    def raise_if_invalid(self) -> None:
+        if self.error:
+            raise ValueError(self.error)
+
+
+def normalize_linking(meta: Dict[str, Any]) -> Dict[str, Any]:
+    linking = meta.get("linking") or {}
+    if not isinstance(linking, dict):
+        linking = {}
+    return {
+        "mode": str(linking.get("mode", "time_window_only")).strip().lower(),
+        "keys": list(linking.get("keys") or []),
+        "filters": list(linking.get("filters") or []),
+    }
+
+
+def _parse_cache_ttl(raw: Any) -> Optional[float]:
+    if raw is None:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except (TypeError, ValueError):
+        logger.warning("指标 cache_ttl 无效: %r，使用默认值", raw)
+        return None
+
+
+def compile_metric_plan(metric_id: str, meta: Dict[str, Any]) -> MetricPlan:
+    """编译单个指标；DB 类指标的标识符/linking/filter/selection 错误记录到 plan.error。"""
+    source_kind = normalize_source_kind(meta.get("source_kind"))
+    linking = normalize_linking(meta)
+    base: Dict[str, Any] = {
+        "metric_id": metric_id,
+        "meta": meta,
+        "source_kind": source_kind,
+        "enabled": meta.get("enabled") is not False,
+        "linking_mode": linking["mode"],
+        "coercion": compile_coercion(meta.get("data_type")),
+    }
+    if source_kind not in DB_SOURCE_KINDS:
+        return MetricPlan(**base)
+
+    raw_duration = meta.get("duration")
+    duration_days = parse_duration_days(raw_duration)
+    base.update(
+        duration_days=duration_days,
+        duration_invalid=raw_duration is not None and duration_days is None,
+        cache_ttl=_parse_cache_ttl(meta.get("cache_ttl")),
+    )
+    try:
+        window_strategy = str(meta.get("window_strategy") or "full").strip().lower()
+        if window_strategy not in WINDOW_STRATEGIES:
+            raise ValueError(f"window_strategy 仅支持 {sorted(WINDOW_STRATEGIES)}，实际: {meta.get('window_strategy')!r}")
+        base["window_strategy"] = window_strategy
+        if source_kind == "mysql_nearest_row":
+            base.update(
+                table_name=safe_identifier(meta.get("table_name", "")),
+                column_name=safe_identifier(meta.get("column_name", "")),
+                time_column=safe_identifier(meta.get("time_column", "wafer_product_start_time")),
+                equipment_column=safe_identifier(meta.get("equipment_column", "equipment")),
+                omit_equipment=bool(meta.get("mysql_omit_equipment_filter")),
+                filter_tree=(
+                    compile_filter_condition(str(meta["filter_condition"]))
+                    if meta.get("filter_condition")
+                    else None
+                ),
+            )
+        else:
+            # ClickHouse 标识符由 ODS 层 _ch_quote_ident 反引号校验
+            time_column_type = meta.get("time_column_type")
+            if time_column_type:
+                parse_time_column_type(time_column_type)
+            base.update(
+                table_name=meta["table_name"],
+                column_name=meta["column_name"],
+                time_column=meta.get("time_column", "time"),
+                equipment_column=meta.get("equipment_column", "equipment"),
+                time_column_type=str(time_column_type) if time_column_type else None,
+            )
+        base.update(
+            link_keys=compile_link_predicates(linking["keys"]),
+            link_filters=compile_link_predicates(linking["filters"]),
+            extraction=compile_extraction_rule(str(meta.get("extraction_rule") or "")),
+            selection=parse_selection(meta.get("selection")),
+        )
+        base["probe_pattern"] = _existence_probe_pattern(
+            base["extraction"], base["coercion"], base["selection"]
+        )
+        if window_strategy == "progressive" and not _progressive_effective(base["selection"], base["probe_pattern"]):
+            # all / aggregate 永远等不到「已满足」，逐级放宽只会多发查询：退回一次查满完整窗口
+            logger.warning("指标 %s 的 selection 无法提前满足，window_strategy=progressive 按 full 执行", metric_id)
+            base["window_strategy"] = "full"
+        if source_kind == "clickhouse_window":
+            base["sql_extract_pattern"] = _sql_extract_pattern(base["extraction"])
+            base["approximate"] = _approximate_query(meta.get("approximate"), base)
+            base["max_rows"] = _parse_read_budget(meta, "max_rows")
+            base["max_bytes"] = _parse_read_budget(meta, "max_bytes")
+    except (KeyError, ValueError, re.error) as exc:
+        base["error"] = f"metric({metric_id}) 取数计划编译失败: {exc}"
+    return MetricPlan(**base)
+
+
+def _progressive_effective(selection: RowSelection, probe_pattern: Optional[str]) -> bool:
+    """progressive 只对能在窄窗口提前满足的取数有意义：nearest / nearest_n 取够条数、存在性探测命中。"""
+    return selection.limit is not None or probe_pattern is not None
+
+
+def progressive_window_supported(meta: Dict[str, Any]) -> bool:
+    """供配置校验使用：meta 的 selection / extraction_rule / data_type 是否允许 window_strategy=progressive。"""
+    selection = parse_selection(meta.get("selection"))
+    extraction = compile_extraction_rule(str(meta.get("extraction_rule") or ""))
+    probe_pattern = _existence_probe_pattern(extraction, compile_coercion(meta.get("data_type")), selection)
+    return _progressive_effective(selection, probe_pattern)
+
+
+def _parse_read_budget(meta: Dict[str, Any], key: str) -> Optional[int]:
+    raw = meta.get(key)
+    if raw is None:
+        return None
+    if isinstance(raw, bool) or not isinstance(raw, int) or raw <= 0:
+        raise ValueError(f"{key} 须为正整数，实际: {raw!r}")
+    return raw
+
+
+def _approximate_query(raw: Any, base: Dict[str, Any]) -> Optional[ApproximateQuery]:
+    """近似取数要求聚合在 SQL 侧完成：selection 为 aggregate:*，且提取规则为空或已下推。"""
+    approximate = parse_approximate(raw)
+    if approximate is None:
+        return None
+    if base["selection"].aggregate not in APPROXIMATE_AGGREGATES:
+        raise ValueError("approximate 取数只支持 selection=aggregate:avg|count（min / max 抽样有偏）")
+    if base["extraction"].kind and base["sql_extract_pattern"] is None:
+        raise ValueError("approximate 取数要求 extraction_rule 为空或可下推到 SQL 的 regex")
+    return approximate
+
+
+def _existence_probe_pattern(extraction: Extractor, coercion: Coercion, selection: RowSelection) -> Optional[str]:
+    """
+    无捕获组 regex 的取值是「每条命中行一个 True」，与 true 比较时按任一为真。
+    selection 为 all / nearest 且 data_type 为空或布尔时，结果只取决于是否存在命中行，
+    可改写成存在性探测（命中返回 [True]）；nearest_n / aggregate 依赖命中行数，不改写。
+    """
+    if extraction.kind != "regex" or extraction.pattern is None or extraction.pattern.groups:
+        return None
+    if selection.mode not in {"all", "nearest"}:
+        return None
+    if coercion.data_type not in {None, "bool", "boolean"}:
+        return None
+    if not sql_regex_compatible(extraction.argument):
+        return None
+    return extraction.argument
+
+
+def _sql_extract_pattern(extraction: Extractor) -> Optional[str]:
+    """
+    带捕获组的 regex 取「首个命中的捕获组 1 转 float」，与 ClickHouse extract()（返回首个捕获组）同义，
+    可改写成 toFloat64OrNull(extract(...))。捕获内容不是数字时 SQL 侧得到 NULL 并丢弃该行
+    （Python 路径的 float() 会抛错使整个指标降级）。
+    """
+    if extraction.kind != "regex" or extraction.pattern is None or not extraction.pattern.groups:
+        return None
+    if not sql_regex_compatible(extraction.argument):
+        return None
+    return extraction.argument
+
+
+def compile_metric_plans(metrics: Dict[str, Dict[str, Any]]) -> Dict[str, MetricPlan]:
+    return {
+        metric_id: compile_metric_plan(metric_id, meta)
+        for metric_id, meta in (metrics or {}).items()
+        if isinstance(meta, dict)
+    }
@@ -2,6 +2,10 @@ import logging
 from typing import Dict, List, Any, Optional
 from app.diagnosis.config_store import DiagnosisConfigStore
 from app.engine.condition_evaluator import extract_vars_from_definition
+from app.engine.scene_dispatch import SceneDispatch, compile_scene_dispatch
+from app.engine.step_plan import StepPlan, compile_step_plan
+from app.engine.subtree_effects import SubtreeIndex, build_subtree_index
+from app.engine.threshold_index import ThresholdEntry, build_threshold_index
 
 logger = logging.getLogger(__name__)
 
@@ -21,7 +25,11 @@ class RuleLoader:
         self.diagnosis_scenes = bundle.get("diagnosis_scenes", [])
         self.steps = bundle.get("steps", [])
         self.steps_map = bundle.get("steps_map", {})
+        self.step_plans = bundle.get("step_plans", {})
         self.metrics_meta = bundle.get("metrics", {})
+        self.threshold_index = bundle.get("threshold_index")
+        self.scene_dispatch = bundle.get("scene_dispatch")
+        self.subtree_index = bundle.get("subtree_index")
         self.default_scene_id = bundle.get("default_scene_id")
         logger.info(
             "RuleLoader 初始化完成: pipeline=%s scenes=%d steps=%d metrics=%d",
@@ -37,6 +45,43 @@ class RuleLoader:
         """根据 step_id 获取步骤定义"""
         return self.steps_map.get(str(step_id))
 
+    def get_step_plan(self, step: Dict[str, Any]) -> StepPlan:
+        """
+        取 pipeline 加载时编译好的 StepPlan；step 或其 next 不是 bundle 里那份
+        （测试替换 steps_map、动态注入）时现场编译，保证分支条件与 step 一致。
+        """
+        plan = self.step_plans.get(str(step.get("id")))
+        if plan is not None and plan.step is step and plan.next is step.get("next"):
+            return plan
+        return compile_step_plan(step)
+
+    def get_threshold_entry(self, metric_id: str) -> Optional[ThresholdEntry]:
+        """
+        取指标的展示阈值（pipeline 加载时预解析）；steps / metrics 被替换
+        （测试、动态注入）后按当前配置重建一次索引。
+        """
+        index = self.threshold_index
+        if index is None or index.steps is not self.steps or index.metrics is not self.metrics_meta:
+            index = build_threshold_index(self.steps, self.metrics_meta)
+            self.threshold_index = index
+        return index.get(metric_id)
+
+    def get_scene_dispatch(self) -> SceneDispatch:
+        """取 pipeline 加载时编译的场景分派索引；scenes / metrics 被替换后按当前配置重建。"""
+        dispatch = self.scene_dispatch
+        if dispatch is None or dispatch.scenes is not self.diagnosis_scenes or dispatch.metrics is not self.metrics_meta:
+            dispatch = compile_scene_dispatch(self.diagnosis_scenes, self.metrics_meta)
+            self.scene_dispatch = dispatch
+        return dispatch
+
+    def get_subtree_index(self) -> SubtreeIndex:
+        """取 pipeline 加载时计算的子树读写集；steps 被替换后按当前配置重建。"""
+        index = self.subtree_index
+        if index is None or index.steps is not self.steps:
+            index = build_subtree_index(self.steps)
+            self.subtree_index = index
+        return index
+
     def get_metric_meta(self, metric_id: str) -> Optional[Dict[str, Any]]:
         """根据 metric_id 获取指标元数据"""
         return self.metrics_meta.get(metric_id)
@@ -74,44 +119,59 @@ class RuleLoader:
             if step is None:
                 continue
 
-            # 收集当前步骤的 metric_id
-            step_metric = step.get("metric_id")
-            if step_metric:
-                metric_ids.add(step_metric)
-
-            # 收集 params 中的指标（建模步骤，兼容新旧格式）
-            params = self.get_step_params(step)
-            for param_name in params.keys():
-                metric_ids.add(param_name)
-            for raw_value in params.values():
-                for var_name in extract_vars_from_definition(raw_value):
-                    metric_ids.add(var_name)
-
-            # 收集 details 中的输出 results（新格式建模步骤的输出指标）
-            output_results = self.get_step_output_results(step)
-            for result_key in output_results.keys():
-                metric_ids.add(result_key)
-
-            # 遍历 next 分支（显式 "next": null 时 .get("next", []) 仍为 None，需 or []）
-            for branch in step.get("next") or []:
-                target = branch.get("target")
-                if target is None:
-                    continue
-                if isinstance(target, list):
-                    for t in target:
-                        queue.append(str(t))
-                else:
-                    queue.append(str(target))
-
-                # 旧格式：分支的 results 中的输出指标
-                results = branch.get("results", {})
-                for result_key in results.keys():
-                    metric_ids.add(result_key)
-                for var_name in extract_vars_from_definition(branch.get("condition")):
-                    metric_ids.add(var_name)
+            metric_ids.update(self.get_step_metric_ids(step))
+            queue.extend(self.get_step_successors(step))
 
         return list(metric_ids)
 
+    def get_step_metric_ids(self, step: Dict[str, Any]) -> List[str]:
+        """
+        单个 step 引用的 metric_id：step.metric_id、建模 params（键与 {var}）、
+        输出 results、分支 condition 变量与旧格式分支 results。
+        """
+        metric_ids: List[str] = []
+
+        def add(metric_id: Any) -> None:
+            if metric_id and metric_id not in metric_ids:
+                metric_ids.append(metric_id)
+
+        # 收集当前步骤的 metric_id
+        add(step.get("metric_id"))
+
+        # 收集 params 中的指标（建模步骤，兼容新旧格式）
+        params = self.get_step_params(step)
+        for param_name in params.keys():
+            add(param_name)
+        for raw_value in params.values():
+            for var_name in extract_vars_from_definition(raw_value):
+                add(var_name)
+
+        # 收集 details 中的输出 results（新格式建模步骤的输出指标）
+        for result_key in self.get_step_output_results(step).keys():
+            add(result_key)
+
+        # 显式 "next": null 时 .get("next", []) 仍为 None，需 or []
+        for branch in step.get("next") or []:
+            # 旧格式：分支的 results 中的输出指标
+            for result_key in (branch.get("results") or {}).keys():
+                add(result_key)
+            for var_name in extract_vars_from_definition(branch.get("condition")):
+                add(var_name)
+        return metric_ids
+
+    @staticmethod
+    def get_step_successors(step: Dict[str, Any]) -> List[str]:
+        """step 的直接后继 step_id（多目标 target 展开），按 next 顺序。"""
+        successors: List[str] = []
+        for branch in step.get("next") or []:
+            target = branch.get("target")
+            if target is None:
+                continue
+            for item in target if isinstance(target, list) else [target]:
+                if str(item) not in successors:
+                    successors.append(str(item))
+        return successors
+
     # ── 新旧格式兼容辅助 ────────────────────────────────────────────────────
 
     @staticmethod
@@ -174,5 +234,9 @@ class RuleLoader:
         self.diagnosis_scenes = bundle.get("diagnosis_scenes", [])
         self.steps = bundle.get("steps", [])
         self.steps_map = bundle.get("steps_map", {})
+        self.step_plans = bundle.get("step_plans", {})
         self.metrics_meta = bundle.get("metrics", {})
+        self.threshold_index = bundle.get("threshold_index")
+        self.scene_dispatch = bundle.get("scene_dispatch")
+        self.subtree_index = bundle.get("subtree_index")
         self.default_scene_id = bundle.get("default_scene_id")
@@ -15,6 +15,15 @@ from app.engine.condition_evaluator import (
     extract_condition_vars,
     validate_condition_definition,
 )
+from app.engine.fetch_planner import parse_selection
+from app.engine.metric_plan import (
+    APPROXIMATE_AGGREGATES,
+    compile_extraction_rule,
+    parse_approximate,
+    progressive_window_supported,
+    sql_regex_compatible,
+)
+from app.utils.clickhouse_types import parse_time_column_type
 
 
 # ────────────────────────────────────────────────────────────────────────────
@@ -49,9 +58,37 @@ VALID_LINKING_MODES: Set[str] = {
 VALID_LINKING_OPERATORS: Set[str] = {
     "=", "==", "!=", ">", ">=", "<", "<=",
     "contains",   # MySQL: INSTR / ClickHouse: positionUTF8
+    "prefix",     # 前缀匹配 LIKE 'xxx%'，可走索引
     "in",         # 列表 IN (...)
 }
 
+# linking 条目的 type 声明：按列原生类型比较（不做 toString / CAST）
+VALID_LINKING_VALUE_TYPES: Set[str] = {"string", "int", "float"}
+
+VALID_WINDOW_STRATEGIES: Set[str] = {
+    "full",         # 一次查满 duration 窗口
+    "progressive",  # 从 T 前 1h 起几何放宽,selection 满足即停
+}
+
+def _approximate_errors(meta: Dict[str, Any]) -> List[str]:
+    try:
+        parse_approximate(meta.get("approximate"))
+        aggregate = parse_selection(meta.get("selection")).aggregate
+    except ValueError as exc:
+        return [str(exc)]
+    if aggregate not in APPROXIMATE_AGGREGATES:
+        return ["approximate 取数只支持 selection=aggregate:avg|count(min / max 在抽样上有偏,不能近似)"]
+    rule = str(meta.get("extraction_rule") or "")
+    if rule:
+        try:
+            extractor = compile_extraction_rule(rule)
+        except Exception:
+            return []  # extraction_rule 本身的错误由运行时编译报出
+        if extractor.kind != "regex" or not extractor.pattern.groups or not sql_regex_compatible(extractor.argument):
+            return ["approximate 取数要求 extraction_rule 为空或可下推到 SQL 的 regex(带捕获组、RE2 兼容)"]
+    return []
+
+
 VALID_FALLBACK_POLICIES: Set[str] = {
     "none",
     "nearest_in_window",
@@ -228,6 +265,18 @@ def _validate_one_metric(metric_id: str, meta: Any) -> List[str]:
                             f"metric({metric_id}) linking.{field_name}[{idx}] operator 非法: {op!r};"
                             f"合法值: {sorted(VALID_LINKING_OPERATORS)}"
                         )
+                    value_type = item.get("type")
+                    if value_type is not None:
+                        value_type = str(value_type).strip().lower()
+                        if value_type not in VALID_LINKING_VALUE_TYPES:
+                            errors.append(
+                                f"metric({metric_id}) linking.{field_name}[{idx}] type 非法: {item.get('type')!r};"
+                                f"合法值: {sorted(VALID_LINKING_VALUE_TYPES)}"
+                            )
+                        elif value_type != "string" and op in {"contains", "prefix"}:
+                            errors.append(
+                                f"metric({metric_id}) linking.{field_name}[{idx}] operator={op} 只能用于 type=string"
+                            )
                     # source 与 value 二选一(且不能同时缺失)
                     has_source = "source" in item and str(item.get("source", "")).strip()
                     has_value = "value" in item
@@ -255,6 +304,64 @@ def _validate_one_metric(metric_id: str, meta: Any) -> List[str]:
                 errors.append(
                     f"metric({metric_id}) duration 必须是整数(单位:天),实际: {dur!r}"
                 )
+        # selection: 窗口取行策略(nearest / nearest_n:N / all / aggregate:avg|min|max|count)
+        if "selection" in meta:
+            try:
+                parse_selection(meta.get("selection"))
+            except ValueError as exc:
+                errors.append(f"metric({metric_id}) {exc}")
+        # cache_ttl: 跨请求窗口缓存的 TTL(秒),0 表示该指标不进缓存
+        if "cache_ttl" in meta:
+            ttl = meta.get("cache_ttl")
+            try:
+                if isinstance(ttl, bool) or float(ttl) < 0:
+                    raise ValueError(ttl)
+            except (TypeError, ValueError):
+                errors.append(
+                    f"metric({metric_id}) cache_ttl 必须是非负数(单位:秒),实际: {ttl!r}"
+                )
+        # time_column_type: ClickHouse 时间列类型(DateTime / DateTime64 / String),决定窗口谓词写法
+        if meta.get("time_column_type") is not None:
+            if normalized_kind != "clickhouse_window":
+                errors.append(
+                    f"metric({metric_id}) time_column_type 仅对 clickhouse_window 生效"
+                )
+            else:
+                try:
+                    parse_time_column_type(meta.get("time_column_type"))
+                except ValueError as exc:
+                    errors.append(f"metric({metric_id}) {exc}")
+        # window_strategy: full(默认) / progressive(从 T 前 1h 起几何放宽,selection 满足即停)
+        if meta.get("window_strategy") is not None:
+            strategy = str(meta.get("window_strategy")).strip().lower()
+            if strategy not in VALID_WINDOW_STRATEGIES:
+                errors.append(
+                    f"metric({metric_id}) window_strategy 非法: {meta.get('window_strategy')!r};"
+                    f"合法值: {sorted(VALID_WINDOW_STRATEGIES)}"
+                )
+            elif strategy == "progressive":
+                try:
+                    supported = progressive_window_supported(meta)
+                except Exception:
+                    # selection / extraction_rule 本身的错误由各自的校验报告
+                    supported = True
+                if not supported:
+                    errors.append(
+                        f"metric({metric_id}) window_strategy=progressive 要求 selection 为 nearest / nearest_n:<N>"
+                        f" 或为无捕获组 regex 的存在性探测;all / aggregate 只能在完整窗口得到结果"
+                    )
+        # approximate: clickhouse_window 上表示近似取数(SAMPLE + max_rows_to_read),只支持 SQL 侧聚合
+        if normalized_kind == "clickhouse_window" and meta.get("approximate") not in (None, False):
+            errors.extend(f"metric({metric_id}) {msg}" for msg in _approximate_errors(meta))
+        # max_rows / max_bytes: ClickHouse 按块读取的行数 / 字节预算(正整数)
+        for budget_key in ("max_rows", "max_bytes"):
+            if meta.get(budget_key) is None:
+                continue
+            budget = meta.get(budget_key)
+            if normalized_kind != "clickhouse_window":
+                errors.append(f"metric({metric_id}) {budget_key} 仅对 clickhouse_window 生效")
+            elif isinstance(budget, bool) or not isinstance(budget, int) or budget <= 0:
+                errors.append(f"metric({metric_id}) {budget_key} 必须是正整数,实际: {budget!r}")
 
     # 9. 直接取字段类必填 field
     if normalized_kind in DIRECT_FIELD_KINDS:
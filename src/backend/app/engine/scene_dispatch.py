@@ -0,0 +1,162 @@
+"""
+场景分派索引（SceneDispatch）：pipeline 加载时把 diagnosis_scenes 的触发条件拆成
+「免费谓词」与「需查库的触发指标」两部分。
+
+过去 DiagnosisEngine._select_scene 按顺序逐个场景取触发指标（可能是 ClickHouse 日志扫描）
+再求 trigger_condition；按源表字段（如 reject_reason）就能排除的场景也要先付查库成本，
+场景越多越慢。现在：
+  1. 所有场景引用的 failure_record_field / request_param 触发指标一次取齐（不查库）
+  2. 每个场景的「免费合取子句」（顶层 AND / all_of 里只引用免费指标的子句）任一为假，
+     该场景的所有 trigger_condition 都不可能成立，直接排除
+  3. 剩余场景的查库触发指标合并成一批，由 fetch_all 并发取数
+  4. 按声明顺序对剩余场景做完整求值，首个命中者胜出（与原顺序语义一致）
+
+免费子句只用场景自身声明的触发指标求值，与完整求值时的取值一致，排除是保守的：
+判不出的子句（含查库指标、OR 跨免费与查库指标）一律留给完整求值。
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.engine.condition_evaluator import (
+    evaluate_boolean_condition_definition,
+    evaluate_boolean_condition_text,
+    extract_condition_vars,
+    extract_vars_from_definition,
+    parse_condition_signature,
+    split_top_level_and,
+)
+from app.engine.step_plan import compile_condition
+
+# 直接从源记录 / 请求参数取值、不查库的触发指标来源
+FREE_SOURCE_KINDS = {"failure_record_field", "request_param"}
+
+Predicate = Callable[[Dict[str, Any]], bool]
+
+
+@dataclass(frozen=True)
+class ScenePlan:
+    scene: Dict[str, Any]
+    trigger_metric_ids: Tuple[str, ...]
+    free_metric_ids: Tuple[str, ...]
+    db_metric_ids: Tuple[str, ...]
+    conditions: Tuple[Any, ...]
+    # 每条 trigger_condition 的免费合取子句；某条的任一子句为假 → 该条不成立
+    free_conjuncts: Tuple[Tuple[Predicate, ...], ...]
+    # default 场景且无触发指标、无条件：按顺序走到即命中
+    catch_all: bool
+
+    def ruled_out(self, free_values: Dict[str, Any]) -> bool:
+        """只用免费触发指标判断本场景是否必然不命中。"""
+        values = {metric_id: free_values.get(metric_id) for metric_id in self.free_metric_ids}
+        if not self.conditions:
+            # 无条件：要求全部触发指标为真；没有触发指标的非 default 场景永不命中
+            if not self.trigger_metric_ids:
+                return True
+            return any(not values.get(metric_id) for metric_id in self.free_metric_ids)
+        return all(
+            any(not predicate(values) for predicate in conjuncts)
+            for conjuncts in self.free_conjuncts
+        )
+
+
+@dataclass(frozen=True)
+class SceneDispatch:
+    # 编译时的 scenes / metrics 引用：RuleLoader 据此判断被替换后重建
+    scenes: Any
+    metrics: Any
+    plans: Tuple[ScenePlan, ...]
+    free_metric_ids: Tuple[str, ...]
+
+
+def _text_predicate(text: str) -> Predicate:
+    if parse_condition_signature(text) is not None:
+        evaluate = compile_condition(text)
+        return lambda values: evaluate(values)[0]
+    return lambda values: evaluate_boolean_condition_text(text, values)
+
+
+def _free_conjuncts(condition: Any, free_ids: set) -> List[Predicate]:
+    """条件里只引用 free_ids 的合取子句（条件成立的必要条件）。"""
+    if isinstance(condition, str):
+        predicates: List[Predicate] = []
+        for part in split_top_level_and(condition):
+            names = extract_condition_vars(part)
+            if names and all(name in free_ids for name in names):
+                predicates.append(_text_predicate(part))
+        return predicates
+    if isinstance(condition, dict):
+        if "all_of" in condition and "compare" not in condition:
+            predicates = []
+            for item in condition.get("all_of") or []:
+                predicates.extend(_free_conjuncts(item, free_ids))
+            return predicates
+        names = extract_vars_from_definition(condition)
+        if names and all(name in free_ids for name in names):
+            return [lambda values: evaluate_boolean_condition_definition(condition, values)]
+    return []
+
+
+def compile_scene_plan(scene: Dict[str, Any], metrics: Dict[str, Any]) -> ScenePlan:
+    trigger_ids = scene.get("metric_id") or []
+    if isinstance(trigger_ids, str):
+        trigger_ids = [trigger_ids]
+    conditions = scene.get("trigger_condition") or []
+    if isinstance(conditions, str):
+        conditions = [conditions]
+
+    free_ids = []
+    db_ids = []
+    for metric_id in trigger_ids:
+        meta = (metrics or {}).get(metric_id)
+        source_kind = str((meta or {}).get("source_kind", "")).strip().lower()
+        (free_ids if source_kind in FREE_SOURCE_KINDS else db_ids).append(metric_id)
+
+    free_set = set(free_ids)
+    return ScenePlan(
+        scene=scene,
+        trigger_metric_ids=tuple(trigger_ids),
+        free_metric_ids=tuple(free_ids),
+        db_metric_ids=tuple(db_ids),
+        conditions=tuple(conditions),
+        free_conjuncts=tuple(tuple(_free_conjuncts(condition, free_set)) for condition in conditions),
+        catch_all=bool(scene.get("default")) and not trigger_ids and not conditions,
+    )
+
+
+def compile_scene_dispatch(scenes: List[Dict[str, Any]], metrics: Dict[str, Any]) -> SceneDispatch:
+    plans = tuple(compile_scene_plan(scene, metrics) for scene in scenes or [])
+    free_ids: List[str] = []
+    for plan in plans:
+        for metric_id in plan.free_metric_ids:
+            if metric_id not in free_ids:
+                free_ids.append(metric_id)
+    return SceneDispatch(scenes=scenes, metrics=metrics, plans=plans, free_metric_ids=tuple(free_ids))
+
+
+def dispatch_candidates(dispatch: SceneDispatch, free_values: Dict[str, Any]) -> Tuple[List[ScenePlan], List[ScenePlan]]:
+    """
+    按声明顺序返回 (候选场景, 被免费谓词排除的场景)；遇到 catch_all 场景截止
+    （其后的场景按原顺序语义永远走不到）。
+    """
+    candidates: List[ScenePlan] = []
+    excluded: List[ScenePlan] = []
+    for plan in dispatch.plans:
+        if plan.catch_all:
+            candidates.append(plan)
+            break
+        if plan.ruled_out(free_values):
+            excluded.append(plan)
+            continue
+        candidates.append(plan)
+    return candidates, excluded
+
+
+def candidate_db_metric_ids(candidates: List[ScenePlan]) -> List[str]:
+    """候选场景需要查库的触发指标（去重，保持顺序）。"""
+    metric_ids: List[str] = []
+    for plan in candidates:
+        for metric_id in plan.db_metric_ids:
+            if metric_id not in metric_ids:
+                metric_ids.append(metric_id)
+    return metric_ids
+
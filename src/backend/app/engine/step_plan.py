@@ -0,0 +1,236 @@
+"""
+决策树编译（StepPlan）：pipeline 加载时把每个 step 的 next 分支预解析成可直接执行的形式。
+
+过去 DiagnosisEngine._evaluate_branches 每次请求、每条分支都要调用
+evaluate_condition_definition：重新跑 parse_condition_signature 的正则、
+parse_condition_literal 的字面量解析，_extract_condition_var 再跑一次 re.search。
+这些都只取决于配置本身，DiagnosisConfigStore._normalize_structured_pipeline 现在
+调用 compile_step_plans 一次性编译，放进 bundle["step_plans"]；
+_walk_subtree 遍历时只剩「按变量名查 context + 比较」。
+
+编译后的求值与 evaluate_condition_definition 逐字段一致（返回同样的
+(matched, var, operator, limit, value) 五元组），无法解析的字符串条件同样
+在求值时告警并视为不匹配。
+"""
+import logging
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.engine.condition_evaluator import (
+    eval_comparison,
+    normalize_condition_text,
+    parse_condition_signature,
+)
+
+logger = logging.getLogger(__name__)
+
+ConditionResult = Tuple[bool, Optional[str], str, Any, Any]
+ConditionFn = Callable[[Dict[str, Any]], ConditionResult]
+
+_CONDITION_VAR_RE = re.compile(r"\{([^}]+)\}")
+
+
+def is_else_condition(condition: Any) -> bool:
+    """else / 无条件回退：与 rule_validator 约定一致（仅 condition，不用 operator/limit）。"""
+    return condition == "else" or condition is None or (
+        isinstance(condition, str) and not condition.strip()
+    )
+
+
+def extract_condition_var(condition: Any) -> Optional[str]:
+    """从 condition 提取展示用的主变量名（dict 取 compare.left，字符串取第一个 {var}）。"""
+    if isinstance(condition, dict):
+        compare = condition.get("compare")
+        if isinstance(compare, dict) and compare.get("left"):
+            return str(compare.get("left"))
+        return None
+    m = _CONDITION_VAR_RE.search(str(condition))
+    return m.group(1).strip() if m else None
+
+
+# ── 条件闭包 ────────────────────────────────────────────────────────────────
+
+
+def _constant(result: ConditionResult) -> ConditionFn:
+    return lambda context: result
+
+
+def _compile_text(condition: str, fallback_metric_id: Optional[str]) -> ConditionFn:
+    signature = parse_condition_signature(condition)
+    if signature is None:
+        expr = normalize_condition_text(condition)
+        snippet = expr if len(expr) <= 200 else expr[:200] + "..."
+        miss: ConditionResult = (False, fallback_metric_id, "", None, None)
+
+        def unparsable(context: Dict[str, Any]) -> ConditionResult:
+            logger.warning(
+                "condition 无法解析为原子表达式（将视为不匹配）: %r fallback_metric_id=%s",
+                snippet,
+                fallback_metric_id,
+            )
+            return miss
+
+        return unparsable
+
+    sig_type = signature["type"]
+    if sig_type == "always":
+        return _constant((True, fallback_metric_id, "", None, None))
+
+    if sig_type == "range":
+        var_name = signature["var"]
+        limits = signature["limit"]
+        lo, hi = limits
+
+        def in_range(context: Dict[str, Any]) -> ConditionResult:
+            value = context.get(var_name)
+            if value is None:
+                return False, var_name, "between", limits, None
+            try:
+                numeric_value = float(value)
+            except (TypeError, ValueError):
+                return False, var_name, "between", limits, value
+            return lo < numeric_value < hi, var_name, "between", limits, numeric_value
+
+        return in_range
+
+    if sig_type == "comparison":
+        var_name = signature["var"]
+        operator = signature["operator"]
+        rhs_var_name = signature.get("rhs_var")
+        if rhs_var_name:
+            def compare_vars(context: Dict[str, Any]) -> ConditionResult:
+                rhs_value = context.get(rhs_var_name)
+                left_value = context.get(var_name)
+                if left_value is None:
+                    return False, var_name, operator, rhs_value, None
+                if rhs_value is None:
+                    return False, var_name, operator, rhs_var_name, left_value
+                return eval_comparison(left_value, operator, rhs_value), var_name, operator, rhs_value, left_value
+
+            return compare_vars
+
+        rhs_value = signature.get("rhs")
+
+        def compare_literal(context: Dict[str, Any]) -> ConditionResult:
+            left_value = context.get(var_name)
+            if left_value is None:
+                return False, var_name, operator, rhs_value, None
+            return eval_comparison(left_value, operator, rhs_value), var_name, operator, rhs_value, left_value
+
+        return compare_literal
+
+    # else 等非条件签名：与 evaluate_condition_text 一样恒不匹配
+    return _constant((False, fallback_metric_id, "", None, None))
+
+
+def compile_condition(condition: Any, fallback_metric_id: Optional[str] = None) -> ConditionFn:
+    """把 condition 定义编译成闭包，返回值与 evaluate_condition_definition 相同。"""
+    if isinstance(condition, str):
+        return _compile_text(condition, fallback_metric_id)
+    if not isinstance(condition, dict):
+        return _constant((False, fallback_metric_id, "", None, None))
+
+    if "compare" in condition and isinstance(condition["compare"], dict):
+        spec = condition["compare"]
+        left_name = str(spec.get("left", "")).strip()
+        operator = str(spec.get("operator", spec.get("op", ""))).strip()
+        right = spec.get("right")
+        if not left_name:
+            return _constant((False, fallback_metric_id, "", None, None))
+
+        def compare(context: Dict[str, Any]) -> ConditionResult:
+            value = context.get(left_name)
+            if value is None:
+                return False, left_name, operator, right, None
+            return eval_comparison(value, operator, right), left_name, operator, right, value
+
+        return compare
+
+    if "all_of" in condition:
+        items = [compile_condition(item, fallback_metric_id) for item in condition.get("all_of", []) or []]
+
+        def all_of(context: Dict[str, Any]) -> ConditionResult:
+            return bool(items) and all(item(context)[0] for item in items), None, "all_of", None, None
+
+        return all_of
+
+    if "any_of" in condition:
+        items = [compile_condition(item, fallback_metric_id) for item in condition.get("any_of", []) or []]
+
+        def any_of(context: Dict[str, Any]) -> ConditionResult:
+            return any(item(context)[0] for item in items), None, "any_of", None, None
+
+        return any_of
+
+    if "not" in condition:
+        inner = compile_condition(condition.get("not"), fallback_metric_id)
+
+        def negate(context: Dict[str, Any]) -> ConditionResult:
+            return (not inner(context)[0]), None, "not", None, None
+
+        return negate
+
+    return _constant((False, fallback_metric_id, "", None, None))
+
+
+# ── 分支与步骤 ──────────────────────────────────────────────────────────────
+
+
+@dataclass(frozen=True)
+class BranchPlan:
+    """一条 next 分支：target 与预编译条件；evaluate 为 None 表示 else 分支。"""
+
+    branch: Dict[str, Any]
+    target: Any
+    condition: Any
+    evaluate: Optional[ConditionFn]
+    # 展示用的主变量名：condition 里的 {var} / compare.left，缺省为 step.metric_id
+    var_name: Optional[str]
+
+    @property
+    def is_else(self) -> bool:
+        return self.evaluate is None
+
+
+@dataclass(frozen=True)
+class StepPlan:
+    """一个 step 的编译结果；step / next 保留原对象引用，用于判断编译结果是否仍对应当前配置。"""
+
+    step_id: str
+    step: Dict[str, Any]
+    next: Any
+    branches: Tuple[BranchPlan, ...]
+
+
+def compile_branch_plans(metric_id: Optional[str], branches: List[Dict[str, Any]]) -> Tuple[BranchPlan, ...]:
+    plans: List[BranchPlan] = []
+    for branch in branches or []:
+        condition = branch.get("condition")
+        if is_else_condition(condition):
+            plans.append(BranchPlan(branch, branch.get("target"), condition, None, None))
+            continue
+        plans.append(
+            BranchPlan(
+                branch=branch,
+                target=branch.get("target"),
+                condition=condition,
+                evaluate=compile_condition(condition, metric_id),
+                var_name=extract_condition_var(condition) or metric_id,
+            )
+        )
+    return tuple(plans)
+
+
+def compile_step_plan(step: Dict[str, Any]) -> StepPlan:
+    next_branches = step.get("next")
+    return StepPlan(
+        step_id=str(step.get("id")),
+        step=step,
+        next=next_branches,
+        branches=compile_branch_plans(step.get("metric_id"), next_branches or []),
+    )
+
+
+def compile_step_plans(steps: List[Dict[str, Any]]) -> Dict[str, StepPlan]:
+    return {str(step.get("id")): compile_step_plan(step) for step in steps or [] if "id" in step}
@@ -0,0 +1,178 @@
+"""
+子树读写集（SubtreeEffects）：pipeline 加载时为每个 step 计算「从它出发可达的整棵子图」
+会读 / 写哪些 context 键，供多目标分支（next.target 为列表）判断子分支能否并发执行。
+
+过去 DiagnosisEngine._walk_subtree 对 target 列表里的子分支逐个串行执行并共享 context，
+子分支各自取数建模（action 可能查库）的耗时直接相加。现在：
+  - 两个子分支之间没有数据冒险（一方写的键不被另一方读写）时并发执行，
+    各自在 context 的独立副本（overlay）上运行，结束后按声明顺序合并写入的键
+  - 存在冒险的子分支（如 221/231/241 都读改写 normal_count）放到更靠后的批次，
+    等前面与之冲突的子分支合并完再执行，结果与串行一致
+
+读写集来自配置与 action 注册时的声明（actions.register 的 reads / writes）：
+  - 读：step.metric_id、details[].params 的 "{var}" / 空值同名键、action 声明的 reads、分支 condition 变量
+  - 写：details[].results 声明的键、action 声明的 writes、分支 set 的键；写入的键同时视为读
+  - action 拿到整个 context、输出也不按 results 过滤，未声明 reads 或 writes 的 action
+    读写集未知，视为不透明，与任何子分支都冲突（一律串行）
+引擎内部键（__leaf_result__）每个叶子都会写、步骤不读，按声明顺序合并即与串行一致，不计入冒险。
+
+分批结果只取决于配置：build_subtree_index 编译时为每个多目标 target 列表算好，运行时只读。
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Sequence, Tuple
+
+from app.engine.actions import action_reads, action_writes
+from app.engine.condition_evaluator import extract_vars_from_definition
+
+Schedule = Tuple[Tuple[int, ...], ...]
+
+
+@dataclass(frozen=True)
+class SubtreeEffects:
+    reads: FrozenSet[str] = frozenset()
+    writes: FrozenSet[str] = frozenset()
+    # 存在未声明 reads / writes 的 action：读写集未知
+    opaque: bool = False
+
+    def conflicts_with(self, other: "SubtreeEffects") -> bool:
+        if self.opaque or other.opaque:
+            return True
+        return bool(self.writes & (other.reads | other.writes) or other.writes & self.reads)
+
+    def union(self, other: "SubtreeEffects") -> "SubtreeEffects":
+        return SubtreeEffects(
+            reads=self.reads | other.reads,
+            writes=self.writes | other.writes,
+            opaque=self.opaque or other.opaque,
+        )
+
+
+@dataclass(frozen=True)
+class SubtreeIndex:
+    # 编译时的 steps 引用：RuleLoader 据此判断 steps 被替换后重建
+    steps: Any
+    effects: Dict[str, SubtreeEffects]
+    # 配置里出现的每个 target 列表 → 分批结果（编译时算好，多线程只读）
+    schedules: Dict[Tuple[str, ...], Schedule]
+
+    def get(self, step_id: str) -> SubtreeEffects:
+        return self.effects.get(str(step_id), SubtreeEffects())
+
+    def schedule(self, children: Sequence[str]) -> Schedule:
+        key = tuple(str(child) for child in children)
+        stages = self.schedules.get(key)
+        if stages is None:
+            stages = schedule_children([self.get(child) for child in key])
+        return stages
+
+
+def step_effects(step: Dict[str, Any]) -> SubtreeEffects:
+    """单个 step 自身（不含后继）的读写集。"""
+    reads: set = set()
+    writes: set = set()
+    opaque = False
+    if step.get("metric_id"):
+        reads.add(str(step["metric_id"]))
+    for item in step.get("details") or []:
+        if not isinstance(item, dict) or not item.get("action"):
+            continue
+        params = item.get("params") or {}
+        for key, raw_value in params.items():
+            if raw_value is None or raw_value == "":
+                reads.add(str(key))
+            else:
+                reads.update(extract_vars_from_definition(raw_value))
+        declared = item.get("results")
+        if isinstance(declared, dict):
+            writes.update(str(key) for key in declared)
+        action_name = str(item["action"])
+        implicit_reads = action_reads(action_name, params)
+        implicit_writes = action_writes(action_name, params)
+        if implicit_reads is None or implicit_writes is None:
+            opaque = True
+        else:
+            reads |= implicit_reads
+            writes |= implicit_writes
+    for branch in step.get("next") or []:
+        reads.update(extract_vars_from_definition(branch.get("condition")))
+        writes.update(str(key) for key in (branch.get("set") or {}))
+    reads |= writes
+    return SubtreeEffects(reads=frozenset(reads), writes=frozenset(writes), opaque=opaque)
+
+
+def _successors(step: Dict[str, Any]) -> List[str]:
+    successors: List[str] = []
+    for branch in step.get("next") or []:
+        target = branch.get("target")
+        if target is None:
+            continue
+        successors.extend(str(item) for item in (target if isinstance(target, list) else [target]))
+    return successors
+
+
+def build_subtree_index(steps: List[Dict[str, Any]]) -> SubtreeIndex:
+    """为每个 step 汇总其可达子图（含自身、含回路）的读写集。"""
+    steps_map = {str(step.get("id")): step for step in steps or [] if "id" in step}
+    own = {step_id: step_effects(step) for step_id, step in steps_map.items()}
+    effects: Dict[str, SubtreeEffects] = {}
+    for step_id in steps_map:
+        combined = SubtreeEffects()
+        seen = {step_id}
+        queue = [step_id]
+        while queue:
+            current = queue.pop()
+            combined = combined.union(own[current])
+            for successor in _successors(steps_map[current]):
+                if successor in steps_map and successor not in seen:
+                    seen.add(successor)
+                    queue.append(successor)
+        effects[step_id] = combined
+    schedules: Dict[Tuple[str, ...], Schedule] = {}
+    for step in steps_map.values():
+        for branch in step.get("next") or []:
+            target = branch.get("target")
+            if isinstance(target, list):
+                key = tuple(str(item) for item in target)
+                if key not in schedules:
+                    schedules[key] = schedule_children(
+                        [effects.get(child, SubtreeEffects()) for child in key]
+                    )
+    return SubtreeIndex(steps=steps, effects=effects, schedules=schedules)
+
+
+def schedule_children(effects: Sequence[SubtreeEffects]) -> Schedule:
+    """
+    把多目标子分支（按声明顺序的下标）分成若干批：同批互不冲突、可并发；
+    每个子分支排在所有与之冲突的、声明更早的子分支之后的批次。
+    """
+    stage_of: List[int] = []
+    for index, current in enumerate(effects):
+        stage = 0
+        for earlier in range(index):
+            if effects[earlier].conflicts_with(current):
+                stage = max(stage, stage_of[earlier] + 1)
+        stage_of.append(stage)
+    stages: List[List[int]] = [[] for _ in range(max(stage_of, default=-1) + 1)]
+    for index, stage in enumerate(stage_of):
+        stages[stage].append(index)
+    return tuple(tuple(stage) for stage in stages)
+
+
+def overlay_writes(base: Dict[str, Any], child_context: Dict[str, Any]) -> Dict[str, Any]:
+    """子分支在 context 副本上写入（新增或替换）的键。"""
+    return {
+        key: value
+        for key, value in child_context.items()
+        if key not in base or base[key] is not value
+    }
+
+
+def merge_overlays(context: Dict[str, Any], overlays: Sequence[Tuple[int, Dict[str, Any]]]) -> None:
+    """
+    按子分支声明顺序把各自的写入合并回 context（in-place）。
+
+    同一个键只会被互相冲突的子分支共同写入，它们按声明顺序分在先后批次，
+    因此全部批次结束后再按声明顺序整体合并一次，每个键的终值即串行时最后写入者的值。
+    """
+    for _, overlay in sorted(overlays, key=lambda item: item[0]):
+        context.update(overlay)
@@ -0,0 +1,200 @@
+"""
+指标阈值索引（ThresholdIndex）：pipeline 加载时为每个指标预先解析展示用阈值。
+
+过去 DiagnosisEngine._build_metrics_list 对每个指标调用 _find_threshold：每次重建
+alias 映射、遍历全部 steps、对每条分支重跑 parse_condition_signature；缓存命中的详情
+（_build_detail_from_cache）还要为每个 any_of 指标重新挑选命中分支的展示文本。
+这些只取决于配置，DiagnosisConfigStore._normalize_structured_pipeline 现在调用
+build_threshold_index 一次性算好，放进 bundle["threshold_index"]，reload() 随新 bundle 重建。
+
+查找规则与原 _find_threshold 一致：
+1. 别名（metric.alias_of）先映射到原始 metric_id
+2. 按 steps 顺序找第一个 metric_id 或分支变量引用该指标、且有 operator+limit 的步骤
+3. 多个合法区间/边界 → any_of；否则优先 between，再取第一个比较分支
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.engine.condition_evaluator import parse_condition_signature
+
+_COMPARISON_OPERATORS = {">", "<", ">=", "<=", "==", "!="}
+
+# (operator, limit, 命中该分支时的展示文本)
+BranchDisplay = Tuple[str, Any, Optional[str]]
+
+
+@dataclass(frozen=True)
+class ThresholdEntry:
+    """一个指标的展示阈值；info 为接口返回的 {operator, limit, display[, branchDisplays]}，只读。"""
+
+    info: Dict[str, Any]
+    # any_of：各合法分支按配置顺序的 (operator, limit, display)，display 已做缺省回退
+    branches: Tuple[BranchDisplay, ...] = ()
+
+    def matches(self, threshold: Dict[str, Any]) -> bool:
+        """缓存里的阈值是否仍与当前配置一致（配置变更后缓存行按原样处理）。"""
+        return (
+            threshold.get("operator") == self.info.get("operator")
+            and threshold.get("limit") == self.info.get("limit")
+        )
+
+
+@dataclass(frozen=True)
+class ThresholdIndex:
+    # 编译时的 steps / metrics 引用：RuleLoader 据此判断 steps 被替换（测试、动态注入）后重建
+    steps: Any
+    metrics: Any
+    entries: Dict[str, Optional[ThresholdEntry]]
+
+    def get(self, metric_id: str) -> Optional[ThresholdEntry]:
+        return self.entries.get(metric_id)
+
+
+def format_branch_display(metric_name: str, operator: str, limit: Any) -> Optional[str]:
+    metric_expr = f"{{{metric_name}}}" if metric_name else "{value}"
+    if operator == "between" and isinstance(limit, list) and len(limit) == 2:
+        return f"{limit[0]} < {metric_expr} < {limit[1]}"
+    if operator in _COMPARISON_OPERATORS and limit is not None:
+        return f"{metric_expr} {operator} {limit}"
+    return None
+
+
+def build_alias_map(metrics: Dict[str, Any]) -> Dict[str, str]:
+    """
+    从 metrics 元数据反查 alias 映射：metric.alias_of 字段声明 alias。
+
+        "output_Tx": {"source_kind": "intermediate", "alias_of": "Tx", "approximate": true}
+
+    Returns:
+        { alias_metric_id: target_metric_id }
+    """
+    alias_map: Dict[str, str] = {}
+    for mid, meta in (metrics or {}).items():
+        if not isinstance(meta, dict):
+            continue
+        alias = meta.get("alias_of")
+        if alias:
+            alias_map[str(mid)] = str(alias).strip()
+    return alias_map
+
+
+def _parse_threshold_branches(step: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """解析 step 的 next 分支里可作为阈值展示的条件（区间与「变量 op 字面量」比较）。"""
+    parsed: List[Dict[str, Any]] = []
+    # 显式 "next": null 时 step.get("next", []) 仍返回 None；用 `or []` 兜底，
+    # 与 rule_validator 对 null/空数组等价的处理保持一致。
+    for branch in step.get("next") or []:
+        condition = str(branch.get("condition", "")).strip()
+        if not condition or condition == "else":
+            continue
+        signature = parse_condition_signature(condition)
+        if not signature:
+            continue
+        sig_type = signature.get("type")
+        if sig_type == "range":
+            parsed.append(
+                {
+                    "var": signature.get("var"),
+                    "operator": "between",
+                    "limit": signature.get("limit"),
+                    "condition": condition,
+                }
+            )
+            continue
+        if sig_type == "comparison":
+            rhs_var = signature.get("rhs_var")
+            rhs_value = signature.get("rhs")
+            if rhs_var is not None or rhs_value is None:
+                continue
+            parsed.append(
+                {
+                    "var": signature.get("var"),
+                    "operator": signature.get("operator"),
+                    "limit": rhs_value,
+                    "condition": condition,
+                }
+            )
+    return parsed
+
+
+def _resolve(lookup_id: str, parsed_steps: List[Tuple[Any, List[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+    for step_metric_id, parsed_branches in parsed_steps:
+        branch_refs_lookup = any(str(item.get("var")) == lookup_id for item in parsed_branches)
+        if step_metric_id != lookup_id and not branch_refs_lookup:
+            continue
+
+        valid_branches = []
+        for branch in parsed_branches:
+            op = str(branch.get("operator", "")).strip()
+            limit = branch.get("limit")
+            branch_var = str(branch.get("var", "")).strip()
+            if branch_refs_lookup and branch_var != lookup_id:
+                continue
+            if op and limit is not None:
+                valid_branches.append({"operator": op, "limit": limit, "condition": branch["condition"]})
+
+        if not valid_branches:
+            continue
+
+        between_branches = [b for b in valid_branches if b["operator"] == "between"]
+        comparison_branches = [b for b in valid_branches if b["operator"] in _COMPARISON_OPERATORS]
+
+        # Mwx_0 这类「多个有效区间/边界共同组成正常条件」的步骤，不能错误折叠成单个 between。
+        if len(between_branches) > 1 or (between_branches and comparison_branches):
+            return {
+                "operator": "any_of",
+                "limit": [{"operator": b["operator"], "limit": b["limit"]} for b in valid_branches],
+                "display": " or ".join(b["condition"] for b in valid_branches if b["condition"]),
+                "branchDisplays": [b["condition"] or None for b in valid_branches],
+            }
+
+        # 次优：单独 between 分支（如 output_Mw between [-20, 20]）
+        for branch in between_branches:
+            if isinstance(branch["limit"], list):
+                return {"operator": "between", "limit": branch["limit"], "display": branch["condition"] or None}
+
+        # 末选：第一个有 operator 的分支（≤、≥ 等，如 n_88um ≤ 8）
+        branch = valid_branches[0]
+        return {"operator": branch["operator"], "limit": branch["limit"], "display": branch["condition"] or None}
+    return None
+
+
+def _entry(metric_id: str, info: Optional[Dict[str, Any]]) -> Optional[ThresholdEntry]:
+    if info is None:
+        return None
+    if info["operator"] != "any_of":
+        return ThresholdEntry(info=info)
+    display = info.get("display")
+    branch_displays = info.get("branchDisplays") or []
+    branches = []
+    for index, item in enumerate(info["limit"]):
+        branch_display = branch_displays[index] if index < len(branch_displays) else None
+        branches.append(
+            (
+                item["operator"],
+                item["limit"],
+                branch_display or format_branch_display(metric_id, item["operator"], item["limit"]) or display,
+            )
+        )
+    return ThresholdEntry(info=info, branches=tuple(branches))
+
+
+def build_threshold_index(steps: List[Dict[str, Any]], metrics: Dict[str, Any]) -> ThresholdIndex:
+    """
+    为 metrics 里的每个指标、以及 steps 引用到的每个变量预先解析阈值。
+
+    不在索引里的 id 既没有步骤引用也不是别名，原查找同样返回 None。
+    """
+    alias_map = build_alias_map(metrics)
+    parsed_steps = [(step.get("metric_id"), _parse_threshold_branches(step)) for step in steps or []]
+    metric_ids = set(metrics or {})
+    for step_metric_id, parsed_branches in parsed_steps:
+        if step_metric_id:
+            metric_ids.add(step_metric_id)
+        metric_ids.update(str(item.get("var")) for item in parsed_branches)
+
+    entries = {
+        metric_id: _entry(metric_id, _resolve(alias_map.get(metric_id, metric_id), parsed_steps))
+        for metric_id in metric_ids
+    }
+    return ThresholdIndex(steps=steps, metrics=metrics, entries=entries)
@@ -4,6 +4,7 @@ import sys
 import logging
 import traceback
 import json
+import threading
 import time
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
@@ -26,6 +27,8 @@ from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from app.handler import reject_errors
+from app.engine.metric_fetcher import metric_window_cache_stats
+from app.ods.clickhouse_ods import clickhouse_pool_stats, reset_clickhouse_pool
 from app.utils import detail_trace
 
 # ── 日志配置 ──────────────────────────────────────────────────────────────────
@@ -65,6 +68,26 @@ else:
 
 logger.info("CORS allow_origins: %s", _cors_origins)
 
+# 启动时从 system.columns 探测 ClickHouse 指标时间列类型（0 关闭，排障或离线环境用）
+CH_TIME_COLUMN_PROBE = os.environ.get("CH_TIME_COLUMN_PROBE", "1").strip() not in {"0", "false", "no"}
+
+
+def _probe_clickhouse_time_columns() -> None:
+    """收集各 pipeline 中未声明 time_column_type 的 ClickHouse 指标 (表, 时间列) 并探测类型。"""
+    from app.diagnosis.config_store import DiagnosisConfigStore
+    from app.ods.clickhouse_ods import probe_time_column_types
+
+    try:
+        store = DiagnosisConfigStore()
+        pairs = set()
+        for pipeline_id in store.list_pipelines():
+            for plan in (store.get_pipeline(pipeline_id).get("metric_plans") or {}).values():
+                if plan.source_kind == "clickhouse_window" and plan.table_name and not plan.time_column_type:
+                    pairs.add((plan.table_name, plan.time_column))
+        probe_time_column_types(pairs)
+    except Exception as exc:
+        logger.warning("ClickHouse 时间列类型探测未完成: %s", exc)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -76,7 +99,11 @@ async def lifespan(app: FastAPI):
         os.environ.get("UIX_DETAIL_TRACE", "1"),
         _cors_env or "default_local",
     )
+    if CH_TIME_COLUMN_PROBE:
+        # 后台线程探测，ClickHouse 不可达时不拖慢启动
+        threading.Thread(target=_probe_clickhouse_time_columns, name="ch-time-probe", daemon=True).start()
     yield
+    reset_clickhouse_pool()
 
 
 app = FastAPI(
@@ -186,4 +213,6 @@ async def health():
         "status": "healthy",
         "appEnv": os.environ.get("APP_ENV", "local"),
         "frontendApiUrl": _load_frontend_api_url(),
+        "metricCache": metric_window_cache_stats(),
+        "clickhousePool": clickhouse_pool_stats(),
     }
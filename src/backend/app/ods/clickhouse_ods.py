@@ -10,12 +10,18 @@ ClickHouse 表约定（SMEE LAS 系统）：
   - extraction_rule：本模块仅处理以 `regex:` 开头的规则；`json:<key>` 仅在 MySQL 路径（metric_fetcher._apply_extraction_rule）生效，勿在 ClickHouse 指标上依赖 json 提取。
 """
 import clickhouse_connect
+from clickhouse_connect.driver.external import ExternalData
 import logging
 import re
+import threading
 import time
-from typing import Optional, List, Dict, Any
+from contextlib import nullcontext
+from typing import Optional, List, Dict, Any, Iterable, Iterator, Tuple
 
+from app.ods.clickhouse_pool import ClickHouseClientPool
 from app.utils import detail_trace
+from app.utils.column_arrays import columns_from_numpy, columns_from_rows
+from app.utils.clickhouse_types import STRING_TIME_COLUMN, TimeColumnType, parse_time_column_type
 
 _CH_IDENT_SEGMENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_\.]*$")
 import json
@@ -42,20 +48,83 @@ def _ch_quote_ident(name: str) -> str:
 
 # ============== 数据库配置 ==============
 
+_CONNECTIONS_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "..", "config", "connections.json")
+
+# 连接设置按 APP_ENV 只解析一次；改 connections.json 后调用 reset_clickhouse_pool() 生效
+_clickhouse_config_cache: Dict[str, Dict[str, Any]] = {}
+_clickhouse_config_lock = threading.Lock()
+
+
+def _load_clickhouse_config() -> Dict[str, Any]:
+    """读取 connections.json 中当前 APP_ENV 的 clickhouse 段；文件缺失返回空 dict。"""
+    app_env = os.environ.get("APP_ENV", "local")
+    with _clickhouse_config_lock:
+        if app_env not in _clickhouse_config_cache:
+            config: Dict[str, Any] = {}
+            if os.path.exists(_CONNECTIONS_PATH):
+                with open(_CONNECTIONS_PATH, "r", encoding="utf-8") as f:
+                    connections = json.load(f)
+                config = connections.get(app_env, {}).get("clickhouse", {}) or {}
+            _clickhouse_config_cache[app_env] = config
+        return _clickhouse_config_cache[app_env]
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning("%s=%r 非法，回退到 %s", name, os.environ.get(name), default)
+        return default
+
+
+# ── Client 池：同时借出上限、借出等待秒数、空闲多久后借出前做健康检查 ──
+CH_POOL_MAX_SIZE = max(1, int(_env_number("CH_POOL_MAX_SIZE", 8)))
+CH_POOL_ACQUIRE_TIMEOUT_SECONDS = _env_number("CH_POOL_ACQUIRE_TIMEOUT_SECONDS", 10)
+CH_POOL_HEALTHCHECK_SECONDS = _env_number("CH_POOL_HEALTHCHECK_SECONDS", 60)
+
+# 按块读取（stream_rows_in_window）的服务端执行时间上限秒数；0 表示不设
+CH_MAX_EXECUTION_TIME_SECONDS = max(0, int(_env_number("CH_MAX_EXECUTION_TIME_SECONDS", 60)))
+
+_client_pool = ClickHouseClientPool(
+    CH_POOL_MAX_SIZE,
+    acquire_timeout=CH_POOL_ACQUIRE_TIMEOUT_SECONDS,
+    healthcheck_seconds=CH_POOL_HEALTHCHECK_SECONDS,
+)
+
+
+def clickhouse_client():
+    """
+    从进程级池借出 Client（with 语句）：
+
+        with clickhouse_client() as client:
+            client.query(...)
+
+    新建 Client 时走 get_clickhouse_client()（按调用时的模块属性取，测试替换后立即生效）。
+    """
+    return _client_pool.acquire(get_clickhouse_client)
+
+
+def clickhouse_pool_stats() -> Dict[str, Any]:
+    """Client 池借出/空闲/新建/复用/丢弃计数（/health 展示用）。"""
+    return _client_pool.stats()
+
+
+def reset_clickhouse_pool() -> None:
+    """关闭空闲 Client 并清空连接设置缓存（切换环境或进程退出时调用）。"""
+    _client_pool.close()
+    with _clickhouse_config_lock:
+        _clickhouse_config_cache.clear()
+
+
 def get_clickhouse_client():
     """
-    获取 ClickHouse 客户端
+    创建一个新的 ClickHouse 客户端（由 Client 池调用；业务查询请用 clickhouse_client()）
 
     从 config/connections.json 读取配置，由 APP_ENV 环境变量选择环境。
     只需修改 connections.json，无需改代码。
     """
-    config_path = os.path.join(os.path.dirname(__file__), "..", "..", "..", "..", "config", "connections.json")
-    app_env = os.environ.get("APP_ENV", "local")
-
-    if os.path.exists(config_path):
-        with open(config_path, "r", encoding="utf-8") as f:
-            connections = json.load(f)
-        config = connections.get(app_env, {}).get("clickhouse", {})
+    if os.path.exists(_CONNECTIONS_PATH):
+        config = _load_clickhouse_config()
         if config:
             return clickhouse_connect.get_client(
                 host=config.get("host", "localhost"),
@@ -70,6 +139,261 @@ def get_clickhouse_client():
     )
 
 
+# ============== 时间列类型 ==============
+#
+# 解析优先级：指标 meta.time_column_type > connections.json 的 clickhouse.time_column_types
+# （按环境声明 {"db.table": {"time_col": "DateTime64"}}）> 启动时 system.columns 探测 > String 尽力解析。
+
+_time_column_types_lock = threading.Lock()
+_declared_time_column_types: Optional[Dict[Tuple[str, str], TimeColumnType]] = None
+_probed_time_column_types: Dict[Tuple[str, str], TimeColumnType] = {}
+
+
+def _declared_types() -> Dict[Tuple[str, str], TimeColumnType]:
+    global _declared_time_column_types
+    with _time_column_types_lock:
+        if _declared_time_column_types is None:
+            declared: Dict[Tuple[str, str], TimeColumnType] = {}
+            try:
+                raw = _load_clickhouse_config().get("time_column_types") or {}
+            except Exception as exc:
+                logger.warning("读取 clickhouse.time_column_types 失败: %s", exc)
+                raw = {}
+            for table_name, columns in raw.items():
+                for column_name, type_text in (columns or {}).items():
+                    try:
+                        declared[(table_name, column_name)] = parse_time_column_type(type_text)
+                    except ValueError as exc:
+                        logger.warning("connections.json 时间列类型 %s.%s 无效，忽略: %s", table_name, column_name, exc)
+            _declared_time_column_types = declared
+        return _declared_time_column_types
+
+
+def resolve_time_column_type(
+    table_name: str,
+    time_column: str,
+    declared: Optional[str] = None,
+) -> TimeColumnType:
+    """按优先级解析时间列类型；均未知时按 String 尽力解析（兼容旧行为）。"""
+    if declared:
+        return parse_time_column_type(declared)
+    key = (table_name, time_column)
+    found = _declared_types().get(key)
+    if found is not None:
+        return found
+    with _time_column_types_lock:
+        return _probed_time_column_types.get(key, STRING_TIME_COLUMN)
+
+
+def reset_time_column_types() -> None:
+    """清空声明缓存与探测结果（测试与配置热更新用）。"""
+    global _declared_time_column_types
+    with _time_column_types_lock:
+        _declared_time_column_types = None
+        _probed_time_column_types.clear()
+
+
+def probe_time_column_types(pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], TimeColumnType]:
+    """
+    从 system.columns 探测 (表, 时间列) 的实际类型并登记，供未显式声明类型的指标使用。
+
+    表名不带库前缀时按 currentDatabase() 查。探测失败只打 warning 并返回空 dict，
+    对应指标继续走 String 尽力解析。
+    """
+    wanted = sorted({(str(table), str(column)) for table, column in pairs if table and column})
+    if not wanted:
+        return {}
+    conditions: List[str] = []
+    params: Dict[str, Any] = {}
+    for idx, (table_name, column_name) in enumerate(wanted):
+        database, _, table = table_name.rpartition(".")
+        db_expr = f"%(db_{idx})s" if database else "currentDatabase()"
+        if database:
+            params[f"db_{idx}"] = database
+        params[f"table_{idx}"] = table
+        params[f"column_{idx}"] = column_name
+        conditions.append(
+            f"(database = {db_expr} AND table = %(table_{idx})s AND name = %(column_{idx})s)"
+        )
+    query = (
+        "SELECT database, table, name, type, database = currentDatabase() AS is_current\n"
+        "FROM system.columns\n"
+        f"WHERE {' OR '.join(conditions)}"
+    )
+    t0 = time.perf_counter()
+    try:
+        with clickhouse_client() as client:
+            result = client.query(query, parameters=params)
+    except Exception as exc:
+        logger.warning("ClickHouse 时间列类型探测失败，继续使用 String 尽力解析: %s", exc)
+        return {}
+
+    found: Dict[Tuple[str, str], TimeColumnType] = {}
+    for database, table, column_name, type_text, is_current in result.result_set or []:
+        column_type = parse_time_column_type(type_text, strict=False)
+        for key in ((f"{database}.{table}", column_name), (table, column_name) if is_current else None):
+            if key in wanted:
+                found[key] = column_type
+    with _time_column_types_lock:
+        _probed_time_column_types.update(found)
+    detail_trace.info(
+        "CH 时间列类型探测 | 请求=%s | 命中=%s | 耗时=%.1fms | 结果=%s",
+        len(wanted),
+        len(found),
+        (time.perf_counter() - t0) * 1000,
+        detail_trace.preview({f"{t}.{c}": v.kind for (t, c), v in found.items()}, 400),
+    )
+    return found
+
+
+# ── 近似取数：没有抽样键的表（视图、非 MergeTree）SAMPLE 会报 SAMPLING_NOT_SUPPORTED，记住后不再加 SAMPLE ──
+_sampling_unsupported_lock = threading.Lock()
+_sampling_unsupported_tables: set = set()
+
+
+def _sampling_not_supported(exc: Exception) -> bool:
+    text = str(exc)
+    return "SAMPLING_NOT_SUPPORTED" in text or "doesn't support sampling" in text
+
+
+def _settings_kwargs(settings: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """只在有查询级 settings 时才传 settings 参数（不改变普通查询的调用形态）。"""
+    return {"settings": settings} if settings else {}
+
+
+def reset_sampling_support() -> None:
+    with _sampling_unsupported_lock:
+        _sampling_unsupported_tables.clear()
+
+
+def sampling_supported(table_name: str) -> bool:
+    """表是否支持 SAMPLE：不支持的表查询时会去掉抽样按精确读取。"""
+    with _sampling_unsupported_lock:
+        return table_name not in _sampling_unsupported_tables
+
+
+def _row_block_bytes(block: List[Tuple[Any, ...]]) -> int:
+    """块内原始值的近似字节数：字符串 / bytes 按长度，其它标量按 8 字节。"""
+    return sum(
+        len(value) if isinstance(value, (str, bytes, bytearray)) else 8
+        for row in block
+        for value in row
+    )
+
+
+class WindowRowStream:
+    """
+    窗口查询的按块读取：query_row_block_stream 每次只解码一个数据块，调用方逐块提取。
+
+    - 迭代得到按 column_names 排列的行块（list[tuple]），行序与 query_rows_in_window 相同
+    - max_rows / max_bytes：本次读取的行数 / 近似字节预算，用完即停止读取并记 truncated
+    - 调用方提前结束（break 后 close()）时关闭响应流，Client 正常归还连接池
+    - Client 不支持 query_row_block_stream（测试替身等）时回退 query()，整体作为一个块
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        query: str,
+        params: Dict[str, Any],
+        settings: Dict[str, Any],
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ):
+        self.table_name = table_name
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.blocks_read = 0
+        self.truncated = False
+        self.stopped_early = False
+        self._blocks = self._iter_blocks(query, params, settings)
+
+    def __iter__(self) -> Iterator[List[Tuple[Any, ...]]]:
+        return self._blocks
+
+    def close(self) -> None:
+        self._blocks.close()
+
+    def _iter_blocks(
+        self,
+        query: str,
+        params: Dict[str, Any],
+        settings: Dict[str, Any],
+    ) -> Iterator[List[Tuple[Any, ...]]]:
+        t0 = time.perf_counter()
+        try:
+            with clickhouse_client() as client:
+                stream = getattr(client, "query_row_block_stream", None)
+                if callable(stream):
+                    source = stream(query, parameters=params, **_settings_kwargs(settings))
+                else:
+                    result = client.query(query, parameters=params, **_settings_kwargs(settings))
+                    source = nullcontext([result.result_set or []])
+                with source as blocks:
+                    for raw_block in blocks:
+                        block = self._take_budget([tuple(row) for row in raw_block])
+                        if block:
+                            self.blocks_read += 1
+                            try:
+                                yield block
+                            except GeneratorExit:
+                                self.stopped_early = True
+                                break
+                        if self.truncated:
+                            break
+        except Exception as e:
+            detail_trace.error(
+                "CH SQL 流式读取异常 | table=%s | 已读行=%s | 耗时=%.1fms | error=%s",
+                self.table_name,
+                self.rows_read,
+                (time.perf_counter() - t0) * 1000,
+                detail_trace.preview(e, 260),
+            )
+            raise
+        detail_trace.info(
+            "CH SQL 流式读取 | table=%s | 块=%s | 行=%s | 字节≈%s | 预算截断=%s | 提前结束=%s | 耗时=%.1fms",
+            self.table_name,
+            self.blocks_read,
+            self.rows_read,
+            self.bytes_read,
+            self.truncated,
+            self.stopped_early,
+            (time.perf_counter() - t0) * 1000,
+        )
+
+    def _take_budget(self, block: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+        """
+        按剩余行数预算截断本块，并累计行数 / 字节数。真有行被丢弃（行数超出预算）
+        或字节预算用完时才标记 truncated；恰好读满 max_rows 行不算截断。
+        """
+        if self.max_rows is not None and self.rows_read + len(block) > self.max_rows:
+            block = block[: self.max_rows - self.rows_read]
+            self.truncated = True
+        self.rows_read += len(block)
+        self.bytes_read += _row_block_bytes(block)
+        if self.max_bytes is not None and self.bytes_read >= self.max_bytes:
+            self.truncated = True
+        return block
+
+
+# ── 批量按键查询：键集合作为外部数据表随查询上传（见 ClickHouseODS.query_rows_by_keys）──
+KEY_TABLE_NAME = "_lookup_keys"
+_TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _key_text(value: Any) -> str:
+    """键值统一成字符串（与 SQL 侧 toString(列) 比较）；整数值的浮点数去掉 .0，如 chuck_id=1.0 → "1"。"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _keys_tsv(keys: Iterable[Tuple[str, ...]]) -> bytes:
+    return "".join("\t".join(v.translate(_TSV_ESCAPES) for v in key) + "\n" for key in keys).encode("utf-8")
+
+
 # ============== ODS 数据源类 ==============
 
 class ClickHouseODS:
@@ -81,14 +405,481 @@ class ClickHouseODS:
 
     def __init__(self):
         self.client = None
+        self._lease = None
 
     def __enter__(self):
-        self.client = get_clickhouse_client()
+        self._lease = clickhouse_client()
+        self.client = self._lease.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.client:
-            self.client.close()
+        lease, self._lease, self.client = self._lease, None, None
+        if lease is not None:
+            return lease.__exit__(exc_type, exc_val, exc_tb)
+        return False
+
+    @staticmethod
+    def extract_window_values(raw_values: List[Any], extraction_rule: Optional[str] = None) -> List[Any]:
+        """
+        把窗口查询得到的原始列值按 extraction_rule 转成指标值列表（保持输入顺序）。
+
+        - `regex:<pattern>` 有捕获组：取捕获组1转 float；无捕获组：命中即 True；未命中跳过
+        - 无规则：非 None 值转 float
+        """
+        pattern = None
+        if extraction_rule and str(extraction_rule).startswith("regex:"):
+            pattern = re.compile(extraction_rule[6:])
+        values: List[Any] = []
+        for raw in raw_values:
+            if pattern is not None:
+                match = pattern.search(str(raw))
+                if not match:
+                    continue
+                if match.groups():
+                    values.append(float(match.group(1)))
+                else:
+                    values.append(True)
+                continue
+
+            if raw is not None:
+                values.append(float(raw))
+        return values
+
+    @classmethod
+    def query_rows_in_window(
+        cls,
+        table_name: str,
+        column_names: List[str],
+        equipment: str,
+        time_start: datetime,
+        time_end: datetime,
+        reference_time: datetime,
+        time_column: str = DEFAULT_TIME_COLUMN,
+        equipment_column: str = DEFAULT_EQUIPMENT_COLUMN,
+        extra_filters: Optional[List[str]] = None,
+        extra_filter_params: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
+        match_pattern: Optional[str] = None,
+        time_column_type: Optional[str] = None,
+        columnar: bool = False,
+        extract_pattern: Optional[str] = None,
+        sample_ratio: Optional[float] = None,
+        max_rows_to_read: Optional[int] = None,
+    ) -> List[Any]:
+        """
+        在时间窗口 [time_start, time_end] 内一次读取多列原始行（不做提取）。
+
+        供取数计划器合并「同表同窗口同过滤」的多个指标使用：返回的每行按 column_names 顺序排列，
+        行按距 reference_time 由近到远排序；窗口内无数据则为空列表。
+        limit 只取最近 N 行（要求各列非空）；aggregate（avg/min/max/count）聚合成单行。
+        match_pattern：存在性探测，SELECT 1 ... WHERE match(列, pattern) LIMIT 1，
+        有命中返回 [(1,)]，否则空列表（pattern 须为 RE2 兼容写法）。
+        time_column_type：指标声明的时间列类型；未声明时按 resolve_time_column_type 解析。
+        DateTime/DateTime64 列生成原生区间谓词（可走主键/分区裁剪），String 列才做尽力解析。
+        extract_pattern：regex 提取下推（pattern 须为 RE2 兼容写法且带捕获组），每列改为
+        toFloat64OrNull(extract(列, pattern)) 并只保留 match(列, pattern) 的行，LIMIT / 聚合作用于提取值。
+        columnar=True：改为返回按 column_names 顺序的一维 ndarray 列表（每列一个数组），
+        Client 支持 query_np 时直接按列解码成 NumPy 数组，不再逐行构造 tuple。
+        sample_ratio / max_rows_to_read：近似聚合（approximate 指标）。FROM 后加 SAMPLE <ratio>，
+        count 按 _sample_factor 放大回全量估计；读取行数超过上限时按 read_overflow_mode=break
+        返回已读部分。表没有抽样键（视图、非 MergeTree）时自动去掉 SAMPLE 与读取行数上限，
+        按精确查询重试，并记住该表。
+        """
+        t0 = time.perf_counter()
+        sampled = sample_ratio is not None and sampling_supported(table_name)
+        if sample_ratio is not None and not sampled:
+            # 抽样不可用的表按精确查询：行数上限只随 SAMPLE 一起生效，避免截断出部分聚合
+            max_rows_to_read = None
+        try:
+            settings: Dict[str, Any] = {}
+            if max_rows_to_read is not None:
+                settings = {"max_rows_to_read": int(max_rows_to_read), "read_overflow_mode": "break"}
+            query, params = cls._render_window_query(
+                table_name,
+                column_names,
+                equipment,
+                time_start,
+                time_end,
+                reference_time,
+                time_column=time_column,
+                equipment_column=equipment_column,
+                extra_filters=extra_filters,
+                extra_filter_params=extra_filter_params,
+                limit=limit,
+                aggregate=aggregate,
+                match_pattern=match_pattern,
+                time_column_type=time_column_type,
+                extract_pattern=extract_pattern,
+                sample_ratio=sample_ratio if sampled else None,
+                settings=settings,
+            )
+            with clickhouse_client() as client:
+                if columnar:
+                    data = cls._fetch_columns(client, query, params, len(column_names), settings)
+                    row_count = len(data[0]) if data else 0
+                else:
+                    result = client.query(query, parameters=params, **_settings_kwargs(settings))
+                    data = [tuple(row) for row in (result.result_set or [])]
+                    row_count = len(data)
+            if not row_count:
+                detail_trace.warning(
+                    "CH SQL 无行 | table=%s | equipment=%s | 耗时=%.1fms",
+                    table_name,
+                    equipment,
+                    (time.perf_counter() - t0) * 1000,
+                )
+            return data
+
+        except Exception as e:
+            if sampled and _sampling_not_supported(e):
+                with _sampling_unsupported_lock:
+                    _sampling_unsupported_tables.add(table_name)
+                detail_trace.warning("CH SQL 表不支持 SAMPLE，按精确查询重试 | table=%s", table_name)
+                return cls.query_rows_in_window(
+                    table_name,
+                    column_names,
+                    equipment,
+                    time_start,
+                    time_end,
+                    reference_time,
+                    time_column=time_column,
+                    equipment_column=equipment_column,
+                    extra_filters=extra_filters,
+                    extra_filter_params=extra_filter_params,
+                    limit=limit,
+                    aggregate=aggregate,
+                    match_pattern=match_pattern,
+                    time_column_type=time_column_type,
+                    columnar=columnar,
+                    extract_pattern=extract_pattern,
+                    sample_ratio=sample_ratio,
+                    max_rows_to_read=max_rows_to_read,
+                )
+            logger.error("ClickHouse query_rows_in_window 失败: table=%s columns=%s error=%s",
+                         table_name, column_names, e)
+            detail_trace.error(
+                "CH SQL 异常 | table=%s | cols=%s | equipment=%s | 耗时=%.1fms | error=%s",
+                table_name,
+                ",".join(column_names),
+                equipment,
+                (time.perf_counter() - t0) * 1000,
+                detail_trace.preview(e, 260),
+            )
+            raise   # 由调用方决定是否降级 mock
+
+    @classmethod
+    def query_rows_by_keys(
+        cls,
+        table_name: str,
+        column_names: List[str],
+        key_columns: List[str],
+        keys: Iterable[Iterable[Any]],
+        time_start: datetime,
+        time_end: datetime,
+        time_column: str = DEFAULT_TIME_COLUMN,
+        time_column_type: Optional[str] = None,
+        extra_filters: Optional[List[str]] = None,
+        extra_filter_params: Optional[Dict[str, Any]] = None,
+    ) -> Dict[Tuple[str, ...], List[Tuple[Any, ...]]]:
+        """
+        批量 exact_keys 查询：一次往返取回多组键（如多片 wafer 的 equipment/lot_id/chuck_id/wafer_id）的行。
+
+        键集合按 TabSeparated 作为外部数据表 _lookup_keys 随查询上传，SQL 里
+        `(toString(键列), ...) IN _lookup_keys` 与之匹配，代替每组键一条参数化查询。
+        键值按字符串比较（与未声明 type 的 linking 口径一致），浮点整数值按整数写出。
+
+        Args:
+            key_columns: 表中的键列名，顺序与 keys 里每组键一致
+            keys       : 键元组序列，重复的键只上传一次
+            time_start / time_end: 所有键共用的时间窗口（调用方按各键 T 的最小/最大值取并集）
+
+        Returns:
+            {键字符串元组: [(时间, *column_names 的值), ...]}，每个键的行按时间由近到远（倒序）；
+            没有命中行的键不出现在结果中
+        """
+        unique_keys = list(dict.fromkeys(tuple(_key_text(v) for v in key) for key in keys))
+        if not unique_keys:
+            return {}
+        width = len(key_columns)
+        if any(len(key) != width for key in unique_keys):
+            raise ValueError(f"键元组长度须与 key_columns 一致({width})")
+
+        t0 = time.perf_counter()
+        ts_fmt = "%Y-%m-%d %H:%M:%S"
+        column_type = resolve_time_column_type(table_name, time_column, time_column_type)
+        q_time_expr = column_type.column_expr(_ch_quote_ident(time_column))
+        q_keys = [f"toString({_ch_quote_ident(c)})" for c in key_columns]
+        where_clauses = [
+            f"({', '.join(q_keys)}) IN {KEY_TABLE_NAME}",
+            f"{q_time_expr} >= {column_type.param_expr('%(t_start)s')}",
+            f"{q_time_expr} <= {column_type.param_expr('%(t_end)s')}",
+            *(extra_filters or []),
+        ]
+        query = (
+            f"SELECT {', '.join(q_keys)}, {q_time_expr}, {', '.join(_ch_quote_ident(c) for c in column_names)}"
+            f" FROM {_ch_quote_ident(table_name)}"
+            f" WHERE {' AND '.join(where_clauses)}"
+            f" ORDER BY {q_time_expr} DESC"
+        )
+        params = {"t_start": time_start.strftime(ts_fmt), "t_end": time_end.strftime(ts_fmt)}
+        params.update(extra_filter_params or {})
+        external = ExternalData(
+            file_name=KEY_TABLE_NAME,
+            data=_keys_tsv(unique_keys),
+            fmt="TabSeparated",
+            structure=[f"k{i} String" for i in range(width)],
+        )
+        detail_trace.info(
+            "CH SQL 批量按键 | table=%s | cols=%s | key_columns=%s | 键数=%s | window=[%s .. %s] | extra_filters=%s",
+            table_name,
+            ",".join(column_names),
+            ",".join(key_columns),
+            len(unique_keys),
+            params["t_start"],
+            params["t_end"],
+            detail_trace.preview(extra_filters, 200),
+        )
+        try:
+            with clickhouse_client() as client:
+                result = client.query(query, parameters=params, external_data=external)
+        except Exception as e:
+            logger.error("ClickHouse query_rows_by_keys 失败: table=%s keys=%s error=%s",
+                         table_name, len(unique_keys), e)
+            detail_trace.error(
+                "CH SQL 批量按键异常 | table=%s | 键数=%s | 耗时=%.1fms | error=%s",
+                table_name,
+                len(unique_keys),
+                (time.perf_counter() - t0) * 1000,
+                detail_trace.preview(e, 260),
+            )
+            raise
+        grouped: Dict[Tuple[str, ...], List[Tuple[Any, ...]]] = {}
+        for row in result.result_set or []:
+            grouped.setdefault(tuple(row[:width]), []).append(tuple(row[width:]))
+        detail_trace.info(
+            "CH SQL 批量按键完成 | table=%s | 键数=%s | 命中键=%s | 行=%s | 耗时=%.1fms",
+            table_name,
+            len(unique_keys),
+            len(grouped),
+            sum(len(rows) for rows in grouped.values()),
+            (time.perf_counter() - t0) * 1000,
+        )
+        return grouped
+
+    @classmethod
+    def stream_rows_in_window(
+        cls,
+        table_name: str,
+        column_names: List[str],
+        equipment: str,
+        time_start: datetime,
+        time_end: datetime,
+        reference_time: datetime,
+        time_column: str = DEFAULT_TIME_COLUMN,
+        equipment_column: str = DEFAULT_EQUIPMENT_COLUMN,
+        extra_filters: Optional[List[str]] = None,
+        extra_filter_params: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
+        time_column_type: Optional[str] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> WindowRowStream:
+        """
+        与 query_rows_in_window 同一条 SQL，但按数据块读取（见 WindowRowStream）。
+
+        供需要 Python 侧提取的大窗口（如 7 天 LOG_EH_UNION_VIEW 的 detail 列）使用：调用方逐块提取，
+        selection 满足后 break，峰值内存只有一个块。服务端同时设 max_execution_time
+        （CH_MAX_EXECUTION_TIME_SECONDS），有 max_rows 时再设 max_result_rows + result_overflow_mode=break，
+        让服务端也按同一预算停止生成结果；服务端多放一行，客户端据此区分「恰好 max_rows 行」与「有行被截掉」。
+        """
+        settings: Dict[str, Any] = {}
+        if CH_MAX_EXECUTION_TIME_SECONDS > 0:
+            settings["max_execution_time"] = CH_MAX_EXECUTION_TIME_SECONDS
+        if max_rows is not None:
+            settings.update(max_result_rows=int(max_rows) + 1, result_overflow_mode="break")
+        query, params = cls._render_window_query(
+            table_name,
+            column_names,
+            equipment,
+            time_start,
+            time_end,
+            reference_time,
+            time_column=time_column,
+            equipment_column=equipment_column,
+            extra_filters=extra_filters,
+            extra_filter_params=extra_filter_params,
+            limit=limit,
+            aggregate=aggregate,
+            time_column_type=time_column_type,
+            settings=settings,
+        )
+        return WindowRowStream(table_name, query, params, settings, max_rows=max_rows, max_bytes=max_bytes)
+
+    @staticmethod
+    def _render_window_query(
+        table_name: str,
+        column_names: List[str],
+        equipment: str,
+        time_start: datetime,
+        time_end: datetime,
+        reference_time: datetime,
+        time_column: str = DEFAULT_TIME_COLUMN,
+        equipment_column: str = DEFAULT_EQUIPMENT_COLUMN,
+        extra_filters: Optional[List[str]] = None,
+        extra_filter_params: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
+        match_pattern: Optional[str] = None,
+        time_column_type: Optional[str] = None,
+        extract_pattern: Optional[str] = None,
+        sample_ratio: Optional[float] = None,
+        settings: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """渲染窗口查询的 SQL 与参数并记 trace（参数含义见 query_rows_in_window）。"""
+        # ClickHouse 使用 toDateTime 处理时间参数
+        ts_fmt = "%Y-%m-%d %H:%M:%S"
+        t_start_str = time_start.strftime(ts_fmt)
+        t_end_str   = time_end.strftime(ts_fmt)
+        t_ref_str   = reference_time.strftime(ts_fmt)
+
+        q_table = _ch_quote_ident(table_name)
+        quoted_cols = [_ch_quote_ident(c) for c in column_names]
+        if extract_pattern is not None:
+            # regex 提取在服务端完成：只回传命中行、已转成数值的捕获组
+            value_exprs = [
+                f"toFloat64OrNull(extract(toString({c}), %(extract_pattern)s))" for c in quoted_cols
+            ]
+        else:
+            value_exprs = quoted_cols
+        if match_pattern is not None:
+            q_cols = "1"
+        elif aggregate == "count" and sample_ratio is not None:
+            q_cols = ", ".join(f"count({c}) * any(_sample_factor)" for c in value_exprs)
+        elif aggregate:
+            q_cols = ", ".join(f"{aggregate}({c})" for c in value_exprs)
+        else:
+            q_cols = ", ".join(value_exprs)
+        sample_sql = f" SAMPLE {float(sample_ratio)!r}" if sample_ratio is not None else ""
+        q_time = _ch_quote_ident(time_column)
+        q_equip = _ch_quote_ident(equipment_column)
+        column_type = resolve_time_column_type(table_name, time_column, time_column_type)
+        q_time_expr = column_type.column_expr(q_time)
+        where_clauses = list(extra_filters or [])
+        if extract_pattern is not None:
+            where_clauses.extend(f"match(toString({c}), %(extract_pattern)s)" for c in quoted_cols)
+        if match_pattern is not None:
+            # 只关心是否存在命中行，不排序，命中第一行即停止扫描
+            where_clauses.extend(f"match(toString({c}), %(probe_pattern)s)" for c in quoted_cols)
+            tail_sql = "LIMIT 1"
+        elif aggregate:
+            tail_sql = ""
+        else:
+            tail_sql = f"""ORDER BY abs(dateDiff('second',
+                {q_time_expr},
+                {column_type.param_expr("%(t_ref)s")}
+            )) ASC"""
+            if limit is not None:
+                where_clauses.extend(f"{c} IS NOT NULL" for c in value_exprs)
+                tail_sql += f"\n                LIMIT {int(limit)}"
+        query = f"""
+            SELECT {q_cols}
+            FROM {q_table}{sample_sql}
+            WHERE {q_equip} = %(equipment)s
+              AND {q_time_expr} >= {column_type.param_expr("%(t_start)s")}
+              AND {q_time_expr} <= {column_type.param_expr("%(t_end)s")}
+              {"AND " + " AND ".join(where_clauses) if where_clauses else ""}
+            {tail_sql}
+        """
+        params = {
+            "equipment": equipment,
+            "t_start":   t_start_str,
+            "t_end":     t_end_str,
+            "t_ref":     t_ref_str,
+        }
+        if extra_filter_params:
+            params.update(extra_filter_params)
+        if match_pattern is not None:
+            params["probe_pattern"] = match_pattern
+        if extract_pattern is not None:
+            params["extract_pattern"] = extract_pattern
+        detail_trace.info(
+            "CH SQL | APP_ENV=%s | table=%s | cols=%s | time_type=%s | equipment=%s | window=[%s .. %s] | T=%s | extra_filters=%s | limit=%s | aggregate=%s | probe=%s | extract=%s | sample=%s | settings=%s",
+            os.environ.get("APP_ENV", "local"),
+            table_name,
+            ",".join(column_names),
+            column_type.kind,
+            equipment,
+            t_start_str,
+            t_end_str,
+            t_ref_str,
+            detail_trace.preview(extra_filters, 200),
+            limit,
+            aggregate,
+            detail_trace.preview(match_pattern, 120),
+            detail_trace.preview(extract_pattern, 120),
+            sample_ratio,
+            settings or None,
+        )
+        return query, params
+
+    @staticmethod
+    def window_values_subquery(
+        table_name: str,
+        column_name: str,
+        equipment: str,
+        time_start: datetime,
+        time_end: datetime,
+        time_column: str = DEFAULT_TIME_COLUMN,
+        equipment_column: str = DEFAULT_EQUIPMENT_COLUMN,
+        extra_filters: Optional[List[str]] = None,
+        extra_filter_params: Optional[Dict[str, Any]] = None,
+        time_column_type: Optional[str] = None,
+        param_prefix: str = "sq",
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        渲染「窗口内某列的非空值」子查询：SELECT toString(列) FROM ... WHERE 设备/窗口/过滤。
+
+        供 linking `in` 依赖下推使用（如 mark_pos_x 的 mark_id IN (mark_candidates)）：
+        父指标不必先取回 Python 再展开成 IN 列表，而是作为子查询嵌进子指标的 WHERE。
+        toString 与 IN 列表逐个 toString(值) 的比较口径一致。窗口与设备参数带 param_prefix
+        前缀，extra_filters 里的占位符需调用方已按同一前缀命名，避免与外层查询参数冲突。
+        """
+        ts_fmt = "%Y-%m-%d %H:%M:%S"
+        q_column = _ch_quote_ident(column_name)
+        column_type = resolve_time_column_type(table_name, time_column, time_column_type)
+        q_time_expr = column_type.column_expr(_ch_quote_ident(time_column))
+        clauses = [
+            f"{_ch_quote_ident(equipment_column)} = %({param_prefix}_equipment)s",
+            f"{q_time_expr} >= {column_type.param_expr(f'%({param_prefix}_t_start)s')}",
+            f"{q_time_expr} <= {column_type.param_expr(f'%({param_prefix}_t_end)s')}",
+            *(extra_filters or []),
+            f"{q_column} IS NOT NULL",
+        ]
+        query = f"SELECT toString({q_column}) FROM {_ch_quote_ident(table_name)} WHERE " + " AND ".join(clauses)
+        params = {
+            f"{param_prefix}_equipment": equipment,
+            f"{param_prefix}_t_start": time_start.strftime(ts_fmt),
+            f"{param_prefix}_t_end": time_end.strftime(ts_fmt),
+        }
+        params.update(extra_filter_params or {})
+        return query, params
+
+    @staticmethod
+    def _fetch_columns(
+        client: Any,
+        query: str,
+        params: Dict[str, Any],
+        width: int,
+        settings: Optional[Dict[str, Any]] = None,
+    ) -> List[Any]:
+        """列式读取；测试替身等不支持 query_np 的 Client 回退 query() 再按列转数组。"""
+        query_np = getattr(client, "query_np", None)
+        if callable(query_np):
+            return columns_from_numpy(query_np(query, parameters=params, **_settings_kwargs(settings)), width)
+        result = client.query(query, parameters=params, **_settings_kwargs(settings))
+        return columns_from_rows(result.result_set or [], width)
 
     @classmethod
     def query_metric_in_window(
@@ -104,6 +895,11 @@ class ClickHouseODS:
         equipment_column: str = DEFAULT_EQUIPMENT_COLUMN,
         extra_filters: Optional[List[str]] = None,
         extra_filter_params: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        aggregate: Optional[str] = None,
+        time_column_type: Optional[str] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
     ) -> List[Any]:
         """
         在时间窗口 [time_start, time_end] 内查询窗口内的指标值列表。
@@ -123,113 +919,50 @@ class ClickHouseODS:
             extraction_rule : 正则提取规则，仅 detail 类列需要，如 "regex:Mwx\\s*\\(([\\d\\.]+)\\)"
             time_column     : 时间列名（默认 "time"，可被 pipeline 指标配置中的 time_column 字段覆盖）
             equipment_column: 设备列名（默认 "equipment"，可被 pipeline 指标配置中的 equipment_column 字段覆盖）
+            limit / aggregate: 指标 selection 下推的 LIMIT 与聚合函数，见 query_rows_in_window
+            time_column_type: 时间列类型声明（DateTime / DateTime64 / String），见 query_rows_in_window
+            max_rows / max_bytes: 读取预算，见 stream_rows_in_window（按块读取、逐块提取）
 
         Returns:
             提取后的值列表（按距 reference_time 由近到远排序；窗口内无数据则为空列表）
         """
-        client = get_clickhouse_client()
         t0 = time.perf_counter()
+        stream = cls.stream_rows_in_window(
+            table_name,
+            [column_name],
+            equipment,
+            time_start,
+            time_end,
+            reference_time,
+            time_column=time_column,
+            equipment_column=equipment_column,
+            extra_filters=extra_filters,
+            extra_filter_params=extra_filter_params,
+            limit=limit,
+            aggregate=aggregate,
+            time_column_type=time_column_type,
+            max_rows=max_rows,
+            max_bytes=max_bytes,
+        )
+        values: List[Any] = []
         try:
-            # ClickHouse 使用 toDateTime 处理时间参数
-            ts_fmt = "%Y-%m-%d %H:%M:%S"
-            t_start_str = time_start.strftime(ts_fmt)
-            t_end_str   = time_end.strftime(ts_fmt)
-            t_ref_str   = reference_time.strftime(ts_fmt)
-
-            q_table = _ch_quote_ident(table_name)
-            q_col = _ch_quote_ident(column_name)
-            q_time = _ch_quote_ident(time_column)
-            q_equip = _ch_quote_ident(equipment_column)
-            # 内网部分表（如 RPT_WAA_LOT_MARK_INFO_OFL_KAFKA）的 file_time 是 String，
-            # 也有表为 DateTime。统一先 toString 再做 BestEffort 解析，避免 String/DateTime
-            # 混比较触发 NO_COMMON_TYPE。
-            q_time_expr = f"parseDateTimeBestEffortOrNull(toString({q_time}))"
-            query = f"""
-                SELECT {q_col}
-                FROM {q_table}
-                WHERE {q_equip} = %(equipment)s
-                  AND {q_time_expr} >= toDateTime(%(t_start)s)
-                  AND {q_time_expr} <= toDateTime(%(t_end)s)
-                  {"AND " + " AND ".join(extra_filters) if extra_filters else ""}
-                ORDER BY abs(dateDiff('second',
-                    {q_time_expr},
-                    toDateTime(%(t_ref)s)
-                )) ASC
-            """
-            params = {
-                "equipment": equipment,
-                "t_start":   t_start_str,
-                "t_end":     t_end_str,
-                "t_ref":     t_ref_str,
-            }
-            if extra_filter_params:
-                params.update(extra_filter_params)
-            detail_trace.info(
-                "CH SQL | APP_ENV=%s | table=%s | col=%s | equipment=%s | window=[%s .. %s] | T=%s | rule=%s | extra_filters=%s",
-                os.environ.get("APP_ENV", "local"),
-                table_name,
-                column_name,
-                equipment,
-                t_start_str,
-                t_end_str,
-                t_ref_str,
-                detail_trace.preview(extraction_rule, 120),
-                detail_trace.preview(extra_filters, 200),
-            )
-            result = client.query(query, parameters=params)
-            raw_rows = len(result.result_set) if result.result_set else 0
-
-            if not result.result_set:
-                detail_trace.warning(
-                    "CH SQL 无行 | table=%s | equipment=%s | 耗时=%.1fms",
-                    table_name,
-                    equipment,
-                    (time.perf_counter() - t0) * 1000,
-                )
-                return []
-
-            values: List[Any] = []
-            for row in result.result_set:
-                raw = row[0]
-                if extraction_rule and str(extraction_rule).startswith("regex:"):
-                    pattern = extraction_rule[6:]
-                    match = re.search(pattern, str(raw))
-                    if not match:
-                        continue
-                    if match.groups():
-                        val_str = match.group(1)
-                        values.append(float(val_str))
-                    else:
-                        values.append(True)
-                    continue
-
-                if raw is not None:
-                    values.append(float(raw))
-            elapsed_ms = (time.perf_counter() - t0) * 1000
-            detail_trace.info(
-                "CH SQL 完成 | table=%s | raw_rows=%s | extracted=%s | 耗时=%.1fms | sample=%s",
-                table_name,
-                raw_rows,
-                len(values),
-                elapsed_ms,
-                detail_trace.preview(values[:5], 160),
-            )
-            return values
-
-        except Exception as e:
-            logger.error("ClickHouse query_metric_in_window 失败: table=%s column=%s error=%s",
-                         table_name, column_name, e)
-            detail_trace.error(
-                "CH SQL 异常 | table=%s | col=%s | equipment=%s | 耗时=%.1fms | error=%s",
-                table_name,
-                column_name,
-                equipment,
-                (time.perf_counter() - t0) * 1000,
-                detail_trace.preview(e, 260),
-            )
-            raise   # 由调用方决定是否降级 mock
+            # 逐块提取：峰值内存只有一个数据块的原始值
+            for block in stream:
+                values.extend(cls.extract_window_values([row[0] for row in block], extraction_rule))
         finally:
-            client.close()
+            stream.close()
+        if not stream.rows_read:
+            return []
+        detail_trace.info(
+            "CH SQL 完成 | table=%s | raw_rows=%s | extracted=%s | 耗时=%.1fms | rule=%s | sample=%s",
+            table_name,
+            stream.rows_read,
+            len(values),
+            (time.perf_counter() - t0) * 1000,
+            detail_trace.preview(extraction_rule, 120),
+            detail_trace.preview(values[:5], 160),
+        )
+        return values
 
     @classmethod
     def query_log_data(
@@ -242,17 +975,15 @@ class ClickHouseODS:
         limit: int = 100,
     ) -> List[Dict[str, Any]]:
         """通用日志查询，保留供其他模块使用"""
-        client = get_clickhouse_client()
         try:
             select_sql = ", ".join(columns)
             where_clauses = [f"{k} = %({k})s" for k in filter_conditions]
             where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
             order_sql = f"ORDER BY {order_by} {order_dir}" if order_by else ""
             query = f"SELECT {select_sql} FROM {table_name} WHERE {where_sql} {order_sql} LIMIT {limit}"
-            result = client.query(query, parameters=filter_conditions)
+            with clickhouse_client() as client:
+                result = client.query(query, parameters=filter_conditions)
             return [dict(zip(columns, row)) for row in result.result_set]
         except Exception as e:
             logger.error("ClickHouse query_log_data 失败: %s", e)
             return []
-        finally:
-            client.close()
@@ -0,0 +1,151 @@
+"""
+ODS 层 - ClickHouse 客户端池
+
+clickhouse_connect 的 Client 内部持有 HTTP 连接池（keep-alive），长期复用可省去每次查询的
+连接建立 / TLS 握手；但同一个 Client 不能被多个线程同时用来查询（会话锁），
+所以这里按「借出独占、用完归还」管理一组长期存活的 Client：
+
+  - 池容量 max_size：同时借出的上限，达到上限时等待归还（最多 acquire_timeout 秒）
+  - 空闲超过 healthcheck_seconds 的 Client 借出前先 ping，失败则丢弃重建
+  - 查询抛异常时丢弃该 Client（连接状态不可信），下次借出时按需重建
+  - 工厂函数变化（切换环境、测试替换 get_clickhouse_client）时清空空闲 Client
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ClickHousePoolExhausted(RuntimeError):
+    """在 acquire_timeout 内没有可借出的 Client。"""
+
+
+class ClickHouseClientPool:
+    def __init__(self, max_size: int, acquire_timeout: float = 10.0, healthcheck_seconds: float = 60.0):
+        self.max_size = max(1, int(max_size))
+        self.acquire_timeout = float(acquire_timeout)
+        self.healthcheck_seconds = float(healthcheck_seconds)
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._in_use = 0
+        self._factory: Optional[Callable[[], Any]] = None
+        self._cond = threading.Condition()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+        self.healthcheck_failures = 0
+
+    @contextmanager
+    def acquire(self, factory: Callable[[], Any]) -> Iterator[Any]:
+        """借出一个 Client；with 块正常结束时归还，抛异常时丢弃。"""
+        client = self._checkout(factory)
+        try:
+            yield client
+        except BaseException:
+            self._discard(client)
+            raise
+        else:
+            self._checkin(client, factory)
+
+    def _checkout(self, factory: Callable[[], Any]) -> Any:
+        stale = []
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            if self._factory is not factory:
+                stale.extend(client for client, _ in self._idle)
+                self._idle.clear()
+                self._factory = factory
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ClickHousePoolExhausted(
+                        f"ClickHouse 连接池已满(max_size={self.max_size})，{self.acquire_timeout}s 内无归还"
+                    )
+                self.waits += 1
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+        self._close_all(stale)
+
+        try:
+            if entry is not None:
+                client, idle_since = entry
+                if time.monotonic() - idle_since < self.healthcheck_seconds or self._healthy(client):
+                    with self._cond:
+                        self.reused += 1
+                    return client
+                self._close_all([client])
+                with self._cond:
+                    self.discarded += 1
+            client = factory()
+            with self._cond:
+                self.created += 1
+            return client
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _healthy(self, client: Any) -> bool:
+        ping = getattr(client, "ping", None)
+        if not callable(ping):
+            return True
+        try:
+            if ping():
+                return True
+        except Exception as exc:
+            logger.debug("ClickHouse Client 健康检查异常: %s", exc)
+        with self._cond:
+            self.healthcheck_failures += 1
+        return False
+
+    def _checkin(self, client: Any, factory: Callable[[], Any]) -> None:
+        with self._cond:
+            self._in_use -= 1
+            keep = factory is self._factory
+            if keep:
+                self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+        if not keep:
+            self._close_all([client])
+
+    def _discard(self, client: Any) -> None:
+        with self._cond:
+            self._in_use -= 1
+            self.discarded += 1
+            self._cond.notify()
+        self._close_all([client])
+
+    @staticmethod
+    def _close_all(clients) -> None:
+        for client in clients:
+            try:
+                client.close()
+            except Exception as exc:
+                logger.debug("关闭 ClickHouse Client 失败: %s", exc)
+
+    def close(self) -> None:
+        """关闭所有空闲 Client（借出中的 Client 归还时按新工厂判断是否保留）。"""
+        with self._cond:
+            stale = [client for client, _ in self._idle]
+            self._idle.clear()
+            self._factory = None
+        self._close_all(stale)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "maxSize": self.max_size,
+                "idle": len(self._idle),
+                "inUse": self._in_use,
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+                "waits": self.waits,
+                "healthcheckFailures": self.healthcheck_failures,
+            }
@@ -523,3 +523,73 @@ class DatacenterODS:
         finally:
             if should_close:
                 db.close()
+
+    # 允许做窗口聚合的指标列（防止任意列名拼进查询）
+    PERFORMANCE_AGGREGATE_COLUMNS = ("wafer_translation_x", "wafer_translation_y", "wafer_rotation")
+
+    @classmethod
+    def query_performance_aggregate(
+        cls,
+        column_name: str,
+        equipment: str,
+        chuck_id: Any,
+        start_time: datetime,
+        end_time: datetime,
+        db: Optional[Session] = None
+    ) -> Dict[str, Any]:
+        """
+        在 MySQL 端对 lo_batch_equipment_performance 某指标列做窗口聚合（AVG / COUNT / STDDEV）
+
+        过滤口径：equipment + chuck_id + wafer_product_start_time ∈ [start_time, end_time]，
+        走 IDX_equipment / IDX_wafer_product_start_time，只回传一行。
+
+        Args:
+            column_name: 指标列名，仅允许 PERFORMANCE_AGGREGATE_COLUMNS
+            equipment: 机台名称
+            chuck_id: Chuck ID（按字符串比较）
+            start_time: 窗口起点
+            end_time: 窗口终点
+            db: 数据库会话（可选）
+
+        Returns:
+            {"avg": float|None, "count": int, "stddev": float|None}；窗口内无非空值时 avg/stddev 为 None
+        """
+        if column_name not in cls.PERFORMANCE_AGGREGATE_COLUMNS:
+            raise ValueError(f"不支持聚合的指标列: {column_name!r}")
+
+        should_close = False
+        if db is None:
+            db = cls.get_session()
+            should_close = True
+
+        try:
+            col = getattr(LoBatchEquipmentPerformance, column_name)
+            row = db.query(
+                func.avg(col),
+                func.count(col),
+                func.stddev(col),
+            ).filter(
+                LoBatchEquipmentPerformance.equipment == equipment,
+                LoBatchEquipmentPerformance.chuck_id == str(chuck_id),
+                LoBatchEquipmentPerformance.wafer_product_start_time >= start_time,
+                LoBatchEquipmentPerformance.wafer_product_start_time <= end_time,
+            ).one()
+            avg_value, count_value, stddev_value = row
+            result = {
+                "avg": float(avg_value) if avg_value is not None else None,
+                "count": int(count_value or 0),
+                "stddev": float(stddev_value) if stddev_value is not None else None,
+            }
+            detail_trace.info(
+                "ODS 窗口聚合 | column=%s | equipment=%s | chuck=%s | window=[%s .. %s] | %s",
+                column_name,
+                equipment,
+                chuck_id,
+                start_time,
+                end_time,
+                result,
+            )
+            return result
+        finally:
+            if should_close:
+                db.close()
@@ -575,7 +575,8 @@ class RejectErrorService:
                 if hasattr(engine, '_last_fetcher') and engine._last_fetcher is not None:
                     _source_log = engine._last_fetcher.source_log
                     if _source_log:
-                        mock_metrics = [k for k, v in _source_log.items() if v == "mock"]
+                        # 备忘/缓存命中记为 `<来源>:memo` / `<来源>:cache`，按冒号前的来源统计
+                        mock_metrics = [k for k, v in _source_log.items() if v.split(":", 1)[0] == "mock"]
                         real_metrics = [k for k, v in _source_log.items() if v.startswith("real")]
                         logger.info(
                             "指标来源统计: failure_id=%s 真实=%s mock=%s",
@@ -674,10 +675,11 @@ class RejectErrorService:
         # 解析缓存的指标数据
         metrics_raw = cached.metrics_data or []
         all_metrics = []
+        engine = cls.get_diagnosis_engine()
         for m in metrics_raw:
             threshold = dict(m.get("threshold", {}) or {})
             if threshold:
-                threshold["display"] = cls.get_diagnosis_engine()._select_matched_threshold_display(
+                threshold["display"] = engine.select_cached_threshold_display(
                     m.get("value"),
                     threshold,
                     m.get("name", ""),
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+ClickHouse 时间列类型声明与 SQL 片段生成（纯函数，不依赖驱动，校验器与 ODS 层共用）。
+
+时间列按类型生成窗口谓词：
+  - DateTime / DateTime64：直接 `col >= toDateTime(...)`，可用主键与分区裁剪
+  - String：保留 `parseDateTimeBestEffortOrNull(toString(col))` 的尽力解析
+
+类型可写简名（DateTime / DateTime64 / String），也可写 system.columns 里的完整类型
+（如 `DateTime64(3, 'UTC')`、`Nullable(DateTime('Asia/Shanghai'))`、`LowCardinality(String)`）。
+带时区的列会把时区带进参数转换，保证与过去「按列时区的字符串比较」口径一致。
+"""
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Any, Optional
+
+TIME_COLUMN_KINDS = {"datetime": "DateTime", "datetime64": "DateTime64", "string": "String"}
+
+_WRAPPER_RE = re.compile(r"^(?:Nullable|LowCardinality)\((.*)\)$")
+_TYPE_RE = re.compile(r"^(DateTime64|DateTime|String|FixedString)\s*(?:\((.*)\))?$", re.IGNORECASE)
+_TIMEZONE_RE = re.compile(r"^[A-Za-z0-9_/+\-]+$")
+
+
+@dataclass(frozen=True)
+class TimeColumnType:
+    kind: str = "String"  # DateTime | DateTime64 | String
+    timezone: Optional[str] = None
+
+    @property
+    def typed(self) -> bool:
+        return self.kind in {"DateTime", "DateTime64"}
+
+    def column_expr(self, quoted_column: str) -> str:
+        """窗口谓词与排序里使用的列表达式；typed 列直接用列本身。"""
+        if self.typed:
+            return quoted_column
+        # 内网部分表（如 RPT_WAA_LOT_MARK_INFO_OFL_KAFKA）的 file_time 是 String，
+        # 先 toString 再 BestEffort 解析，避免 String/DateTime 混比较触发 NO_COMMON_TYPE。
+        return f"parseDateTimeBestEffortOrNull(toString({quoted_column}))"
+
+    def param_expr(self, placeholder: str) -> str:
+        """把字符串时间参数转成与列同类型、同时区的值。"""
+        tz = f", '{self.timezone}'" if self.timezone else ""
+        if self.kind == "DateTime64":
+            return f"toDateTime64({placeholder}, 3{tz})"
+        if self.kind == "DateTime":
+            return f"toDateTime({placeholder}{tz})"
+        return f"toDateTime({placeholder})"
+
+
+STRING_TIME_COLUMN = TimeColumnType()
+
+
+def parse_time_column_type(raw: Any, strict: bool = True) -> TimeColumnType:
+    """
+    解析时间列类型声明。
+
+    strict=True（配置声明）时无法识别的类型抛 ValueError；
+    strict=False（system.columns 探测）时 Date 等其它类型按 String 尽力解析处理。
+    """
+    text = str(raw or "").strip()
+    inner = text
+    while True:
+        wrapped = _WRAPPER_RE.match(inner)
+        if not wrapped:
+            break
+        inner = wrapped.group(1).strip()
+    match = _TYPE_RE.match(inner)
+    if not match:
+        if strict:
+            raise ValueError(
+                f"time_column_type 仅支持 {sorted(TIME_COLUMN_KINDS.values())}（可带 Nullable/时区），实际: {raw!r}"
+            )
+        return STRING_TIME_COLUMN
+    name, args = match.group(1).lower(), match.group(2) or ""
+    if name in {"string", "fixedstring"}:
+        return STRING_TIME_COLUMN
+    timezone = None
+    tz_match = re.search(r"'([^']*)'", args)
+    if tz_match:
+        timezone = tz_match.group(1)
+        if not _TIMEZONE_RE.fullmatch(timezone):
+            if strict:
+                raise ValueError(f"time_column_type 时区非法: {timezone!r}")
+            timezone = None
+    return TimeColumnType(kind=TIME_COLUMN_KINDS[name], timezone=timezone)
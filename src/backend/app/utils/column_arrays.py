@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+窗口查询列式结果的向量化处理（NumPy）。
+
+ClickHouse 无提取规则的窗口指标，列值本身就是指标值：按列取成 ndarray 后一次性完成
+None/NaN 过滤、float/int/bool 归一与 selection（LIMIT / 聚合），不再逐行 float()。
+口径与逐行路径一致：
+  - None 与 NaN 丢弃（ClickHouse 对空集合 avg 返回 nan）
+  - 非数值字符串转换失败抛 ValueError，由调用方按取数失败降级
+  - bool 归一后只保留 True（False 与逐行路径一样被过滤）
+"""
+from __future__ import annotations
+
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+# data_type → 向量化归一方式；不在表内的类型（str / 未知）由调用方逐值处理
+_FLOAT_TYPES = {"float", "double", "number"}
+_INT_TYPES = {"int", "integer"}
+_BOOL_TYPES = {"bool", "boolean"}
+
+
+def columns_from_numpy(result: Any, width: int) -> List[np.ndarray]:
+    """
+    把 clickhouse_connect query_np 的结果拆成按列的一维数组。
+
+    各列 dtype 相同时 query_np 返回 (rows, cols) 二维数组，否则返回按列名索引的结构化数组。
+    """
+    array = np.asarray(result)
+    if array.dtype.names:
+        return [np.asarray(array[name]) for name in array.dtype.names]
+    if array.size == 0:
+        return [np.empty(0, dtype=object) for _ in range(width)]
+    array = array.reshape(-1, width)
+    return [array[:, index] for index in range(width)]
+
+
+def columns_from_rows(rows: Sequence[Sequence[Any]], width: int) -> List[np.ndarray]:
+    """行式结果（result_set）转按列的 object 数组，供不支持 query_np 的 Client 使用。"""
+    columns = [np.empty(len(rows), dtype=object) for _ in range(width)]
+    for row_index, row in enumerate(rows):
+        for index in range(width):
+            columns[index][row_index] = row[index]
+    return columns
+
+
+def float_column(column: np.ndarray) -> np.ndarray:
+    """列值转 float64 并去掉 None/NaN；非数值（字符串、日期等）抛 ValueError/TypeError。"""
+    column = np.asarray(column)
+    kind = column.dtype.kind
+    if kind in "biuf":
+        numbers = column.astype(np.float64, copy=False)
+    elif kind in "OUS":
+        if kind == "O":
+            column = column[np.not_equal(column, None)]
+        numbers = column.astype(np.float64)
+    else:
+        raise TypeError(f"列类型 {column.dtype} 不能按数值指标读取")
+    return numbers[~np.isnan(numbers)]
+
+
+def coerce_float_column(numbers: np.ndarray, data_type: Optional[str]) -> Optional[np.ndarray]:
+    """
+    按 data_type 向量化归一；返回 None 表示该类型无法向量化（由调用方逐值转换）。
+    """
+    if data_type is None or data_type in _FLOAT_TYPES:
+        return numbers
+    if data_type in _INT_TYPES:
+        return np.trunc(numbers).astype(np.int64)
+    if data_type in _BOOL_TYPES:
+        return np.ones(int(np.count_nonzero(numbers)), dtype=bool)
+    return None
+
+
+def select_column(values: np.ndarray, limit: Optional[int], aggregate: Optional[str]) -> np.ndarray:
+    """与 RowSelection.apply 同口径的向量化选择（values 已按距 T 由近到远排序）。"""
+    if limit is not None:
+        return values[:limit]
+    if aggregate == "count":
+        return np.array([len(values)], dtype=np.int64)
+    if aggregate:
+        if not len(values):
+            return values[:0]
+        numbers = values.astype(np.float64, copy=False)
+        if aggregate == "avg":
+            return np.array([numbers.mean()])
+        return np.array([numbers.min() if aggregate == "min" else numbers.max()])
+    return values
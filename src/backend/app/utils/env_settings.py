@@ -0,0 +1,26 @@
+"""
+环境变量读取工具
+整数 / 浮点配置项的统一解析：非法值打 warning 并回退默认值
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def env_int(name: str, default: int, minimum: int = 0) -> int:
+    """读取整数环境变量；非法值打 warning 并回退默认值，结果不小于 minimum。"""
+    try:
+        return max(minimum, int(os.environ.get(name, default)))
+    except (TypeError, ValueError):
+        logger.warning("%s=%r 非法，回退到 %s", name, os.environ.get(name), default)
+        return max(minimum, default)
+
+
+def env_float(name: str, default: float) -> float:
+    """读取浮点环境变量；非法值打 warning 并回退默认值。"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        logger.warning("%s=%r 非法，回退到 %s", name, os.environ.get(name), default)
+        return default
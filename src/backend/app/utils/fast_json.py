@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+JSON 解码工具：有 orjson 时用 orjson，否则回退标准库 json。
+
+datacenter.mc_config_commits_history.data 这类列每行都是大段配置 JSON，
+Sx/Sy 等 jsonpath 指标共读同一列。LazyJsonColumn 让一次取数里的每个原始值
+最多解析一次，解析树在同列的多个指标之间共享，且只解析真正被访问到的行。
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List
+
+try:  # 可选加速依赖，缺失时行为不变
+    import orjson
+except ImportError:  # pragma: no cover - 取决于部署环境
+    orjson = None
+
+# 解码失败的哨兵值（JSON 里合法的 null 会解出 None，不能用 None 表示失败）
+INVALID_JSON = object()
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def decode_json(raw: Any) -> Any:
+    """
+    解码单个原始值；失败返回 INVALID_JSON。
+
+    orjson 比标准库严格（不接受 NaN/Infinity 字面量、超 64 位整数），
+    orjson 失败时再用标准库解一次，保证结果口径与 json.loads 一致。
+    """
+    payload = raw if isinstance(raw, (bytes, bytearray, str)) else str(raw)
+    if orjson is not None:
+        try:
+            return orjson.loads(payload)
+        except ValueError:
+            pass
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return INVALID_JSON
+
+
+class LazyJsonColumn:
+    """同一列原始值的惰性解析缓存：按行号解析一次，之后直接返回同一棵解析树。"""
+
+    def __init__(self, raw_values: List[Any]):
+        self.raw_values = raw_values
+        self._decoded: Dict[int, Any] = {}
+
+    def get(self, index: int) -> Any:
+        if index not in self._decoded:
+            self._decoded[index] = decode_json(self.raw_values[index])
+        return self._decoded[index]
+
+    @property
+    def decoded_count(self) -> int:
+        return len(self._decoded)
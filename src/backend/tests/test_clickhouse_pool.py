@@ -0,0 +1,131 @@
+"""
+ClickHouse Client 池测试（无需数据库）。
+"""
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import pytest
+
+import app.ods.clickhouse_ods as clickhouse_ods
+from app.ods.clickhouse_ods import ClickHouseODS
+from app.ods.clickhouse_pool import ClickHouseClientPool, ClickHousePoolExhausted
+
+
+class FakeClient:
+    def __init__(self, healthy=True):
+        self.healthy = healthy
+        self.closed = False
+        self.queries = 0
+
+    def query(self, query, parameters=None):
+        self.queries += 1
+        return SimpleNamespace(result_set=[[1.0]])
+
+    def ping(self):
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+def _factory(created):
+    def make():
+        client = FakeClient()
+        created.append(client)
+        return client
+
+    return make
+
+
+def test_pool_reuses_idle_client_and_discards_on_error():
+    created = []
+    factory = _factory(created)
+    pool = ClickHouseClientPool(max_size=2)
+
+    with pool.acquire(factory) as first:
+        pass
+    with pool.acquire(factory) as second:
+        pass
+    assert first is second and len(created) == 1
+
+    with pytest.raises(RuntimeError):
+        with pool.acquire(factory):
+            raise RuntimeError("query failed")
+    assert created[0].closed
+    with pool.acquire(factory):
+        pass
+    stats = pool.stats()
+    assert stats["created"] == 2 and stats["reused"] == 2 and stats["discarded"] == 1
+    assert stats["inUse"] == 0 and stats["idle"] == 1
+
+
+def test_pool_health_checks_idle_clients_before_reuse():
+    created = []
+    pool = ClickHouseClientPool(max_size=1, healthcheck_seconds=0)
+    factory = _factory(created)
+
+    with pool.acquire(factory) as client:
+        client.healthy = False
+    with pool.acquire(factory) as replacement:
+        pass
+
+    assert replacement is not client and client.closed
+    assert pool.stats()["healthcheckFailures"] == 1
+
+
+def test_pool_blocks_until_release_and_times_out_when_full():
+    created = []
+    factory = _factory(created)
+    pool = ClickHouseClientPool(max_size=1, acquire_timeout=0.05)
+
+    with pool.acquire(factory):
+        with pytest.raises(ClickHousePoolExhausted):
+            with pool.acquire(factory):
+                pass
+
+    pool = ClickHouseClientPool(max_size=1, acquire_timeout=5)
+    lease = pool.acquire(factory)
+    held = lease.__enter__()
+    got = []
+
+    def borrower():
+        with pool.acquire(factory) as client:
+            got.append(client)
+
+    thread = threading.Thread(target=borrower)
+    thread.start()
+    lease.__exit__(None, None, None)
+    thread.join(timeout=5)
+    assert got == [held]
+
+
+def test_pool_drops_idle_clients_when_factory_changes():
+    created_a, created_b = [], []
+    pool = ClickHouseClientPool(max_size=2)
+    with pool.acquire(_factory(created_a)):
+        pass
+    with pool.acquire(_factory(created_b)) as client:
+        pass
+    assert created_a[0].closed
+    assert client is created_b[0]
+
+
+def test_window_queries_share_one_pooled_client(monkeypatch):
+    created = []
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", _factory(created))
+    clickhouse_ods.reset_clickhouse_pool()
+    T = datetime(2026, 3, 25, 12, 0, 0)
+
+    for _ in range(3):
+        ClickHouseODS.query_rows_in_window("src.T", ["v"], "SSB8000", T, T, T)
+
+    assert len(created) == 1 and created[0].queries == 3
+    assert clickhouse_ods.clickhouse_pool_stats()["reused"] >= 2
+    clickhouse_ods.reset_clickhouse_pool()
+    assert created[0].closed
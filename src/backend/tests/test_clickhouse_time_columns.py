@@ -0,0 +1,106 @@
+"""
+ClickHouse 时间列类型声明 / 探测与窗口谓词生成测试（无需数据库）。
+"""
+import sys
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import pytest
+
+import app.ods.clickhouse_ods as clickhouse_ods
+from app.ods.clickhouse_ods import ClickHouseODS
+from app.utils.clickhouse_types import TimeColumnType, parse_time_column_type
+
+T = datetime(2026, 3, 25, 12, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def _reset_time_column_types():
+    clickhouse_ods.reset_time_column_types()
+    yield
+    clickhouse_ods.reset_time_column_types()
+
+
+class _RecordingClient:
+    def __init__(self, result_set=None):
+        self.queries = []
+        self.result_set = result_set or []
+
+    def query(self, query, parameters=None):
+        self.queries.append((query, dict(parameters or {})))
+        return SimpleNamespace(result_set=self.result_set)
+
+    def close(self):
+        return None
+
+
+def test_parse_time_column_type_accepts_short_and_full_names():
+    assert parse_time_column_type("DateTime") == TimeColumnType("DateTime")
+    assert parse_time_column_type("datetime64") == TimeColumnType("DateTime64")
+    assert parse_time_column_type("DateTime64(3, 'UTC')") == TimeColumnType("DateTime64", "UTC")
+    assert parse_time_column_type("Nullable(DateTime('Asia/Shanghai'))") == TimeColumnType("DateTime", "Asia/Shanghai")
+    assert parse_time_column_type("LowCardinality(String)").kind == "String"
+    with pytest.raises(ValueError):
+        parse_time_column_type("Date")
+    assert parse_time_column_type("Date", strict=False).kind == "String"
+
+
+def test_declared_datetime64_column_uses_native_range_predicate(monkeypatch):
+    client = _RecordingClient()
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: client)
+
+    ClickHouseODS.query_rows_in_window(
+        "las.LOG_EH_UNION_VIEW", ["detail"], "SSB8000", T, T, T,
+        time_column="file_time", time_column_type="DateTime64(3, 'UTC')",
+    )
+
+    sql = client.queries[0][0]
+    assert "parseDateTimeBestEffortOrNull" not in sql
+    assert "`file_time` >= toDateTime64(%(t_start)s, 3, 'UTC')" in sql
+    assert "`file_time` <= toDateTime64(%(t_end)s, 3, 'UTC')" in sql
+
+
+def test_undeclared_column_keeps_best_effort_parsing(monkeypatch):
+    client = _RecordingClient()
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: client)
+
+    ClickHouseODS.query_rows_in_window("src.T", ["v"], "SSB8000", T, T, T, time_column="file_time")
+
+    assert "parseDateTimeBestEffortOrNull(toString(`file_time`)) >= toDateTime(%(t_start)s)" in client.queries[0][0]
+
+
+def test_probe_registers_types_from_system_columns(monkeypatch):
+    probe_client = _RecordingClient(
+        result_set=[
+            ("las", "LOG_EH_UNION_VIEW", "file_time", "DateTime64(3, 'UTC')", 0),
+            ("default", "MARKS", "file_time", "String", 1),
+        ]
+    )
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: probe_client)
+
+    found = clickhouse_ods.probe_time_column_types(
+        [("las.LOG_EH_UNION_VIEW", "file_time"), ("MARKS", "file_time")]
+    )
+
+    probe_sql, params = probe_client.queries[0]
+    assert "system.columns" in probe_sql and "currentDatabase()" in probe_sql
+    assert "las" in params.values() and "LOG_EH_UNION_VIEW" in params.values()
+    assert found[("las.LOG_EH_UNION_VIEW", "file_time")] == TimeColumnType("DateTime64", "UTC")
+    assert found[("MARKS", "file_time")].kind == "String"
+    assert clickhouse_ods.resolve_time_column_type("las.LOG_EH_UNION_VIEW", "file_time").kind == "DateTime64"
+    # 指标显式声明优先于探测结果
+    assert clickhouse_ods.resolve_time_column_type("las.LOG_EH_UNION_VIEW", "file_time", "String").kind == "String"
+
+
+def test_probe_failure_falls_back_to_string(monkeypatch):
+    def broken_client():
+        raise ConnectionError("unreachable")
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", broken_client)
+
+    assert clickhouse_ods.probe_time_column_types([("las.X", "file_time")]) == {}
+    assert clickhouse_ods.resolve_time_column_type("las.X", "file_time").kind == "String"
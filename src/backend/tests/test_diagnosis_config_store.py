@@ -99,6 +99,24 @@ def test_rule_loader_reload_works():
     assert loader.get_step("continue_model") is not None
 
 
+def test_reload_rebuilds_precompiled_threshold_index():
+    loader = RuleLoader()
+    before = loader.threshold_index
+    assert loader.get_threshold_entry("Mwx_0") is before.get("Mwx_0")
+    loader.reload()
+    assert loader.threshold_index is not before
+    assert loader.threshold_index is loader.store.get_pipeline("reject_errors")["threshold_index"]
+    assert loader.get_threshold_entry("Mwx_0").info == before.get("Mwx_0").info
+
+
+def test_store_reload_clears_metric_window_cache():
+    from app.engine import metric_fetcher as metric_fetcher_module
+
+    metric_fetcher_module._metric_window_cache.set(("stale",), ([1.0], "real_clickhouse"))
+    DiagnosisConfigStore().reload()
+    assert metric_fetcher_module._metric_window_cache.get(("stale",)) == (False, None)
+
+
 def test_store_versions_are_valid():
     store = DiagnosisConfigStore()
     assert str(store.version).startswith("3.")
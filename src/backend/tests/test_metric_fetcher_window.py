@@ -2,6 +2,7 @@
 MetricFetcher 鏃堕棿绐椾笌绐楀彛鍒楄〃琛屼负娴嬭瘯銆?
 """
 import sys
+from contextlib import nullcontext
 from pathlib import Path
 from datetime import datetime, timedelta
 from types import SimpleNamespace
@@ -9,8 +10,19 @@ from types import SimpleNamespace
 project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
+import pytest
+
 from app.engine.actions.builtin import calculate_monthly_mean_Tx, select_window_metric
+from app.engine import metric_fetcher as metric_fetcher_module
 from app.engine.metric_fetcher import MetricFetcher
+from app.utils.ttl_cache import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def _isolate_metric_window_cache():
+    metric_fetcher_module.clear_metric_window_cache()
+    yield
+    metric_fetcher_module.clear_metric_window_cache()
 
 
 def test_window_uses_duration_days_from_meta():
@@ -248,7 +260,7 @@ def test_mysql_exact_match_returns_none_without_explicit_fallback(monkeypatch):
         source_record={"lot_id": "LOT-1"},
     )
 
-    monkeypatch.setattr(f, "_query_mysql_window", lambda *args, **kwargs: [])
+    monkeypatch.setattr(f, "_query_mysql_window_rows", lambda *args, **kwargs: [])
     value = f._fetch_from_mysql(
         "Sx",
         {
@@ -305,11 +317,19 @@ def test_fetch_all_passes_previous_metric_results_as_context(monkeypatch):
     T = datetime(2026, 3, 25, 12, 0, 0)
     f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
 
-    monkeypatch.setattr(
-        f.rule_loader,
-        "get_metric_meta",
-        lambda metric_id: {"source_kind": "mysql_nearest_row"},
-    )
+    def _fake_meta(metric_id):
+        if metric_id == "mark_pos_x":
+            return {
+                "source_kind": "mysql_nearest_row",
+                "linking": {
+                    "mode": "exact_keys",
+                    "keys": [],
+                    "filters": [{"target": "mark_id", "operator": "in", "source": "mark_candidates"}],
+                },
+            }
+        return {"source_kind": "mysql_nearest_row"}
+
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", _fake_meta)
 
     seen_context = {}
 
@@ -370,7 +390,7 @@ def test_clickhouse_query_accepts_extra_filters(monkeypatch):
     captured = {}
 
     class FakeClient:
-        def query(self, query, parameters=None):
+        def query(self, query, parameters=None, settings=None):
             captured["query"] = query
             captured["parameters"] = parameters or {}
             return SimpleNamespace(result_set=[["1.02"], ["1.03"]])
@@ -420,6 +440,62 @@ def test_fetch_all_adds_window_alias_for_query_metrics(monkeypatch):
     assert values["Mwx_0_window"] == [1.0, 2.0]
 
 
+def test_group_metric_ids_by_level_follows_linking_deps():
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    levels = f._group_metric_ids_by_level(["mark_pos_y", "Msx", "mark_pos_x", "mark_candidates", "Mwx_0"])
+    assert len(levels) == 2
+    assert set(levels[0]) == {"Msx", "mark_candidates", "Mwx_0"}
+    assert set(levels[1]) == {"mark_pos_x", "mark_pos_y"}
+
+
+def test_fetch_all_runs_independent_metrics_concurrently(monkeypatch):
+    import threading
+
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7, max_workers=4)
+    monkeypatch.setattr(
+        f.rule_loader,
+        "get_metric_meta",
+        lambda metric_id: {"source_kind": "clickhouse_window"},
+    )
+    # 三个同层指标必须同时在途才能越过 barrier；串行实现会在这里超时
+    barrier = threading.Barrier(3, timeout=5)
+
+    def _fake_fetch(metric_id, extra_context=None):
+        barrier.wait()
+        f.source_log[metric_id] = "real_clickhouse"
+        return [metric_id]
+
+    monkeypatch.setattr(f, "_fetch_one", _fake_fetch)
+    values = f.fetch_all(["A", "B", "C"])
+    assert values["A"] == ["A"]
+    assert values["C_window"] == ["C"]
+    assert f.source_log == {"A": "real_clickhouse", "B": "real_clickhouse", "C": "real_clickhouse"}
+
+
+def test_fetch_all_isolates_failures_per_metric(monkeypatch):
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(
+        f.rule_loader,
+        "get_metric_meta",
+        lambda metric_id: {"source_kind": "mysql_nearest_row"},
+    )
+
+    def _fake_fetch(metric_id, extra_context=None):
+        if metric_id == "bad":
+            raise RuntimeError("boom")
+        return [1.0]
+
+    monkeypatch.setattr(f, "_fetch_one", _fake_fetch)
+    values = f.fetch_all(["good", "bad"])
+    assert values["good"] == [1.0]
+    assert values["bad"] is None
+    assert values["bad_window"] == []
+    assert f.source_log["bad"] == "none"
+
+
 def test_select_window_metric_picks_first_value():
     assert select_window_metric(metric_name="Mwx_0", values=[1.00003, 1.00006]) == {"Mwx_0": 1.00003}
 
@@ -543,3 +619,995 @@ def test_render_template_scalar_var_unchanged():
     fetcher = _make_fetcher_with_ctx({"chuck_index0": 1})
     rendered = fetcher._render_extraction_template("foo/chuck_message[{chuck_index0}]/x")
     assert rendered == "foo/chuck_message[1]/x"
+
+
+def test_fetch_all_coalesces_same_table_mysql_metrics_into_one_query(monkeypatch):
+    executed = []
+
+    class FakeResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def fetchall(self):
+            return self._rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            sql_text = str(sql)
+            executed.append(sql_text)
+            if "other_table" in sql_text:
+                return FakeResult([(7.0,)])
+            return FakeResult([(1.5, 2.5), (1.6, None)])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+
+    shared = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "src_table",
+        "time_column": "file_time",
+        "linking": {"mode": "exact_keys", "keys": [{"target": "chuck_id", "source": "chuck_id"}]},
+    }
+    metas = {
+        "Msx": {**shared, "column_name": "ms_x"},
+        "Msy": {**shared, "column_name": "ms_y"},
+        "Other": {**shared, "table_name": "other_table", "column_name": "v"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, chuck_id=1, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["Msx", "Msy", "Other"])
+
+    assert len(executed) == 2
+    merged_sql = next(sql for sql in executed if "src_table" in sql)
+    assert "SELECT ms_x, ms_y" in merged_sql
+    assert values["Msx"] == [1.5, 1.6]
+    assert values["Msy"] == [2.5]
+    assert values["Msy_window"] == [2.5]
+    assert values["Other"] == [7.0]
+    assert f.source_log == {"Msx": "real_mysql", "Msy": "real_mysql", "Other": "real_mysql"}
+
+
+def test_fetch_all_coalesced_clickhouse_group_applies_per_metric_extraction(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None):
+            queries.append(query)
+            return SimpleNamespace(result_set=[["Mwx (1.0002) alarm", "0.5"], ["idle", "0.7"]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+
+    shared = {"source_kind": "clickhouse_window", "table_name": "las.LOG_VIEW"}
+    metas = {
+        # 环视不是 RE2 写法，提取留在 Python 侧，与 offset 合并成一条查询
+        "Mwx_0": {**shared, "column_name": "detail", "extraction_rule": "regex:Mwx\\s*\\(([\\d\\.]+)(?=\\))"},
+        "has_alarm": {**shared, "column_name": "detail", "extraction_rule": "regex:alarm"},
+        "offset": {**shared, "column_name": "offset"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["Mwx_0", "has_alarm", "offset"])
+
+    # has_alarm 是无捕获组 regex，改走单独的存在性探测
+    assert len(queries) == 2
+    assert any("SELECT `detail`, `offset`" in q for q in queries)
+    assert any("match(toString(`detail`)" in q and "LIMIT 1" in q for q in queries)
+    assert values["Mwx_0"] == [1.0002]
+    assert values["has_alarm"] == [True]
+    assert values["offset"] == [0.5, 0.7]
+    assert set(f.source_log.values()) == {"real_clickhouse"}
+
+
+def test_repeat_fetch_in_same_diagnosis_is_served_from_memo(monkeypatch):
+    executed = []
+
+    class FakeResult:
+        def fetchall(self):
+            return [(1.5,)]
+
+    class FakeDb:
+        def execute(self, sql, params):
+            executed.append(dict(params))
+            return FakeResult()
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+
+    meta = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "src_table",
+        "column_name": "ms_x",
+        "linking": {"mode": "exact_keys", "keys": [{"target": "lot_id", "source": "lot_id"}]},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+
+    first = f.fetch_from_source_record({"lot_id": "LOT-1"}, ["Msx"])
+    assert f.source_log["Msx"] == "real_mysql"
+    second = f.fetch_from_source_record({"lot_id": "LOT-1"}, ["Msx"])
+    assert len(executed) == 1
+    assert second["Msx"] == first["Msx"] == [1.5]
+    assert f.source_log["Msx"] == "real_mysql:memo"
+
+    # linking 值变化 → 不同的备忘键，重新查询
+    f.fetch_from_source_record({"lot_id": "LOT-2"}, ["Msx"])
+    assert len(executed) == 2
+    assert executed[-1]["link_0"] == "LOT-2"
+    assert f.source_log["Msx"] == "real_mysql"
+
+
+def _counting_mysql_session(monkeypatch, rows):
+    executed = []
+
+    class FakeResult:
+        def fetchall(self):
+            return rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            executed.append(dict(params))
+            return FakeResult()
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    return executed
+
+
+def test_window_cache_serves_identical_query_across_requests(monkeypatch):
+    executed = _counting_mysql_session(monkeypatch, [(0.8,)])
+    meta = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "lo_batch_equipment_performance",
+        "column_name": "wafer_translation_x",
+        "duration": "30",
+        "linking": {"mode": "exact_keys", "keys": [{"target": "chuck_id", "source": "chuck_id"}]},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    values = []
+    logs = []
+    # 第二次请求的 T 落在同一时间分桶内
+    for ref in (T, T + timedelta(seconds=1)):
+        f = MetricFetcher(equipment="SSB8000", reference_time=ref, chuck_id=1, fallback_duration_days=7)
+        monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+        values.append(f.fetch_all(["Tx_history"])["Tx_history"])
+        logs.append(f.source_log["Tx_history"])
+
+    assert len(executed) == 1
+    assert values == [[0.8], [0.8]]
+    assert logs == ["real_mysql", "real_mysql:cache"]
+    stats = metric_fetcher_module.metric_window_cache_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_window_cache_respects_cache_ttl_opt_out_and_linking_values(monkeypatch):
+    executed = _counting_mysql_session(monkeypatch, [(0.8,)])
+    base = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "lo_batch_equipment_performance",
+        "column_name": "wafer_translation_x",
+        "linking": {"mode": "exact_keys", "keys": [{"target": "chuck_id", "source": "chuck_id"}]},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+
+    def _run(meta, chuck_id):
+        f = MetricFetcher(equipment="SSB8000", reference_time=T, chuck_id=chuck_id, fallback_duration_days=7)
+        monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+        f.fetch_all(["Tx_history"])
+        return f.source_log["Tx_history"]
+
+    opt_out = {**base, "cache_ttl": 0}
+    assert [_run(opt_out, 1), _run(opt_out, 1)] == ["real_mysql", "real_mysql"]
+    assert [_run(base, 1), _run(base, 2)] == ["real_mysql", "real_mysql"]
+    assert len(executed) == 4
+
+
+def test_window_cache_key_tracks_compiled_metric_plan(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None):
+            queries.append(query)
+            return SimpleNamespace(result_set=[[2.0]] if "avg(" in query else [[1.0], [3.0]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    meta = {"source_kind": "clickhouse_window", "table_name": "las.HIST", "column_name": "v", "selection": "all"}
+    T = datetime(2026, 3, 25, 12, 0, 0)
+
+    def _run():
+        f = MetricFetcher(equipment="SSB8000", reference_time=T)
+        monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: dict(meta))
+        return f._fetch_one("V"), f.source_log["V"]
+
+    assert _run() == ([1.0, 3.0], "real_clickhouse")
+    assert _run() == ([1.0, 3.0], "real_clickhouse:cache")
+    # 热加载改了 selection：不再命中旧形状的缓存
+    meta["selection"] = "aggregate:avg"
+    assert _run() == ([2.0], "real_clickhouse")
+    assert len(queries) == 2
+
+
+def test_ttl_cache_evicts_least_recently_used_and_expires(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr("app.utils.ttl_cache.time.monotonic", lambda: clock[0])
+    cache = TTLCache(maxsize=2, ttl_seconds=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+    cache.set("c", 3)  # b 最久未使用 → 淘汰
+    assert cache.get("b") == (False, None)
+    assert cache.stats()["evictions"] == 1
+    clock[0] += 11
+    assert cache.get("a") == (False, None)
+    assert cache.stats()["expirations"] == 1
+
+
+def test_parse_selection_accepts_documented_forms():
+    from app.engine.fetch_planner import parse_selection
+
+    assert parse_selection(None).limit is None
+    assert parse_selection("nearest").limit == 1
+    assert parse_selection("nearest_n:5").limit == 5
+    assert parse_selection("aggregate:avg").aggregate == "avg"
+    for bad in ("nearest_n", "nearest_n:0", "aggregate:median", "latest"):
+        with pytest.raises(ValueError):
+            parse_selection(bad)
+
+
+def test_mysql_selection_pushes_limit_and_aggregate_into_sql(monkeypatch):
+    executed = []
+
+    class FakeResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def fetchall(self):
+            return self._rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            sql_text = str(sql)
+            executed.append(sql_text)
+            if "AVG(" in sql_text:
+                return FakeResult([(0.25,)])
+            return FakeResult([(1.5,)])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    shared = {"source_kind": "mysql_nearest_row", "table_name": "src_table"}
+    metas = {
+        "Msx": {**shared, "column_name": "ms_x", "selection": "nearest"},
+        "Tx_mean": {**shared, "column_name": "tx", "selection": "aggregate:avg"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["Msx", "Tx_mean"])
+
+    limit_sql = next(sql for sql in executed if "ms_x" in sql)
+    assert "ms_x IS NOT NULL" in limit_sql and "LIMIT 1" in limit_sql
+    avg_sql = next(sql for sql in executed if "AVG(tx)" in sql)
+    assert "ORDER BY" not in avg_sql
+    assert values["Msx"] == [1.5]
+    assert values["Tx_mean"] == [0.25]
+
+
+def test_selection_with_extraction_rule_is_applied_after_extraction(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None):
+            queries.append(query)
+            return SimpleNamespace(result_set=[["idle"], ["Mwx (1.0002)"], ["Mwx (1.0005)"]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    meta = {
+        "source_kind": "clickhouse_window",
+        "table_name": "las.LOG_VIEW",
+        "column_name": "detail",
+        "extraction_rule": "regex:Mwx\\s*\\(([\\d\\.]+)(?=\\))",
+        "selection": "nearest",
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+
+    values = f.fetch_all(["Mwx_0"])
+
+    assert "LIMIT" not in queries[0]
+    assert values["Mwx_0"] == [1.0002]
+
+
+def test_jsonpath_metrics_on_same_column_share_one_parse_per_row(monkeypatch):
+    import app.utils.fast_json as fast_json
+
+    decoded = []
+    real_decode = fast_json.decode_json
+
+    def counting_decode(raw):
+        decoded.append(raw)
+        return real_decode(raw)
+
+    monkeypatch.setattr(fast_json, "decode_json", counting_decode)
+    rows = [
+        ("not-json",),
+        ('{"chuck": [{"x": 1.5, "y": 2.5}, {"x": 9, "y": 9}]}',),
+        ('{"chuck": [{"x": 7, "y": 7}]}',),
+    ]
+    executed = _counting_mysql_session(monkeypatch, rows)
+    shared = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "cfg_history",
+        "column_name": "data",
+        "selection": "nearest",
+    }
+    metas = {
+        "Sx": {**shared, "extraction_rule": "jsonpath:chuck[{chuck_index0}]/x"},
+        "Sy": {**shared, "extraction_rule": "jsonpath:chuck[{chuck_index0}]/y"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, chuck_id=1, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["Sx", "Sy"])
+
+    assert len(executed) == 1
+    assert values["Sx"] == [1.5]
+    assert values["Sy"] == [2.5]
+    # 最近一行解析失败后继续第二行；Sx/Sy 共享解析结果，第三行不再解析
+    assert decoded == [rows[0][0], rows[1][0]]
+
+
+def test_capture_less_regex_metric_uses_existence_probe(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None):
+            queries.append((query, dict(parameters or {})))
+            return SimpleNamespace(result_set=[[1]] if "match(" in query else [["x"]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    metas = {
+        "trigger_log": {
+            "source_kind": "clickhouse_window",
+            "table_name": "las.LOG_EH_UNION_VIEW",
+            "column_name": "detail",
+            "extraction_rule": "regex:Mwx out of range,CGG6_check_parameter_ranges",
+        },
+        # 环视不是 RE2 写法，保留 Python 侧逐行匹配
+        "lookahead": {
+            "source_kind": "clickhouse_window",
+            "table_name": "las.LOG_EH_UNION_VIEW",
+            "column_name": "detail",
+            "extraction_rule": "regex:x(?=y)",
+        },
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["trigger_log", "lookahead"])
+
+    probe_sql, probe_params = next(q for q in queries if "match(" in q[0])
+    assert "SELECT 1" in probe_sql and "LIMIT 1" in probe_sql and "ORDER BY" not in probe_sql
+    assert probe_params["probe_pattern"] == "Mwx out of range,CGG6_check_parameter_ranges"
+    assert values["trigger_log"] == [True]
+    assert f.source_log["trigger_log"] == "real_clickhouse"
+    assert values["lookahead"] is None
+    assert len(queries) == 2
+
+
+def test_mysql_existence_probe_uses_regexp_limit_one(monkeypatch):
+    executed = []
+
+    class FakeResult:
+        def fetchall(self):
+            return []
+
+    class FakeDb:
+        def execute(self, sql, params):
+            executed.append((str(sql), dict(params)))
+            return FakeResult()
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    meta = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "event_log",
+        "column_name": "message",
+        "extraction_rule": "regex:overlay\\s+alarm",
+        "data_type": "bool",
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+
+    assert f._fetch_one("has_overlay_alarm") is None
+
+    sql, params = executed[0]
+    assert "SELECT 1" in sql
+    assert "message REGEXP :probe_pattern" in sql
+    assert "LIMIT 1" in sql and "ORDER BY" not in sql
+    assert params["probe_pattern"] == "overlay\\s+alarm"
+    assert f.source_log["has_overlay_alarm"] == "none"
+
+
+def test_clickhouse_numeric_metrics_use_columnar_query_np(monkeypatch):
+    import numpy as np
+
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query_np(self, query, parameters=None):
+            queries.append(query)
+            dtype = [("offset", "f8"), ("flag", "i8")]
+            return np.array([(0.5, 0), (np.nan, 3), (1.75, -2)], dtype=dtype)
+
+        def query(self, query, parameters=None):
+            raise AssertionError("数值列应走 query_np")
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    shared = {"source_kind": "clickhouse_window", "table_name": "las.WAA_VIEW"}
+    metas = {
+        "offset": {**shared, "column_name": "offset"},
+        "offset_int": {**shared, "column_name": "offset", "data_type": "int", "selection": "nearest"},
+        "flag": {**shared, "column_name": "flag", "data_type": "bool"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    values = f.fetch_all(["offset", "offset_int", "flag"])
+
+    assert len(queries) == 2  # offset_int 的 LIMIT 下推使其单独成组
+    assert any("LIMIT 1" in q for q in queries)
+    assert values["offset"] == [0.5, 1.75]
+    # 假 Client 不执行 LIMIT；int 截断与逐行 int(float(v)) 一致
+    assert values["offset_int"] == [0, 1]
+    assert all(type(v) is int for v in values["offset_int"])
+    assert values["flag"] == [True, True]
+    assert set(f.source_log.values()) == {"real_clickhouse"}
+
+
+def test_clickhouse_columnar_path_falls_back_to_row_query_and_keeps_semantics(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    class FakeClient:
+        def query(self, query, parameters=None):
+            return SimpleNamespace(result_set=[[None, "x"], ["2.5", "y"], [4, "z"]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    shared = {"source_kind": "clickhouse_window", "table_name": "las.WAA_VIEW"}
+    metas = {
+        "mean_offset": {**shared, "column_name": "offset", "selection": "aggregate:avg"},
+        "label": {**shared, "column_name": "label"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+    # avg 未下推时在数组上聚合
+    monkeypatch.setattr(MetricFetcher, "_selection_pushdown", staticmethod(lambda plan: (None, None)))
+
+    values = f.fetch_all(["mean_offset", "label"])
+
+    assert values["mean_offset"] == [3.25]
+    # 非数值列与逐行路径一样按取数失败降级
+    assert f.source_log["label"] == "mock"
+
+
+def test_clickhouse_regex_extraction_is_pushed_into_sql(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None):
+            queries.append((query, dict(parameters or {})))
+            return SimpleNamespace(result_set=[[1.0002]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    meta = {
+        "source_kind": "clickhouse_window",
+        "table_name": "las.LOG_EH_UNION_VIEW",
+        "column_name": "detail",
+        "extraction_rule": "regex:Mwx\\s*\\(\\s*([\\d\\.]+)\\s*\\)",
+        "selection": "nearest",
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: meta)
+
+    values = f.fetch_all(["Mwx_0"])
+
+    sql, params = queries[0]
+    assert "SELECT toFloat64OrNull(extract(toString(`detail`), %(extract_pattern)s))" in sql
+    assert "match(toString(`detail`), %(extract_pattern)s)" in sql
+    # 提取在服务端完成后 nearest 可以下推成 LIMIT 1
+    assert "LIMIT 1" in sql
+    assert params["extract_pattern"] == meta["extraction_rule"][6:]
+    assert values["Mwx_0"] == [1.0002]
+    assert f.source_log["Mwx_0"] == "real_clickhouse"
+
+
+def test_mysql_nearest_rows_use_two_sided_index_seek(monkeypatch):
+    executed = []
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    table = [
+        (1.0, T - timedelta(minutes=30)),
+        (2.0, T - timedelta(minutes=5)),
+        (3.0, T + timedelta(minutes=5)),
+        (4.0, T + timedelta(minutes=10)),
+        (5.0, T - timedelta(hours=2)),
+    ]
+
+    class FakeResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def fetchall(self):
+            return self._rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            sql_text = str(sql)
+            executed.append(sql_text)
+            with_time = "ms_x, file_time" in sql_text
+            if "file_time > :ref_time" in sql_text:
+                rows = sorted((r for r in table if r[1] > T), key=lambda r: r[1])
+            else:
+                rows = sorted((r for r in table if r[1] <= T), key=lambda r: r[1], reverse=True)
+            if "LIMIT 2" in sql_text:
+                rows = rows[:2]
+            return FakeResult([r if with_time else r[:1] for r in rows])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+
+    # 常见情况：窗口终点即 T，只有一次倒序范围读取，不再按 ABS(TIMESTAMPDIFF) 排序
+    rows = f._query_mysql_window_rows("src", ["ms_x"], "file_time", "equipment", T - timedelta(days=7), T, "", {})
+    assert rows == [(2.0,), (1.0,), (5.0,)]
+    assert len(executed) == 1
+    assert "ORDER BY file_time DESC" in executed[0] and "ABS(" not in executed[0]
+
+    # 窗口跨过 T：两侧各取 LIMIT k 后按距离归并，结果与按距离排序一致
+    executed.clear()
+    rows = f._query_mysql_window_rows(
+        "src", ["ms_x"], "file_time", "equipment", T - timedelta(days=7), T + timedelta(hours=1), "", {}, limit=2
+    )
+    assert rows == [(2.0,), (3.0,)]
+    assert len(executed) == 2
+    assert "ORDER BY file_time ASC LIMIT 2" in executed[1]
+
+    monkeypatch.setattr(metric_fetcher_module, "MYSQL_TWO_SIDED_SEEK", False)
+    executed.clear()
+    f._query_mysql_window_rows("src", ["ms_x"], "file_time", "equipment", T - timedelta(days=7), T, "", {})
+    assert "ORDER BY ABS(TIMESTAMPDIFF(SECOND, file_time, :ref_time))" in executed[0]
+
+
+
+def test_mysql_two_sided_seek_parses_string_times_and_falls_back_when_unparseable(monkeypatch):
+    executed = []
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    before_rows = [(2.0, "2026-03-25 11:50:00"), (1.0, "2026-03-25T10:00:00")]
+    after_rows = [(3.0, "2026-03-25 12:05:00")]
+    abs_rows = [(9.0,)]
+
+    class FakeResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def fetchall(self):
+            return self._rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            sql_text = str(sql)
+            executed.append(sql_text)
+            if "ABS(" in sql_text:
+                return FakeResult(abs_rows)
+            if "file_time > :ref_time" in sql_text:
+                return FakeResult(after_rows)
+            return FakeResult(before_rows)
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, fallback_duration_days=7)
+    window = ("src", ["ms_x"], "file_time", "equipment", T - timedelta(days=7), T + timedelta(hours=1), "", {})
+
+    # 字符串时间列按 ISO 解析后参与归并：12:05（5 分钟）< 11:50（10 分钟）< 10:00
+    assert f._query_mysql_window_rows(*window) == [(3.0,), (2.0,), (1.0,)]
+    assert len(executed) == 2
+
+    # 无法解析的时间列不猜距离，退回单次 ORDER BY ABS(...) 查询
+    before_rows[1] = (1.0, "not-a-time")
+    executed.clear()
+    assert f._query_mysql_window_rows(*window) == [(9.0,)]
+    assert len(executed) == 3
+    assert "ORDER BY ABS(TIMESTAMPDIFF(SECOND, file_time, :ref_time))" in executed[-1]
+
+def test_clickhouse_in_dependency_is_pushed_down_as_subquery(monkeypatch):
+    import threading
+
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+    both_started = threading.Barrier(2, timeout=5)
+
+    class FakeClient:
+        def query(self, query, parameters=None):
+            queries.append((query, dict(parameters or {})))
+            # 父指标与下推后的子指标同层并发：两条查询都已发出才返回
+            both_started.wait()
+            if "`mark_pos_x`" in query:
+                return SimpleNamespace(result_set=[[1.5, 2.5], [1.6, 2.6]])
+            return SimpleNamespace(result_set=[[11], [12]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(
+        equipment="SSB8000",
+        reference_time=T,
+        chuck_id=1,
+        source_record={"lot_id": "LOT-1", "wafer_id": "W01"},
+    )
+
+    values = f.fetch_all(["mark_candidates", "mark_pos_x", "mark_pos_y"])
+
+    assert len(queries) == 2
+    sql, params = next(q for q in queries if "`mark_pos_x`" in q[0])
+    assert "SELECT `mark_pos_x`, `mark_pos_y`" in sql
+    assert "toString(mark_id) IN (SELECT toString(`mark_id`) FROM `las`.`RPT_WAA_RESULT_OFL`" in sql
+    assert params["link_0"] == "LOT-1"
+    assert params["dep0_equipment"] == "SSB8000"
+    assert sorted(str(v) for k, v in params.items() if k.startswith("dep0_link")) == ["1", "1ST_COWA", "LOT-1", "W01"]
+    assert values["mark_candidates"] == [11.0, 12.0]
+    assert values["mark_pos_x"] == [1.5, 1.6]
+    assert values["mark_pos_y"] == [2.5, 2.6]
+
+
+def test_join_pushdown_requires_plain_column_parent(monkeypatch):
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T)
+    ids = ["mark_candidates", "mark_pos_x", "mark_pos_y"]
+    assert f._plan_join_pushdown(ids) == {
+        "mark_pos_x": frozenset({"mark_candidates"}),
+        "mark_pos_y": frozenset({"mark_candidates"}),
+    }
+    # 父指标有 selection 时取值不再是「窗口内全部列值」，保持两步查
+    meta = dict(f.rule_loader.get_metric_meta("mark_candidates"), selection="nearest")
+    real_meta = f.rule_loader.get_metric_meta
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda mid: meta if mid == "mark_candidates" else real_meta(mid))
+    assert f._plan_join_pushdown(ids) == {}
+    # 父指标不在本批（已由上下文提供）时不下推
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", real_meta)
+    assert f._plan_join_pushdown(["mark_pos_x"]) == {}
+    monkeypatch.setattr(metric_fetcher_module, "CH_JOIN_PUSHDOWN", False)
+    assert f._plan_join_pushdown(ids) == {}
+
+
+def test_progressive_window_widens_until_selection_is_satisfied(monkeypatch):
+    executed = []
+    T = datetime(2026, 3, 25, 12, 0, 0)
+
+    class FakeResult:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def fetchall(self):
+            return self._rows
+
+    class FakeDb:
+        def execute(self, sql, params):
+            executed.append(params["time_start"])
+            # 最近一行在 T 前 10 小时：1h、4h 窗口为空，16h 窗口命中
+            return FakeResult([(1.5,)] if T - params["time_start"] >= timedelta(hours=10) else [])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr("app.ods.datacenter_ods.SessionLocal", lambda: FakeDb())
+    shared = {"source_kind": "mysql_nearest_row", "table_name": "src", "column_name": "v", "duration": "7"}
+    metas = {
+        "Near": {**shared, "selection": "nearest", "window_strategy": "progressive"},
+        "Empty": {**shared, "table_name": "src_empty", "selection": "nearest", "window_strategy": "progressive"},
+    }
+    f = MetricFetcher(equipment="SSB8000", reference_time=T)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    assert f._fetch_one("Near") == [1.5]
+    assert [T - start for start in executed] == [timedelta(hours=1), timedelta(hours=4), timedelta(hours=16)]
+    assert f.source_log["Near"] == "real_mysql:progressive@16h"
+
+    monkeypatch.setattr(FakeDb, "execute", lambda self, sql, params: executed.append(params["time_start"]) or FakeResult([]))
+    executed.clear()
+    assert f._fetch_one("Empty") is None
+    # 1h → 4h → 16h → 64h → 完整 7 天
+    assert len(executed) == 5 and executed[-1] == T - timedelta(days=7)
+    assert f.source_log["Empty"] == "none:progressive@168h"
+
+    # selection=all 无法提前满足：progressive 退回一次查满完整窗口
+    metas["All"] = {**shared, "table_name": "src_all", "selection": "all", "window_strategy": "progressive"}
+    executed.clear()
+    f._fetch_one("All")
+    assert executed == [T - timedelta(days=7)]
+    assert f.source_log["All"] == "none"
+
+
+def test_approximate_clickhouse_metric_samples_and_caps_rows_read(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    queries = []
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None):
+            queries.append((query, settings))
+            if "SAMPLE" in query and "VIEW" in query:
+                raise RuntimeError("Code: 141. DB::Exception: Storage VIEW doesn't support sampling (SAMPLING_NOT_SUPPORTED)")
+            return SimpleNamespace(result_set=[[12.5]])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    clickhouse_ods.reset_sampling_support()
+    shared = {"source_kind": "clickhouse_window", "table_name": "las.HIST", "column_name": "v", "duration": "30"}
+    metas = {
+        "Mean": {**shared, "selection": "aggregate:avg", "approximate": True},
+        "Count": {**shared, "column_name": "w", "selection": "aggregate:count",
+                  "approximate": {"sample": 0.25, "max_rows_to_read": 1000}},
+        "ViewMean": {**shared, "table_name": "las.HIST_VIEW", "selection": "aggregate:avg", "approximate": True},
+        "Exact": {**shared, "selection": "aggregate:avg"},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+
+    def new_fetcher():
+        fetcher = MetricFetcher(equipment="SSB8000", reference_time=T)
+        monkeypatch.setattr(fetcher.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+        return fetcher
+
+    f = new_fetcher()
+    assert f._fetch_one("Mean") == [12.5]
+    sql, settings = queries[-1]
+    assert "FROM `las`.`HIST` SAMPLE 0.1" in sql and "avg(`v`)" in sql
+    assert settings == {"max_rows_to_read": metric_fetcher_module.CH_APPROX_MAX_ROWS_TO_READ, "read_overflow_mode": "break"}
+    assert f.source_log["Mean"] == "real_clickhouse:approx"
+
+    # 备忘 / 跨请求缓存命中的近似值仍标记 approximate
+    from app.engine.diagnosis_engine import DiagnosisEngine
+
+    queries.clear()
+    assert f._fetch_one("Mean") == [12.5]
+    assert f.source_log["Mean"] == "real_clickhouse:approx:memo"
+    cached = new_fetcher()
+    assert cached._fetch_one("Mean") == [12.5]
+    assert queries == []
+    assert cached.source_log["Mean"] == "real_clickhouse:approx:cache"
+    assert DiagnosisEngine._metric_approximate("Mean", metas["Mean"], cached.source_log) is True
+
+    f._fetch_one("Count")
+    sql, settings = queries[-1]
+    assert "SAMPLE 0.25" in sql and "count(`w`) * any(_sample_factor)" in sql
+    assert settings["max_rows_to_read"] == 1000
+
+    # 视图没有抽样键：去掉 SAMPLE 与读取行数上限按精确查询重试，之后不再尝试 SAMPLE
+    queries.clear()
+    assert f._fetch_one("ViewMean") == [12.5]
+    assert ["SAMPLE" in q for q, _ in queries] == [True, False]
+    assert queries[-1][1] is None
+    assert f.source_log["ViewMean"] == "real_clickhouse"
+    queries.clear()
+    metric_fetcher_module.clear_metric_window_cache()
+    new_fetcher()._fetch_one("ViewMean")
+    assert len(queries) == 1 and "SAMPLE" not in queries[0][0] and queries[0][1] is None
+
+    queries.clear()
+    f._fetch_one("Exact")
+    assert "SAMPLE" not in queries[0][0] and queries[0][1] is None
+    assert f.source_log["Exact"] == "real_clickhouse"
+    clickhouse_ods.reset_sampling_support()
+
+
+def test_approximate_requires_sql_side_aggregate():
+    from app.engine.metric_plan import compile_metric_plan
+
+    shared = {"source_kind": "clickhouse_window", "table_name": "t", "column_name": "v", "approximate": True}
+    assert compile_metric_plan("A", {**shared, "selection": "aggregate:avg"}).approximate is not None
+    assert "aggregate" in compile_metric_plan("B", {**shared, "selection": "nearest"}).error
+    assert "extraction_rule" in compile_metric_plan(
+        "C", {**shared, "selection": "aggregate:avg", "extraction_rule": "jsonpath:a/b"}
+    ).error
+    assert "sample" in compile_metric_plan(
+        "D", {**shared, "selection": "aggregate:avg", "approximate": {"sample": 2}}
+    ).error
+    # intermediate 上的 approximate 只是展示标记
+    assert compile_metric_plan("E", {"source_kind": "intermediate", "approximate": True}).error is None
+
+
+def test_clickhouse_extraction_streams_blocks_and_stops_early(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    streams = []
+
+    class FakeStream:
+        def __init__(self, blocks, settings):
+            self.blocks = blocks
+            self.settings = settings
+            self.consumed = 0
+            self.closed = False
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.closed = True
+
+        def __iter__(self):
+            for block in self.blocks:
+                self.consumed += 1
+                yield block
+
+    blocks = [
+        [["idle"], ["Mwx (1.0001)"]],
+        [["Mwx (1.0002)"], ["idle"]],
+        [["Mwx (1.0003)"], ["Mwx (1.0004)"]],
+    ]
+
+    class FakeClient:
+        def query_row_block_stream(self, query, parameters=None, settings=None):
+            streams.append(FakeStream(blocks, settings))
+            return streams[-1]
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    shared = {
+        "source_kind": "clickhouse_window",
+        "table_name": "las.LOG_VIEW",
+        "column_name": "detail",
+        "extraction_rule": "regex:Mwx\\s*\\(([\\d\\.]+)(?=\\))",
+    }
+    metas = {
+        "Near2": {**shared, "selection": "nearest_n:2"},
+        "Capped": {**shared, "max_rows": 3},
+    }
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    f = MetricFetcher(equipment="SSB8000", reference_time=T)
+    monkeypatch.setattr(f.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+
+    # nearest_n:2 在第二块取够两条后停止读取，第三块不再解码
+    assert f._fetch_one("Near2") == [1.0001, 1.0002]
+    assert streams[0].consumed == 2 and streams[0].closed
+    assert streams[0].settings == {"max_execution_time": clickhouse_ods.CH_MAX_EXECUTION_TIME_SECONDS}
+    assert f.source_log["Near2"] == "real_clickhouse"
+
+    # 行数预算：第二块截到第 3 行即停，服务端同时按 max_result_rows 截断
+    assert f._fetch_one("Capped") == [1.0001, 1.0002]
+    assert streams[1].consumed == 2
+    assert streams[1].settings["max_result_rows"] == 4
+    assert streams[1].settings["result_overflow_mode"] == "break"
+    assert f.source_log["Capped"] == "real_clickhouse:truncated"
+
+
+def test_window_row_stream_reports_truncation_only_when_rows_are_dropped(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    blocks = [[(1,), (2,)], [(3,), (4,)]]
+
+    class FakeClient:
+        def query_row_block_stream(self, query, parameters=None, settings=None):
+            return nullcontext(iter(blocks))
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+
+    def read(max_rows):
+        stream = clickhouse_ods.WindowRowStream("t", "SELECT 1", {}, {}, max_rows=max_rows)
+        rows = [row for block in stream for row in block]
+        return rows, stream.truncated
+
+    # 恰好读满预算：没有行被丢弃
+    assert read(4) == ([(1,), (2,), (3,), (4,)], False)
+    # 第一块恰好用完预算，第二块的行被丢弃
+    assert read(2) == ([(1,), (2,)], True)
+    assert read(3) == ([(1,), (2,), (3,)], True)
+
+
+def test_bulk_key_lookup_uploads_keys_as_external_table(monkeypatch):
+    import app.ods.clickhouse_ods as clickhouse_ods
+
+    captured = {}
+
+    class FakeClient:
+        def query(self, query, parameters=None, settings=None, external_data=None):
+            captured.update(query=query, parameters=parameters, external=external_data)
+            return SimpleNamespace(result_set=[
+                ("SSB8000", "LOT-1", "1", "W01", datetime(2026, 3, 25, 11), 1.5, 2.5),
+                ("SSB8000", "LOT-1", "1", "W01", datetime(2026, 3, 25, 10), 1.4, 2.4),
+                ("SSB8000", "LOT-2", "2", "W07", datetime(2026, 3, 24, 9), 3.5, 4.5),
+            ])
+
+        def close(self):
+            return None
+
+    monkeypatch.setattr(clickhouse_ods, "get_clickhouse_client", lambda: FakeClient())
+    T = datetime(2026, 3, 25, 12, 0, 0)
+    rows = clickhouse_ods.ClickHouseODS.query_rows_by_keys(
+        "src.RPT_WAA_V2_SET_OFL",
+        ["WS_pos_x", "WS_pos_y"],
+        ["equipment", "lot_id", "chuck_id", "wafer_id"],
+        [("SSB8000", "LOT-1", 1.0, "W01"), ("SSB8000", "LOT-2", 2, "W07"), ("SSB8000", "LOT-1", 1, "W01")],
+        T - timedelta(days=7),
+        T,
+        time_column="file_time",
+        time_column_type="DateTime",
+    )
+
+    sql = captured["query"]
+    assert "(toString(`equipment`), toString(`lot_id`), toString(`chuck_id`), toString(`wafer_id`)) IN _lookup_keys" in sql
+    assert "ORDER BY `file_time` DESC" in sql
+    external = captured["external"]
+    # 重复键只上传一次，浮点整数按整数写出
+    assert external.files[0].data == b"SSB8000\tLOT-1\t1\tW01\nSSB8000\tLOT-2\t2\tW07\n"
+    assert rows[("SSB8000", "LOT-1", "1", "W01")] == [
+        (datetime(2026, 3, 25, 11), 1.5, 2.5),
+        (datetime(2026, 3, 25, 10), 1.4, 2.4),
+    ]
+    assert rows[("SSB8000", "LOT-2", "2", "W07")][0][1:] == (3.5, 4.5)
+    assert clickhouse_ods.ClickHouseODS.query_rows_by_keys("t", ["v"], ["k"], [], T, T) == {}
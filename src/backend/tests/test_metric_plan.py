@@ -0,0 +1,130 @@
+"""
+MetricPlan 编译与取数绑定测试。
+"""
+import sys
+from datetime import datetime
+from pathlib import Path
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import pytest
+
+from app.diagnosis.config_store import DiagnosisConfigStore
+from app.engine.metric_fetcher import MetricFetcher
+from app.engine.metric_plan import (
+    compile_extraction_rule,
+    compile_filter_condition,
+    compile_metric_plan,
+)
+
+T = datetime(2026, 3, 25, 12, 0, 0)
+
+
+def test_pipeline_bundle_contains_compiled_metric_plans():
+    bundle = DiagnosisConfigStore().get_pipeline("reject_errors")
+    plans = bundle["metric_plans"]
+
+    sx = plans["Sx"]
+    assert sx.meta is bundle["metrics"]["Sx"]
+    assert sx.table_name == "datacenter.mc_config_commits_history"
+    assert sx.time_column == "last_modify_date"
+    assert sx.extraction.kind == "jsonpath"
+    assert sx.extraction.template_vars == ("chuck_index0",)
+    assert [pred.target for pred in sx.link_filters] == ["table_name", "env_id"]
+    assert sx.error is None
+
+    msx = plans["Msx"]
+    assert msx.linking_mode == "exact_keys"
+    assert [pred.target for pred in msx.link_keys] == ["equipment", "lot_id", "chuck_id", "wafer_id"]
+    assert msx.duration_days == 7
+    assert msx.selection.limit == 1
+
+
+def test_fetcher_reuses_bundle_plan_and_compiles_for_foreign_meta():
+    f = MetricFetcher(equipment="SSB8000", reference_time=T)
+    meta = f.rule_loader.get_metric_meta("Msx")
+    assert f._plan("Msx", meta) is f.pipeline["metric_plans"]["Msx"]
+
+    patched = {**meta, "duration": "3"}
+    plan = f._plan("Msx", patched)
+    assert plan.meta is patched
+    assert plan.duration_days == 3
+
+
+def test_filter_condition_compiles_once_with_static_param_indices():
+    node = compile_filter_condition("(a = 1 AND ???) OR b == {chuck_id}")
+    assert compile_filter_condition("(a = 1 AND ???) OR b == {chuck_id}") is node
+    assert node.kind == "or"
+    # 无法解析的片段被丢弃且不占参数序号
+    left, right = node.children
+    assert left.kind == "and" and [child.param_index for child in left.children] == [0]
+    assert right.operator == "=" and right.context_var == "chuck_id" and right.param_index == 1
+
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, chuck_id=2)
+    sql, params = f._bind_filter_tree(node, T, {})
+    assert sql == " AND ((a = :filter_0) OR (b = :filter_1))"
+    assert params == {"filter_0": 1, "filter_1": 2}
+
+
+def test_invalid_identifier_is_recorded_on_plan_and_raised_at_fetch_time():
+    meta = {
+        "source_kind": "mysql_nearest_row",
+        "table_name": "t; DROP TABLE x",
+        "column_name": "v",
+    }
+    plan = compile_metric_plan("Bad", meta)
+    assert plan.error and "非法 SQL 标识符" in plan.error
+
+    f = MetricFetcher(equipment="SSB8000", reference_time=T)
+    with pytest.raises(ValueError):
+        f._prepare_mysql_request("Bad", meta, {})
+
+
+def test_jsonpath_extractor_renders_template_once_per_request():
+    f = MetricFetcher(equipment="SSB8000", reference_time=T, chuck_id=2)
+    extractor = compile_extraction_rule("jsonpath:items[{chuck_index0}]/x")
+    bound = f._bind_extractor(extractor, {})
+    assert bound.path_segments == ("items[1]", "x")
+    assert f._apply_extractor('{"items": [{"x": 1}, {"x": 5}]}', bound) == 5
+
+    unresolved = MetricFetcher(equipment="SSB8000", reference_time=T)._bind_extractor(extractor, {})
+    assert unresolved is None
+    assert f._apply_extractor('{"items": []}', unresolved) is None
+
+
+def test_clickhouse_capture_regex_compiles_to_sql_extraction():
+    plans = DiagnosisConfigStore().get_pipeline("reject_errors")["metric_plans"]
+    assert plans["Mwx_0"].sql_extract_pattern == plans["Mwx_0"].extraction.argument
+    assert not plans["Mwx_0"].python_extraction
+
+    base = {"source_kind": "clickhouse_window", "table_name": "las.LOG", "column_name": "detail"}
+    for rule in ("regex:v=(\\d+)(?=;)", "regex:(a)\\1", "regex:v=(\\d++)"):
+        plan = compile_metric_plan("M", {**base, "extraction_rule": rule})
+        assert plan.sql_extract_pattern is None and plan.python_extraction
+    mysql = compile_metric_plan("M", {**base, "source_kind": "mysql_nearest_row", "extraction_rule": "regex:v=(\\d+)"})
+    assert mysql.sql_extract_pattern is None
+
+
+def test_typed_linking_renders_native_comparisons_and_prefix():
+    from app.engine.metric_plan import compile_link_predicate
+
+    untyped = compile_link_predicate({"target": "lot_id", "source": "lot_id"})
+    assert untyped.render("link_0", "LOT-1", "clickhouse")[0] == "toString(lot_id) = toString(%(link_0)s)"
+
+    chuck = compile_link_predicate({"target": "chuck_id", "source": "chuck_id", "type": "int"})
+    assert chuck.render("link_0", "2", "clickhouse") == ("chuck_id = %(link_0)s", {"link_0": 2})
+    assert chuck.render("link_0", "n/a", "clickhouse") == (None, {})
+
+    marks = compile_link_predicate({"target": "mark_id", "operator": "in", "source": "m", "type": "string"})
+    assert marks.render("link_1", [11.0, "M2"], "clickhouse") == (
+        "mark_id IN (%(link_1_0)s, %(link_1_1)s)",
+        {"link_1_0": "11", "link_1_1": "M2"},
+    )
+
+    env = compile_link_predicate({"target": "env_id", "operator": "prefix", "source": "equipment", "type": "string"})
+    assert env.render("link_2", "SSB_8000%", "mysql") == ("env_id LIKE :link_2", {"link_2": "SSB\\_8000\\%%"})
+    assert env.render("link_2", "SSB8000", "clickhouse")[0] == "env_id LIKE %(link_2)s"
+
+    with pytest.raises(ValueError):
+        compile_link_predicate({"target": "chuck_id", "operator": "contains", "source": "c", "type": "int"})
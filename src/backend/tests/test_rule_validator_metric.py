@@ -261,6 +261,28 @@ def test_unknown_linking_operator_rejected():
     assert any("operator" in e and "between" in e for e in errs)
 
 
+def test_linking_type_and_prefix_operator_validated():
+    def _linking_errors(item):
+        return validate_metrics_metadata(
+            {
+                "X": {
+                    "source_kind": "clickhouse_window",
+                    "table_name": "t.x",
+                    "column_name": "v",
+                    "linking": {"mode": "exact_keys", "keys": [item], "filters": []},
+                }
+            }
+        )
+
+    assert _linking_errors({"target": "env_id", "operator": "prefix", "source": "equipment", "type": "string"}) == []
+    assert _linking_errors({"target": "chuck_id", "source": "chuck_id", "type": "int"}) == []
+    assert any("type 非法" in e for e in _linking_errors({"target": "lot_id", "source": "lot_id", "type": "uuid"}))
+    assert any(
+        "只能用于 type=string" in e
+        for e in _linking_errors({"target": "chuck_id", "operator": "prefix", "source": "chuck_id", "type": "int"})
+    )
+
+
 def test_linking_key_missing_target_rejected():
     errs = validate_metrics_metadata(
         {
@@ -459,3 +481,93 @@ def test_mock_range_rejected_when_elements_not_numeric():
     metrics = {"X": {"source_kind": "intermediate", "mock_range": ["a", "b"]}}
     errs = validate_metrics_metadata(metrics)
     assert any("mock_range" in e and "\u6570\u5b57" in e for e in errs)
+
+
+# ── 跨请求窗口缓存: cache_ttl 校验 ─────────────────────────────────
+
+
+def test_cache_ttl_accepts_non_negative_seconds():
+    metrics = {
+        "A": {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v", "cache_ttl": 0},
+        "B": {"source_kind": "mysql_nearest_row", "table_name": "t", "column_name": "v", "cache_ttl": "120"},
+    }
+    assert validate_metrics_metadata(metrics) == []
+
+
+def test_cache_ttl_rejected_when_negative_or_not_numeric():
+    metrics = {
+        "A": {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v", "cache_ttl": -1},
+        "B": {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v", "cache_ttl": "soon"},
+    }
+    errs = validate_metrics_metadata(metrics)
+    assert sum("cache_ttl" in e for e in errs) == 2
+
+
+def test_selection_validated_for_db_metrics():
+    ok = {"A": {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v", "selection": "nearest_n:3"}}
+    assert validate_metrics_metadata(ok) == []
+    bad = {"A": {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v", "selection": "aggregate:median"}}
+    errs = validate_metrics_metadata(bad)
+    assert any("selection" in e for e in errs)
+
+
+def test_time_column_type_validated_for_clickhouse_metrics():
+    base = {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v"}
+    ok = {
+        "A": {**base, "time_column_type": "DateTime64"},
+        "B": {**base, "time_column_type": "Nullable(DateTime('Asia/Shanghai'))"},
+        "C": {**base, "time_column_type": "String"},
+    }
+    assert validate_metrics_metadata(ok) == []
+    bad = {
+        "A": {**base, "time_column_type": "Date32"},
+        "B": {"source_kind": "mysql_nearest_row", "table_name": "t", "column_name": "v", "time_column_type": "DateTime"},
+    }
+    errs = validate_metrics_metadata(bad)
+    assert sum("time_column_type" in e for e in errs) == 2
+
+
+def test_window_strategy_validated():
+    base = {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v"}
+    progressive = {**base, "window_strategy": "progressive"}
+    assert validate_metrics_metadata({"A": {**progressive, "selection": "nearest"}}) == []
+    assert validate_metrics_metadata({"A": {**progressive, "selection": "nearest_n:5"}}) == []
+    # 无捕获组 regex 的存在性探测命中即停，selection=all 也允许
+    assert validate_metrics_metadata({"A": {**progressive, "extraction_rule": "regex:ERR\\d+"}}) == []
+    errs = validate_metrics_metadata({"A": {**base, "window_strategy": "adaptive"}})
+    assert any("window_strategy" in e and "adaptive" in e for e in errs)
+    # all / aggregate 永远查到完整窗口，progressive 只会多发查询
+    for selection in (None, "all", "aggregate:avg"):
+        meta = dict(progressive, selection=selection) if selection else progressive
+        errs = validate_metrics_metadata({"A": meta})
+        assert any("window_strategy=progressive" in e for e in errs), selection
+
+
+def test_approximate_clickhouse_metric_validated():
+    base = {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v"}
+    assert validate_metrics_metadata({"A": {**base, "selection": "aggregate:avg", "approximate": True}}) == []
+    assert validate_metrics_metadata({
+        "A": {**base, "selection": "aggregate:count", "approximate": {"sample": 0.2, "max_rows_to_read": 100000}},
+    }) == []
+    errs = validate_metrics_metadata({"A": {**base, "selection": "nearest", "approximate": True}})
+    assert any("approximate" in e and "aggregate" in e for e in errs)
+    # min / max 在抽样上偏向中间值，_sample_factor 也无法校正
+    for aggregate in ("min", "max"):
+        errs = validate_metrics_metadata({"A": {**base, "selection": f"aggregate:{aggregate}", "approximate": True}})
+        assert any("approximate" in e and "avg|count" in e for e in errs), aggregate
+    errs = validate_metrics_metadata({"A": {**base, "selection": "aggregate:avg", "approximate": {"sample": 0}}})
+    assert any("approximate.sample" in e for e in errs)
+    errs = validate_metrics_metadata({
+        "A": {**base, "selection": "aggregate:avg", "approximate": True, "extraction_rule": "jsonpath:a/b"},
+    })
+    assert any("extraction_rule" in e for e in errs)
+
+
+def test_read_budgets_validated():
+    base = {"source_kind": "clickhouse_window", "table_name": "t.x", "column_name": "v"}
+    assert validate_metrics_metadata({"A": {**base, "max_rows": 200000, "max_bytes": 64 << 20}}) == []
+    errs = validate_metrics_metadata({"A": {**base, "max_rows": 0}})
+    assert any("max_rows" in e for e in errs)
+    mysql = {"source_kind": "mysql_nearest_row", "table_name": "t", "column_name": "v"}
+    errs = validate_metrics_metadata({"A": {**mysql, "max_bytes": 1024}})
+    assert any("max_bytes" in e and "clickhouse_window" in e for e in errs)
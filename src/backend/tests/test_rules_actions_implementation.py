@@ -149,3 +149,52 @@ if __name__ == "__main__":
     test_build_model_uses_explicit_model_type()
     test_build_model_auto_determines_type_from_mwx0()
     print("OK: test_rules_actions_implementation")
+
+
+def test_monthly_mean_uses_ods_aggregate_and_caches_by_window(monkeypatch):
+    from datetime import datetime
+
+    from app.engine.actions import builtin
+    from app.ods.datacenter_ods import DatacenterODS
+
+    calls = []
+
+    def _fake_aggregate(column_name, equipment, chuck_id, start_time, end_time, db=None):
+        calls.append((column_name, equipment, chuck_id, start_time, end_time))
+        return {"avg": 0.42, "count": 1200, "stddev": 0.05}
+
+    builtin._monthly_aggregate_cache.clear()
+    monkeypatch.setattr(DatacenterODS, "query_performance_aggregate", staticmethod(_fake_aggregate))
+    ctx = {"equipment": "SSB8000", "chuck_id": 1}
+
+    out1 = builtin.calculate_monthly_mean_Tx(Tx=None, reference_time=datetime(2026, 3, 25, 9, 0), **ctx)
+    out2 = builtin.calculate_monthly_mean_Tx(Tx=None, reference_time=datetime(2026, 3, 25, 9, 0), **ctx)
+    builtin.calculate_monthly_mean_Tx(Tx=None, reference_time=datetime(2026, 3, 25, 18, 0), **ctx)
+
+    assert out1 == out2 == {"mean_Tx": 0.42}
+    # 同一窗口复用聚合缓存；同一天但窗口不同（基准时间不同）重新查询
+    assert len(calls) == 2
+    assert calls[1][3] == datetime(2026, 2, 23, 18, 0)
+    assert calls[0][0] == "wafer_translation_x"
+    builtin._monthly_aggregate_cache.clear()
+
+
+def test_monthly_mean_falls_back_to_current_value_on_empty_window(monkeypatch):
+    from datetime import datetime
+
+    from app.engine.actions import builtin
+    from app.ods.datacenter_ods import DatacenterODS
+
+    builtin._monthly_aggregate_cache.clear()
+    monkeypatch.setattr(
+        DatacenterODS,
+        "query_performance_aggregate",
+        staticmethod(lambda *args, **kwargs: {"avg": None, "count": 0, "stddev": None}),
+    )
+    value = builtin._query_monthly_mean(
+        "wafer_rotation", 3.5, equipment="SSB8000", chuck_id=2, reference_time=datetime(2026, 3, 25)
+    )
+    assert value == 3.5
+    # 空窗口不缓存：数据补齐后的下一次请求直接查到
+    assert len(builtin._monthly_aggregate_cache) == 0
+    builtin._monthly_aggregate_cache.clear()
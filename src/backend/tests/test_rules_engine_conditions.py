@@ -18,7 +18,12 @@ from app.engine.diagnosis_engine import (
     BRANCH_OUTCOME_NO_MATCH_NO_ELSE,
     DiagnosisEngine,
 )
-from app.engine.condition_evaluator import evaluate_boolean_condition_text, evaluate_condition_text
+from app.engine.condition_evaluator import (
+    evaluate_boolean_condition_text,
+    evaluate_condition_definition,
+    evaluate_condition_text,
+)
+from app.engine.step_plan import compile_condition
 from app.engine.metric_fetcher import MetricFetcher
 
 
@@ -252,6 +257,23 @@ def test_mwx0_threshold_display_can_recover_from_legacy_cache_shape():
     )
 
 
+def test_alias_metric_threshold_resolves_through_alias_of():
+    engine = DiagnosisEngine()
+    threshold = engine._find_threshold("output_Tx")
+    assert threshold == {"operator": "between", "limit": [-20.0, 20.0], "display": "-20 < {output_Tx} < 20"}
+
+
+def test_cached_any_of_threshold_display_uses_index_and_tolerates_config_drift():
+    engine = DiagnosisEngine()
+    cached = {key: value for key, value in engine._find_threshold("Mwx_0").items() if key != "branchDisplays"}
+    assert engine.select_cached_threshold_display(1.00005, cached, "Mwx_0") == "1.00002 < {Mwx_0} < 1.0001"
+    assert engine.select_cached_threshold_display(None, cached, "Mwx_0") == cached["display"]
+
+    drifted = dict(cached, limit=[{"operator": "between", "limit": [1.0, 2.0]}])
+    assert engine.select_cached_threshold_display(1.5, drifted, "Mwx_0") == "1.0 < {Mwx_0} < 2.0"
+    assert engine.select_cached_threshold_display(5.0, {"operator": "<=", "limit": 8, "display": "x"}, "n_88um") == "x"
+
+
 def test_between_threshold_uses_open_interval():
     engine = DiagnosisEngine()
     assert engine._is_within_normal_range(0.0, "between", [-20, 20]) is True
@@ -383,6 +405,23 @@ def test_metrics_list_uses_final_context_outputs_and_means():
     assert by_name["output_Tx"]["approximate"] is True
 
 
+def test_metrics_list_flags_db_metrics_approximate_from_fetch_outcome(monkeypatch):
+    engine = DiagnosisEngine()
+    metas = {
+        "Sampled": {"source_kind": "clickhouse_window", "approximate": True},
+        "FellBack": {"source_kind": "clickhouse_window", "approximate": True},
+        "Derived": {"source_kind": "intermediate", "approximate": True},
+    }
+    monkeypatch.setattr(engine.rule_loader, "get_metric_meta", lambda metric_id: metas.get(metric_id))
+    metrics = engine._build_metrics_list(
+        list(metas),
+        {"Sampled": 1.0, "FellBack": 2.0, "Derived": 3.0},
+        {"Sampled": "real_clickhouse:approx", "FellBack": "real_clickhouse"},
+    )
+    by_name = {m["name"]: m["approximate"] for m in metrics}
+    assert by_name == {"Sampled": True, "FellBack": False, "Derived": True}
+
+
 def test_metrics_list_keeps_missing_model_params_as_unknown():
     engine = DiagnosisEngine()
     metrics = engine._build_metrics_list(
@@ -434,6 +473,188 @@ def test_select_scene_uses_trigger_conditions(monkeypatch):
     ]
 
 
+
+def test_select_scene_rules_out_scenes_by_free_trigger_before_db_fetch(monkeypatch):
+    engine = DiagnosisEngine()
+    loader = engine.rule_loader
+    metrics = dict(loader.metrics_meta)
+    metrics["scene_reject_reason"] = {"source_kind": "failure_record_field", "field": "reject_reason"}
+    metrics["scene_log_a"] = {"source_kind": "clickhouse", "table": "log_a"}
+    metrics["scene_log_b"] = {"source_kind": "clickhouse", "table": "log_b"}
+    scenes = [
+        {
+            "id": "a",
+            "metric_id": ["scene_reject_reason", "scene_log_a"],
+            "trigger_condition": "{scene_reject_reason} == 'COWA_1' AND {scene_log_a} == true",
+            "start_node": "1",
+        },
+        {
+            "id": "b",
+            "metric_id": ["scene_reject_reason", "scene_log_b"],
+            "trigger_condition": [{"all_of": ["{scene_reject_reason} == 'COWA_6'", "{scene_log_b} == true"]}],
+            "start_node": "1",
+        },
+        {"id": "fallback", "default": True, "start_node": "1"},
+        {"id": "unreachable", "metric_id": ["scene_log_a"], "start_node": "1"},
+    ]
+    monkeypatch.setattr(loader, "metrics_meta", metrics)
+    monkeypatch.setattr(loader, "diagnosis_scenes", scenes)
+
+    requested = []
+
+    def fake_fetch_from_source_record(self, source_record, metric_ids):
+        requested.append(list(metric_ids))
+        values = {"scene_reject_reason": source_record.get("reject_reason"), "scene_log_a": True, "scene_log_b": True}
+        return {mid: values.get(mid) for mid in metric_ids}
+
+    monkeypatch.setattr(
+        "app.engine.metric_fetcher.MetricFetcher.fetch_from_source_record",
+        fake_fetch_from_source_record,
+    )
+    fetcher = MetricFetcher(equipment="SSB8000", reference_time=datetime(2026, 1, 1), chuck_id=1)
+
+    scene = engine._select_scene({"reject_reason": "COWA_6"}, fetcher)
+    assert scene["id"] == "b"
+    # 场景 a 被源表字段排除：其 ClickHouse 触发指标不取；剩余场景的查库指标一批取齐
+    assert requested == [["scene_reject_reason"], ["scene_reject_reason", "scene_log_b"]]
+
+    requested.clear()
+    scene = engine._select_scene({"reject_reason": "OTHER"}, fetcher)
+    assert scene["id"] == "fallback"
+    assert requested == [["scene_reject_reason"]]
+
+
+def test_scene_dispatch_keeps_undecidable_conditions_as_candidates():
+    from app.engine.scene_dispatch import candidate_db_metric_ids, compile_scene_dispatch, dispatch_candidates
+
+    metrics = {
+        "reason": {"source_kind": "failure_record_field"},
+        "param": {"source_kind": "request_param"},
+        "log": {"source_kind": "clickhouse"},
+    }
+    scenes = [
+        # OR 跨免费与查库指标：免费值判不出，保留
+        {"id": "or", "metric_id": ["reason", "log"], "trigger_condition": "{reason} == 'X' OR {log} == true"},
+        # 多条 trigger_condition 任一可能成立即保留
+        {"id": "multi", "metric_id": ["reason", "log"], "trigger_condition": ["{reason} == 'X'", "{log} == true"]},
+        {"id": "param", "metric_id": ["param", "log"], "trigger_condition": "{param} > 3 AND {log} == true"},
+        # 无条件：全部触发指标为真才命中
+        {"id": "flags", "metric_id": ["param", "log"]},
+    ]
+    dispatch = compile_scene_dispatch(scenes, metrics)
+    assert dispatch.free_metric_ids == ("reason", "param")
+
+    candidates, excluded = dispatch_candidates(dispatch, {"reason": "Y", "param": 0})
+    assert [plan.scene["id"] for plan in candidates] == ["or", "multi"]
+    assert [plan.scene["id"] for plan in excluded] == ["param", "flags"]
+    assert candidate_db_metric_ids(candidates) == ["log"]
+
+    candidates, _ = dispatch_candidates(dispatch, {"reason": "Y", "param": 5})
+    assert [plan.scene["id"] for plan in candidates] == ["or", "multi", "param", "flags"]
+
+
+@pytest.mark.parametrize(
+    "condition",
+    [
+        "-2 < {mean_Tx} < 2",
+        "1.00002 < {Mwx_0} < 1.0001",
+        "{model_type} == '88um'",
+        "{n_88um} >= 8",
+        "{output_Tx} > {output_Ty}",
+        "{missing} == 1",
+        "{flag} == true",
+        "{mean_Tx} > 1 AND {n_88um} < 3",
+        {"compare": {"left": "n_88um", "operator": "<=", "right": 8}},
+        {"all_of": ["{n_88um} <= 8", {"compare": {"left": "model_type", "op": "==", "right": "8um"}}]},
+        {"any_of": ["{mean_Tx} > 100", "-2 < {mean_Tx} < 2"]},
+        {"not": "{model_type} == '88um'"},
+        {"unknown": 1},
+    ],
+)
+def test_compiled_condition_matches_interpreted(condition):
+    contexts = [
+        {"mean_Tx": 0.5, "Mwx_0": 1.00005, "model_type": "8um", "n_88um": 3,
+         "output_Tx": 5, "output_Ty": 2, "flag": [False, True]},
+        {"mean_Tx": "abc", "Mwx_0": None, "model_type": "88um", "n_88um": 12, "output_Ty": None},
+        {},
+    ]
+    compiled = compile_condition(condition, "fallback_metric")
+    for context in contexts:
+        assert compiled(context) == evaluate_condition_definition(condition, context, "fallback_metric")
+
+
+def test_walk_uses_pipeline_step_plans_and_recompiles_replaced_steps():
+    engine = DiagnosisEngine()
+    loader = engine.rule_loader
+    step = loader.get_step("20")
+    assert loader.get_step_plan(step) is loader.step_plans["20"]
+
+    replaced = dict(step, next=[{"target": "99", "condition": "{n_88um} <= 100"}])
+    plan = loader.get_step_plan(replaced)
+    assert plan is not loader.step_plans["20"]
+    assert [branch.target for branch in plan.branches] == ["99"]
+
+
+
+def test_lazy_metric_resolution_follows_walked_path(monkeypatch):
+    values = {
+        "trigger_reject_reason_cowa_6": True,
+        "trigger_log_mwx_cgg6_range": True,
+        # 落在 [0.99998, 1.00002] 规则盲区：1 → 99
+        "Mwx_0": 1.00001,
+        "Tx": 30.0,
+        "mean_Tx": 0.5,
+    }
+    requested = []
+
+    def fake_fetch_from_source_record(self, source_record, metric_ids, extra_context=None):
+        requested.extend(metric_ids)
+        return {mid: values.get(mid) for mid in metric_ids}
+
+    monkeypatch.setattr(
+        "app.engine.metric_fetcher.MetricFetcher.fetch_from_source_record",
+        fake_fetch_from_source_record,
+    )
+    source_record = {
+        "id": 1,
+        "equipment": "SSB8000",
+        "chuck_id": 1,
+        "reject_reason": 6,
+        "wafer_product_start_time": datetime(2026, 1, 10, 8, 45, 0),
+    }
+
+    eager = DiagnosisEngine(lazy_metrics=False).diagnose(source_record)
+    requested.clear()
+    lazy = DiagnosisEngine(lazy_metrics=True).diagnose(source_record)
+
+    assert lazy.trace == eager.trace
+    assert (lazy.root_cause, lazy.system) == (eager.root_cause, eager.system)
+    assert sorted(m["name"] for m in lazy.metrics) == sorted(m["name"] for m in eager.metrics)
+    # 未走到的 step 的指标不取，详情里为 UNKNOWN
+    assert {m["name"]: m["status"] for m in lazy.metrics}["Tx"] == "UNKNOWN"
+    # 只取 step 1 的指标并预取直接后继（10 / 11 / 99）的指标；更深层的月均值、计数器不取
+    assert "mean_Tx" not in requested
+    assert "normal_count" not in requested
+    assert "Mwx_0" in requested
+    assert "ws_pos_x" in requested
+
+
+def test_lazy_step_demand_covers_context_keys_actions_read_implicitly():
+    from app.engine.lazy_metrics import LazyMetricResolver
+
+    engine = DiagnosisEngine()
+    resolver = LazyMetricResolver(None, {}, engine.rule_loader, scene_metric_ids=["Mwx_0", "Tx"])
+    try:
+        # build_88um_model 建模失败时回退输出读 Tx / Ty / Rw，params 里没写也要先取
+        demand = resolver.step_demand(engine.rule_loader.get_step("10"))
+        assert {"Tx", "Ty", "Rw", "ws_pos_x"} <= set(demand)
+        # 未声明 reads 的 action：读集未知，先取齐场景指标
+        opaque = {"id": "x", "details": [{"action": "not_registered", "results": {"out": ""}}]}
+        assert resolver.step_demand(opaque) == ["out", "Mwx_0", "Tx"]
+    finally:
+        resolver.close()
+
+
 if __name__ == "__main__":
     test_expression_string_equality_branch()
     test_expression_numeric_equality_branch()
@@ -454,3 +675,144 @@ if __name__ == "__main__":
     test_continue_model_routes_to_manual_when_attempts_exhausted()
     test_metrics_list_uses_final_context_outputs_and_means()
     print("OK: test_rules_engine_conditions")
+
+
+def test_multi_target_children_without_hazards_run_concurrently(monkeypatch):
+    import threading
+
+    from app.engine import actions as actions_module
+
+    barrier = threading.Barrier(3, timeout=5)
+    threads = {}
+
+    def bump(out, wait, **context):
+        # a / b / c 同批并发：三者都到达 barrier 才继续，串行执行会超时
+        if wait:
+            barrier.wait()
+        threads[out] = threading.current_thread().name
+        return {out: (context.get(out) or 0) + 1}
+
+    for table in ("_REGISTRY", "_READS", "_WRITES", "_DEFAULTS"):
+        monkeypatch.setattr(actions_module, table, dict(getattr(actions_module, table)))
+    actions_module.register("test_bump", reads={"{out}"}, writes={"{out}"})(bump)
+
+    def child(step_id, out, wait, next_target=None):
+        return {
+            "id": step_id,
+            "details": [{"action": "test_bump", "params": {"out": out, "wait": wait}, "results": {out: ""}}],
+            "next": [{"target": next_target, "condition": ""}] if next_target else [],
+        }
+
+    steps = [
+        {"id": "1", "next": [{"target": ["a", "c", "b", "d"], "condition": ""}]},
+        child("a", "out_a", True, next_target="leaf_a"),
+        child("b", "out_b", True),
+        # c / d 都读改写 cnt：d 必须等 c 合并后执行
+        child("c", "cnt", True),
+        child("d", "cnt", False),
+        {"id": "leaf_a", "details": [{"result": {"rootCause": "A", "system": "S"}}]},
+    ]
+    engine = DiagnosisEngine(subtree_max_workers=4)
+    loader = engine.rule_loader
+    monkeypatch.setattr(loader, "steps", steps)
+    monkeypatch.setattr(loader, "steps_map", {step["id"]: step for step in steps})
+
+    root_cause, system, trace, _, context = engine._walk_tree("1", {}, {})
+
+    assert (root_cause, system) == ("A", "S")
+    assert trace == ["1", "a", "leaf_a", "c", "b", "d"]
+    assert context["out_a"] == 1 and context["out_b"] == 1
+    assert context["cnt"] == 2
+    assert context["__leaf_result__"] == {"rootCause": "A", "system": "S"}
+    assert all(name.startswith("subtree") for name in threads.values())
+
+
+def test_subtree_schedule_keeps_shared_counter_children_sequential():
+    from app.engine.subtree_effects import SubtreeEffects, schedule_children
+
+    engine = DiagnosisEngine()
+    index = engine.rule_loader.get_subtree_index()
+    # 22/23/24 分别走到 221/231/241，都读改写 normal_count
+    assert "normal_count" in index.get("22").writes
+    assert schedule_children([index.get(step_id) for step_id in ("22", "23", "24")]) == ((0,), (1,), (2,))
+    assert index.schedules[("22", "23", "24")] == ((0,), (1,), (2,))
+
+    independent = SubtreeEffects(reads=frozenset({"x"}), writes=frozenset({"y"}))
+    reader = SubtreeEffects(reads=frozenset({"y"}))
+    opaque = SubtreeEffects(opaque=True)
+    assert schedule_children([independent, SubtreeEffects(), reader]) == ((0, 1), (2,))
+    assert schedule_children([SubtreeEffects(), opaque, SubtreeEffects()]) == ((0,), (1,), (2,))
+
+
+def test_subtree_effects_use_declared_action_reads_and_treat_undeclared_actions_as_opaque():
+    from app.engine.subtree_effects import step_effects
+
+    # build_88um_model 回退输出读 Tx / Ty / Rw，params 里没写也计入读集；输出不按 results 过滤
+    model = step_effects({"id": "10", "details": [{"action": "build_88um_model", "results": {"output_Tx": ""}}]})
+    assert not model.opaque
+    assert {"Tx", "Ty", "Rw", "ws_pos_x"} <= model.reads
+    assert "model_history" in model.writes
+    counter = step_effects({
+        "id": "221",
+        "details": [{"action": "increment_counter", "params": {"counter_name": "hits"}, "results": {"hits": ""}}],
+    })
+    assert "hits" in counter.reads and "hits" in counter.writes
+    assert step_effects({"id": "x", "details": [{"action": "not_registered", "results": {"o": ""}}]}).opaque
+    # 计数键来自 context（运行时才知道）：读写集未知
+    dynamic = step_effects({
+        "id": "y",
+        "details": [{"action": "increment_counter", "params": {"counter_name": "{name}"}, "results": {"n": ""}}],
+    })
+    assert dynamic.opaque
+
+
+def test_multi_target_parallel_walk_matches_sequential_walk(monkeypatch):
+    from app.engine import actions as actions_module
+
+    for table in ("_REGISTRY", "_READS", "_WRITES", "_DEFAULTS"):
+        monkeypatch.setattr(actions_module, table, dict(getattr(actions_module, table)))
+
+    def scale(**context):
+        # 只经 **context 读取 base，params 里不声明
+        return {"scaled": (context.get("base") or 0) * 10}
+
+    def tag(**context):
+        return {"tag": "seen_" + str(context.get("scaled"))}
+
+    actions_module.register("test_scale", reads={"base"}, writes={"scaled"})(scale)
+    # 未声明 reads / writes：不透明，与任何子分支都串行
+    actions_module.register("test_tag")(tag)
+
+    steps = [
+        {"id": "1", "next": [{"target": ["w", "m", "c1", "t", "c2", "i"], "condition": ""}]},
+        {"id": "w", "next": [{"target": "w_leaf", "condition": "", "set": {"base": 7}}]},
+        {"id": "w_leaf", "details": [{"result": {"rootCause": "W", "system": "S"}}]},
+        {"id": "m", "details": [{"action": "test_scale", "results": {"scaled": ""}}]},
+        {
+            "id": "c1",
+            "details": [{"action": "increment_counter", "params": {"counter_name": "cnt"}, "results": {"cnt": ""}}],
+        },
+        {"id": "t", "details": [{"action": "test_tag", "results": {"tag": ""}}]},
+        {
+            "id": "c2",
+            "details": [{"action": "increment_counter", "params": {"counter_name": "cnt"}, "results": {"cnt": ""}}],
+        },
+        {"id": "i", "next": [{"target": "i_leaf", "condition": "", "set": {"other": 1}}]},
+        {"id": "i_leaf", "details": [{"result": {"rootCause": "I", "system": "S"}}]},
+    ]
+
+    def walk(workers):
+        engine = DiagnosisEngine(subtree_max_workers=workers)
+        loader = engine.rule_loader
+        monkeypatch.setattr(loader, "steps", steps)
+        monkeypatch.setattr(loader, "steps_map", {step["id"]: step for step in steps})
+        return engine._walk_tree("1", {"base": 1}, {})
+
+    sequential = walk(1)
+    parallel = walk(4)
+    assert parallel[0:3] == sequential[0:3]
+    assert parallel[4] == sequential[4]
+    # m 读到 w 写入的 base，t 读到 m 的输出，计数器累加两次
+    assert parallel[4]["scaled"] == 70
+    assert parallel[4]["tag"] == "seen_70"
+    assert parallel[4]["cnt"] == 2